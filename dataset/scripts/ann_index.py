@@ -0,0 +1,366 @@
+"""
+APPROXIMATE NEAREST NEIGHBOR INDEXES
+
+FAISS index backends for the product neighbor job, built from an `EmbeddingStore`:
+- "flat": exact search, the ground truth; O(N * d) per query
+- "ivf_flat": vectors clustered into `nlist` lists, a query scans the `nprobe` closest lists
+- "ivf_pq": as ivf_flat, with vectors compressed by product quantization to `pq_m` codes
+  of `pq_bits` bits (e.g. 1536 float32 dims = 6 KB -> 64 bytes)
+- "hnsw": a navigable small world graph of `hnsw_m` links per vector, searched with a
+  candidate list of `ef_search`
+
+Every kind can compare vectors by L2 distance (`metric="l2"`) or by inner product
+(`metric="ip"`, i.e. cosine similarity of unit-norm vectors such as OpenAI
+embeddings; build the store with `normalize=True` to be sure they are). With
+`scalar_quantizer` "fp16" or "int8" the flat, ivf_flat and hnsw indexes store each
+dimension in 2 or 1 bytes instead of 4 (faiss `IndexScalarQuantizer` and its IVF and
+HNSW variants), so they take half or a quarter of the memory and scan fewer bytes
+per query; `benchmark_ann.py` reports what that costs in recall.
+
+Any of them (or a `ShardedSearcher`) can be the first stage of a `RerankingSearcher`:
+built over a reduced-dimension store (e.g. the first 256 of 1536 dimensions, see
+`EmbeddingStore.build(dimensions=...)`), it shortlists `shortlist_size` candidates per
+query, which are re-ranked exactly with the full vectors. The index is 6x smaller and
+6x cheaper to scan, and recall@k stays close to full-dimension search.
+
+IVF indexes are trained (k-means, and the PQ codebooks) on a random sample of
+`train_size` vectors; faiss recommends at least 39 * nlist of them. `nprobe` and
+`ef_search` trade recall for speed at search time and can be changed on a built index
+with `set_search_params`. Use `benchmark_ann.py` to pick an operating point.
+
+A built index is saved to a directory (`save_index`) with the item ids of its rows and
+a manifest of the config and the store it was built from. `open_or_build_index` loads
+it again, unless the store's shards or the build options changed since; search-time
+settings are not part of the build and are applied on load. Loading memory-maps the
+index file (faiss `IO_FLAG_MMAP`), so it takes seconds instead of a rebuild, and
+processes that load the same index share its pages through the page cache. Mapping
+covers the inverted lists of IVF indexes, and the codes of flat and HNSW indexes with
+faiss releases that have `IO_FLAG_MMAP_IFC`; the rest (e.g. HNSW graph links) is read
+into memory.
+
+Example:
+```
+config = IndexConfig(kind="ivf_pq", metric="ip", nprobe=64)
+index, ids = open_or_build_index(store, config, "dataset/faiss_index/ivf_pq_ip")
+distances, rows = index.search(queries, 100)  # ids[rows] are the item ids
+```
+"""
+
+import json
+import os
+import shutil
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Tuple, Union
+
+import faiss
+import numpy as np
+from loguru import logger
+
+from scripts.embedding_store import EmbeddingStore, normalize_rows
+
+INDEX_KINDS = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+METRICS = {"l2": faiss.METRIC_L2, "ip": faiss.METRIC_INNER_PRODUCT}
+SCALAR_QUANTIZERS = {
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+# IndexConfig fields that only affect search; a saved index is reused when they change
+SEARCH_PARAMS = ("nprobe", "ef_search")
+
+
+@dataclass
+class IndexConfig:
+    kind: str = "flat"
+    metric: str = "l2"  # "l2", or "ip" for inner product
+    scalar_quantizer: str = None  # None (float32), "fp16" or "int8"; not for ivf_pq
+    nlist: int = 4096  # IVF lists
+    pq_m: int = 64  # PQ sub-quantizers; must divide the dimensions
+    pq_bits: int = 8  # bits per PQ code
+    hnsw_m: int = 32  # HNSW links per vector
+    ef_construction: int = 200  # HNSW candidate list while building
+    train_size: int = 200_000  # vectors sampled to train IVF and int8 indexes
+    nprobe: int = 32  # IVF lists scanned per query
+    ef_search: int = 128  # HNSW candidate list per query
+    add_batch_size: int = 100_000
+    seed: int = 0
+
+
+def create_index(dimensions: int, config: IndexConfig) -> faiss.Index:
+    """An empty (untrained) index of `config.kind`."""
+    if config.kind not in INDEX_KINDS:
+        raise ValueError(
+            f'Unknown index "{config.kind}", expected one of {INDEX_KINDS}'
+        )
+    metric = METRICS[config.metric]
+    qtype = None
+    if config.scalar_quantizer is not None:
+        if config.kind == "ivf_pq":
+            raise ValueError("ivf_pq already compresses vectors, use no scalar_quantizer")
+        qtype = SCALAR_QUANTIZERS[config.scalar_quantizer]
+
+    if config.kind == "flat":
+        if qtype is not None:
+            return faiss.IndexScalarQuantizer(dimensions, qtype, metric)
+        return faiss.IndexFlat(dimensions, metric)
+    if config.kind == "hnsw":
+        if qtype is not None:
+            index = faiss.IndexHNSWSQ(dimensions, qtype, config.hnsw_m, metric)
+        else:
+            index = faiss.IndexHNSWFlat(dimensions, config.hnsw_m, metric)
+        index.hnsw.efConstruction = config.ef_construction
+        return index
+
+    quantizer = faiss.IndexFlat(dimensions, metric)
+    if config.kind == "ivf_pq":
+        index = faiss.IndexIVFPQ(
+            quantizer, dimensions, config.nlist, config.pq_m, config.pq_bits, metric
+        )
+    elif qtype is not None:
+        index = faiss.IndexIVFScalarQuantizer(
+            quantizer, dimensions, config.nlist, qtype, metric
+        )
+    else:
+        index = faiss.IndexIVFFlat(quantizer, dimensions, config.nlist, metric)
+    # the faiss wrapper keeps the quantizer alive (index.referenced_objects)
+    return index
+
+
+def build_index(store: EmbeddingStore, config: IndexConfig) -> faiss.Index:
+    """
+    Create, train and fill an index with all rows of `store`, in row order.
+
+    Rows are read as float32 whatever the store's dtype; a float16 or int8 store
+    saves memory on disk and in the page cache, the index's own codes are set by
+    `config.scalar_quantizer`.
+    """
+    started_at = time.perf_counter()
+    index = create_index(store.dimensions, config)
+    if not index.is_trained:
+        rng = np.random.default_rng(config.seed)
+        train_size = min(config.train_size, len(store))
+        sample = np.sort(rng.choice(len(store), train_size, replace=False))
+        logger.info(f"Training {config.kind} index on {train_size} vectors...")
+        index.train(store.get(sample))
+    for start in range(0, len(store), config.add_batch_size):
+        index.add(store.get_range(start, start + config.add_batch_size))
+    set_search_params(index, config)
+    logger.info(
+        f"Built {describe_index(config)} index of {index.ntotal} vectors "
+        f"in {time.perf_counter() - started_at:.1f}s"
+    )
+    return index
+
+
+def describe_index(config: IndexConfig) -> str:
+    """E.g. "hnsw/ip/int8"."""
+    return "/".join([config.kind, config.metric, config.scalar_quantizer or "float32"])
+
+
+def set_search_params(index: faiss.Index, config: IndexConfig) -> None:
+    """Apply `nprobe` (IVF) or `ef_search` (HNSW) to a built index."""
+    parameters = faiss.ParameterSpace()
+    if config.kind in ("ivf_flat", "ivf_pq"):
+        parameters.set_index_parameter(index, "nprobe", config.nprobe)
+    elif config.kind == "hnsw":
+        parameters.set_index_parameter(index, "efSearch", config.ef_search)
+
+
+def index_size_bytes(index: faiss.Index) -> int:
+    """Memory the index needs, measured as the size of its serialized form (a copy of it)."""
+    return faiss.serialize_index(index).nbytes
+
+
+def save_index(
+    index: faiss.Index,
+    directory: Union[str, Path],
+    config: IndexConfig,
+    store: EmbeddingStore,
+) -> Path:
+    """
+    Write a built index to `directory`, with its id mapping and build manifest:
+    - index.faiss: the index, as written by `faiss.write_index`
+    - ids.npy: the item id of each index row (the rows of `store`, in order)
+    - index.json: the config it was built with, and the manifest of `store`, which
+      includes the fingerprints of the embedding shards
+
+    The files are written to a temporary directory that is then renamed, so
+    `directory` is either complete or missing.
+    """
+    directory = Path(directory)
+    temporary_dir = directory.with_name(directory.name + ".tmp")
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    temporary_dir.mkdir(parents=True)
+    faiss.write_index(index, str(temporary_dir / "index.faiss"))
+    np.save(temporary_dir / "ids.npy", store.ids)
+    with open(temporary_dir / "index.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "index": describe_index(config),
+                "ntotal": index.ntotal,
+                "config": asdict(config),
+                "store_dir": str(store.directory),
+                "store": store.manifest,
+            },
+            f,
+            indent=2,
+        )
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temporary_dir, directory)
+    logger.info(f"Saved the {describe_index(config)} index to {directory}")
+    return directory
+
+
+def load_index(
+    directory: Union[str, Path], config: IndexConfig = None, mmap: bool = True
+) -> Tuple[faiss.Index, np.ndarray]:
+    """
+    Load an index written by `save_index`, and the item id of each of its rows.
+
+    With `mmap`, the index file is mapped read-only instead of copied into memory.
+    `config` sets the search parameters; without it, they are the ones saved.
+    """
+    directory = Path(directory)
+    with open(directory / "index.json", "r", encoding="utf-8") as f:
+        saved_config = IndexConfig(**json.load(f)["config"])
+    io_flags = 0
+    if mmap:
+        # IO_FLAG_MMAP maps the inverted lists of IVF indexes; IO_FLAG_MMAP_IFC (not
+        # in older faiss releases) maps the codes of flat and HNSW indexes, but
+        # read_index rejects it for IVF ones
+        io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        if saved_config.kind in ("flat", "hnsw"):
+            io_flags |= getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    started_at = time.perf_counter()
+    index = faiss.read_index(str(directory / "index.faiss"), io_flags)
+    set_search_params(index, config or saved_config)
+    ids = np.load(directory / "ids.npy", mmap_mode="r")
+    logger.info(
+        f"Loaded an index of {index.ntotal} vectors from {directory} "
+        f"in {time.perf_counter() - started_at:.1f}s"
+    )
+    return index, ids
+
+
+def open_or_build_index(
+    store: EmbeddingStore,
+    config: IndexConfig,
+    directory: Union[str, Path],
+    mmap: bool = True,
+) -> Tuple[faiss.Index, np.ndarray]:
+    """
+    Load the index saved in `directory`, building and saving it first if it is
+    missing, or was built from other embeddings or with other build options.
+
+    The embeddings are the same when the manifest of `store` (its options and the
+    size and mtime of each shard) is the one saved with the index.
+    """
+    directory = Path(directory)
+    if (directory / "index.json").exists():
+        with open(directory / "index.json", "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        same_options = _build_options(manifest["config"]) == _build_options(
+            asdict(config)
+        )
+        if same_options and manifest["store"] == store.manifest:
+            return load_index(directory, config, mmap=mmap)
+        logger.info(
+            f"{directory} is out of date with the store or the options, rebuilding"
+        )
+    index = build_index(store, config)
+    save_index(index, directory, config, store)
+    if mmap:
+        # serve the mapped copy, so the memory of the built one is released
+        del index
+        return load_index(directory, config, mmap=True)
+    return index, np.asarray(store.ids)
+
+
+def _build_options(config: dict) -> dict:
+    """An IndexConfig as a dict, without its search-time settings."""
+    return {key: value for key, value in config.items() if key not in SEARCH_PARAMS}
+
+
+def recall_at_k(neighbors: np.ndarray, true_neighbors: np.ndarray) -> float:
+    """Mean fraction of each row of `true_neighbors` found in the same row of `neighbors`."""
+    k = true_neighbors.shape[1]
+    hits = sum(
+        len(np.intersect1d(found[:k], true))
+        for found, true in zip(neighbors, true_neighbors)
+    )
+    return hits / (k * len(true_neighbors))
+
+
+class RerankingSearcher:
+    """
+    Two-stage search: a first stage over reduced-dimension vectors shortlists
+    candidates, which are re-ranked by their full vectors read from `full_store`.
+
+    `first_stage` is a faiss index (or anything with its `search`) over a store of
+    the first `dimensions` dimensions of the rows of `full_store`, renormalized, in
+    the same row order. Queries are full vectors; `search` truncates and
+    renormalizes them for the first stage. Candidates are gathered and scored
+    `rerank_batch_size` queries at a time, which bounds the memory of the gathered
+    (queries, shortlist_size, full dimensions) block.
+    """
+
+    def __init__(
+        self,
+        first_stage,
+        full_store: EmbeddingStore,
+        dimensions: int,
+        shortlist_size: int = 400,
+        metric: str = "ip",
+        rerank_batch_size: int = 64,
+    ):
+        if metric not in METRICS:
+            raise ValueError(
+                f'Unknown metric "{metric}", expected one of {list(METRICS)}'
+            )
+        self.first_stage = first_stage
+        self.full_store = full_store
+        self.dimensions = dimensions
+        self.shortlist_size = shortlist_size
+        self.metric = metric
+        self.rerank_batch_size = rerank_batch_size
+        self.ntotal = len(full_store)
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """The k nearest rows to each (full-dimension) query, like faiss' Index.search."""
+        queries = np.asarray(queries, dtype=np.float32)
+        reduced = np.ascontiguousarray(normalize_rows(queries[:, : self.dimensions]))
+        shortlist_size = max(k, self.shortlist_size)
+        _, candidates = self.first_stage.search(reduced, shortlist_size)
+        k = min(k, candidates.shape[1])
+
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), self.rerank_batch_size):
+            end = start + self.rerank_batch_size
+            batch_candidates = candidates[start:end]
+            valid = batch_candidates >= 0  # faiss pads short result lists with -1
+            vectors = self.full_store.get(np.where(valid, batch_candidates, 0).ravel())
+            vectors = vectors.reshape(*batch_candidates.shape, -1)
+            batch_queries = queries[start:end]
+            scores = np.einsum("qd,qcd->qc", batch_queries, vectors)
+            if self.metric == "l2":
+                # |q - v|^2 = |q|^2 - 2 q.v + |v|^2
+                scores = (
+                    (batch_queries**2).sum(axis=1)[:, None]
+                    - 2 * scores
+                    + np.einsum("qcd,qcd->qc", vectors, vectors)
+                )
+                keys = np.where(valid, scores, np.inf)
+            else:
+                keys = np.where(valid, -scores, np.inf)
+            top = np.argpartition(keys, k - 1, axis=1)[:, :k]
+            top_keys = np.take_along_axis(keys, top, axis=1)
+            top = np.take_along_axis(top, np.argsort(top_keys, axis=1, kind="stable"), axis=1)
+            distances[start:end] = np.take_along_axis(scores, top, axis=1)
+            indices[start:end] = np.where(
+                np.take_along_axis(valid, top, axis=1),
+                np.take_along_axis(batch_candidates, top, axis=1),
+                -1,
+            )
+        return distances, indices
@@ -13,7 +13,18 @@ Features:
 - Makes requests concurrently, to maximize throughput
 - Throttles request and token usage, to stay under rate limits
 - Retries failed requests up to {max_attempts} times, to avoid missing data
+- Backs off exponentially (with jitter) between retries, with separate policies per kind of error
+- Caps the number of requests in flight, to bound memory and open sockets when the API slows down
+- Reports live throughput, latency and what the run is waiting on, as periodic JSON lines or over HTTP
+- Spreads requests over a pool of endpoints (API keys, Azure deployments), each with its own limits
+- Optionally writes embeddings straight into float32 .npy or parquet shards instead of a jsonl file
+- Keeps connections alive in a sized pool, encodes JSON with orjson when installed, and can gzip large requests
+- Optionally parses and sizes requests in worker processes, for request files of tens of millions of lines
 - Logs errors, to diagnose problems with requests
+- Writes results in batches from a background thread, to keep disk I/O off the event loop
+- Resumes interrupted runs, skipping requests that already have a result in the save file
+- Packs single-input embedding requests into multi-input requests, to stretch the request budget
+- Retunes the rate limits from the API's x-ratelimit-* response headers, to run close to the real limits
 
 Example command to call script:
 ```
@@ -33,6 +44,8 @@ Inputs:
     - path to the file containing the requests to be processed
     - file should be a jsonl file, where each line is a json object with API parameters and an optional metadata field
     - e.g., {"model": "text-embedding-3-small", "input": "embed me", "metadata": {"row_id": 1}}
+    - lines may carry a precomputed token count in an optional num_tokens field, which is trusted as is
+      and not sent to the API, e.g. {"model": "text-embedding-3-small", "input": "embed me", "num_tokens": 3}
     - as with all jsonl files, take care that newlines in the content are properly escaped (json.dumps does this automatically)
     - an example file is provided at examples/data/example_requests_to_parallel_process.jsonl
     - the code to generate the example file is appended to the bottom of this script
@@ -41,27 +54,144 @@ Inputs:
     - file will be a jsonl file, where each line is an array with the original request plus the API response
     - e.g., [{"model": "text-embedding-3-small", "input": "embed me"}, {...}]
     - if omitted, results will be saved to {requests_filename}_results.jsonl
+    - with embedding_output set, this is a directory for the embedding shards instead
+      (if omitted, {requests_filename}_embeddings)
 - request_url : str, optional
     - URL of the API endpoint to call
     - if omitted, will default to "https://api.openai.com/v1/embeddings"
 - api_key : str, optional
     - API key to use
     - if omitted, the script will attempt to read it from an environment variable {os.getenv("OPENAI_API_KEY")}
+- endpoints : list, optional
+    - pool of endpoints to spread requests over, e.g. several API keys or Azure deployments
+    - each entry is a dict with request_url, api_key, max_requests_per_minute, max_tokens_per_minute
+      and an optional weight (default 1)
+    - every endpoint gets its own request & token limits; an endpoint that is rate limited or keeps
+      failing is routed around until it recovers
+    - all endpoints must serve the same kind of request (e.g. all embeddings)
+    - if omitted, the pool is the single endpoint given by request_url, api_key and the limits below
+- routing : str, optional
+    - how to pick an endpoint among those with capacity: "least_loaded" (fewest requests in flight
+      per unit of weight) or "weighted" (random, proportional to weight)
+    - if omitted, will default to "least_loaded"
 - max_requests_per_minute : float, optional
     - target number of requests to make per minute (will make less if limited by tokens)
     - leave headroom by setting this to 50% or 75% of your limit
+    - with adapt_to_rate_limit_headers, this is only the starting point until the first response arrives
     - if requests are limiting you, try batching multiple embeddings or completions into one request
     - if omitted, will default to 1,500
 - max_tokens_per_minute : float, optional
     - target number of tokens to use per minute (will use less if limited by requests)
     - leave headroom by setting this to 50% or 75% of your limit
+    - with adapt_to_rate_limit_headers, this is only the starting point until the first response arrives
     - if omitted, will default to 125,000
+- write_durability : str, optional
+    - how hard the result writer pushes results to disk: "none", "flush" or "fsync"
+    - "none" leaves it to the OS, "flush" hands buffered results to the OS, "fsync" also forces them onto disk
+    - if omitted, will default to "flush"
+- write_durability_every : int, optional
+    - number of written results between flushes/fsyncs for the durability policy above
+    - if omitted, will default to 100
+- resume_key : str, optional
+    - name of a metadata field that uniquely identifies each request, e.g. "item_id"
+    - if set, requests whose key already has a successful result in the save file are skipped
+    - if omitted, every request in the file is sent
+- requeue_failed : bool, optional
+    - with resume_key set, also resend requests whose saved result is a failure after all attempts
+    - if omitted, will default to False (failed requests are skipped too)
+- embedding_output : str, optional
+    - for embedding requests, "npy" or "parquet" to skip the jsonl results and write the vectors
+      directly into float32 shards in the save_filepath directory
+    - embeddings are requested with encoding_format="base64" and decoded off the event loop
+    - "npy" writes shard_00000.npy (rows x dimensions) with the ids in shard_00000.ids.npy,
+      "parquet" writes shard_00000.parquet with an id column and a fixed size list `embedding` column
+    - failures after all attempts go to failures.jsonl in the same directory, in the usual results format
+    - if omitted, results are saved to a jsonl file as usual
+- embedding_id_key : str, optional
+    - metadata field whose value is saved as the id of each embedding; with resume_key, both must match
+    - if omitted, will default to "id"
+- embedding_shard_size : int, optional
+    - number of embeddings per shard
+    - if omitted, will default to 100,000
+- adapt_to_rate_limit_headers : bool, optional
+    - if True, the x-ratelimit-limit-*, x-ratelimit-remaining-* and x-ratelimit-reset-* response headers
+      retune the request & token limits as the script runs, and a rate limit error only pauses until the
+      server's retry-after, or until the exhausted limit has refilled enough for one request
+    - if False, the limits stay fixed and a rate limit error pauses all requests for 15 seconds
+    - if omitted, will default to True
+- target_utilization : float, optional
+    - fraction of the limits reported in the response headers to aim for
+    - if omitted, will default to 0.95
+- max_inputs_per_request : int, optional
+    - for embedding requests, number of single-input requests to pack into one request with a list `input`
+    - only consecutive requests with the same parameters (model, dimensions, ...) are packed together
+    - results are still saved one line per original request, with its own metadata
+    - if omitted, will default to 1 (no packing)
+- max_tokens_per_request : int, optional
+    - upper bound on the tokens of one packed embedding request
+    - if omitted, will default to 100,000
 - token_encoding_name : str, optional
     - name of the token encoding used, as defined in the `tiktoken` package
     - if omitted, will default to "cl100k_base" (used by `text-embedding-3-small`)
+- token_counting_workers : int, optional
+    - number of threads that count tokens for requests without a num_tokens field, off the event loop
+    - if omitted, will default to 4
+- ingestion_workers : int, optional
+    - number of worker processes that parse the requests file and count tokens, for files too big for
+      the event loop thread to keep up with; each parses byte-range slices of the file and sends back
+      ready requests
+    - if omitted, will default to 0 (requests are parsed on the event loop thread, tokens counted in threads)
+- ingestion_slice_bytes : int, optional
+    - size of the byte-range slices of the requests file handed to the ingestion workers
+    - if omitted, will default to 4 MiB
+- ingestion_queue_slices : int, optional
+    - maximum number of slices being parsed or waiting to be sent, which bounds the memory used
+    - if omitted, will default to twice ingestion_workers
+- ingestion_order : str, optional
+    - "file" sends requests in the order of the file; "any" sends each slice as soon as it is parsed,
+      so a slow slice does not hold back the others
+    - if omitted, will default to "file"
 - max_attempts : int, optional
     - number of times to retry a failed request before giving up
     - if omitted, will default to 5
+- max_in_flight : int, optional
+    - maximum number of requests waiting for a response at any time; reading the file pauses while it is reached
+    - if omitted, will default to 500
+- max_connections : int, optional
+    - size of the connection pool; requests beyond it wait for a free connection inside aiohttp
+    - if omitted, will default to max_in_flight, so every request in flight has its own connection
+- max_connections_per_host : int, optional
+    - cap on the connections to one host, 0 for no cap
+    - if omitted, will default to 0
+- keepalive_seconds : float, optional
+    - how long an idle connection is kept open for reuse, saving a TCP + TLS handshake per request
+    - if omitted, will default to 30
+- dns_cache_seconds : float, optional
+    - how long resolved host names are cached
+    - if omitted, will default to 300
+- fast_json : bool, optional
+    - if True and orjson is installed, request bodies are encoded and responses decoded with orjson
+    - if omitted, will default to True
+- gzip_request_min_bytes : int, optional
+    - request bodies of at least this many bytes are sent gzip compressed (Content-Encoding: gzip),
+      compressed in a thread off the event loop
+    - only use this with servers that accept compressed request bodies
+    - if omitted, requests are sent uncompressed
+- retry_policies : dict, optional
+    - RetryPolicy per kind of error ("rate_limit", "server", "timeout", "client", "other"): how many
+      attempts errors of that kind may use, and the exponential backoff before each retry
+    - if omitted, will default to default_retry_policies(max_attempts)
+- metrics_interval_seconds : float, optional
+    - how often to report live metrics as one JSON line: requests/s, tokens/s, requests in flight,
+      retry queue depth, status code counts, rate limit errors, latency percentiles (p50/p95/p99),
+      current limits, event loop lag and how long the script waited on each limit
+    - set to 0 to turn reporting off
+    - if omitted, will default to 10
+- metrics_filepath : str, optional
+    - jsonl file to append the metrics lines to
+    - if omitted, metrics lines are logged at INFO level
+- metrics_port : int, optional
+    - if set, the latest metrics are also served as JSON at http://127.0.0.1:{metrics_port}/metrics
 - logging_level : int, optional
     - level of logging to use; higher numbers will log fewer messages
     - 40 = ERROR; will log only when requests fail after all retries
@@ -77,28 +207,69 @@ The script is structured as follows:
         - In main loop:
             - Get next request if one is not already waiting for capacity
             - Update available token & request capacity
-            - If enough capacity available, call API
-            - The loop pauses if a rate limit error is hit
+            - Retries whose backoff has passed go before new requests
+            - If an endpoint has enough capacity and fewer than max_in_flight requests are waiting, call API
             - The loop breaks when no tasks remain
-    - Define dataclasses
+            - Otherwise the loop sleeps until capacity refills, a retry is due or a task finishes
+            - Capacity is paused for a while if a rate limit error is hit
+    - Define dataclasses and classes
         - StatusTracker (stores script metadata counters; only one instance is created)
+        - CapacityBucket (stores available request & token capacity; refills over time, retuned from response headers)
+        - Endpoint (one API URL + key with its own CapacityBucket and health)
+        - HTTPTransport (connection pool, JSON encoding and request compression)
+        - EndpointPool (routes each request to an endpoint with capacity)
+        - ResultWriter (writes results to the save file in batches from a background thread)
+        - EmbeddingShardWriter (decodes embeddings into float32 .npy or parquet shards instead)
+        - EmbeddingPacker (packs single-input embedding requests into multi-input requests)
+        - RequestReader (reads requests from file in batches, counting tokens in a thread pool)
+        - ParallelRequestReader (parses byte-range slices of the file in worker processes instead)
+        - RetryPolicy (how often and after what backoff one kind of error is retried)
+        - RetryQueue (holds failed requests until their backoff has passed)
+        - LatencyHistogram (counts request latencies in log-spaced buckets, for percentiles)
+        - MetricsReporter (reports live metrics periodically and over HTTP)
         - APIRequest (stores API inputs, outputs, metadata; one method to call API)
     - Define functions
         - api_endpoint_from_url (extracts API endpoint from request URL)
-        - append_to_jsonl (writes to results file)
+        - completed_request_keys (collects keys of requests already saved, for resuming)
+        - completed_embedding_keys (the same for a directory of embedding shards)
+        - save_embedding_shard (saves one shard of ids and vectors)
+        - iter_embedding_shards (reads back the ids and vectors of embedding shards)
+        - embedding_shard_names (lists the complete shards of a directory, in order)
+        - seconds_from_duration (parses durations like "6m0s" from rate limit headers)
+        - classify_error (sorts an error into a kind with its own retry policy)
+        - default_retry_policies (retry policies used unless others are given)
         - num_tokens_consumed_from_request (bigger function to infer token usage from request)
+        - cached_encoding (loads each tiktoken encoding once)
         - task_id_generator_function (yields 0, 1, 2, ...)
     - Run main()
 """
 
 # imports
 import aiohttp  # for making API calls concurrently
+from aiohttp import web  # for serving live metrics
 import argparse  # for running script from command line
 import asyncio  # for running API calls concurrently
+import base64  # for decoding base64 embeddings
+import contextlib  # for opening the request reader's resources only when needed
+import functools  # for caching token encodings
+import gzip  # for compressing large request bodies
+import heapq  # for ordering retries by when they are due
+import itertools  # for reading requests in batches
 import json  # for saving results to a jsonl file
 import logging  # for logging rate limit warnings and other messages
+import math  # for latency histogram buckets
+import multiprocessing  # for parsing requests in worker processes
+import numpy as np  # for embedding shards
+from collections import deque  # for holding packed requests until they are sent
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)  # for counting tokens off the event loop
 import os  # for reading API key
+import queue  # for handing results to the writer thread
+import random  # for jittering retry backoff
 import re  # for matching endpoint from request URL
+import threading  # for writing results off the event loop
 import tiktoken  # for counting tokens
 import time  # for sleeping after rate limit is hit
 from dataclasses import (
@@ -106,6 +277,11 @@ from dataclasses import (
     field,
 )  # for storing API inputs, outputs, and metadata
 
+try:
+    import orjson  # for faster JSON encoding and decoding, if installed
+except ImportError:
+    orjson = None
+
 
 async def process_api_requests_from_file(
     requests_filepath: str,
@@ -117,145 +293,302 @@ async def process_api_requests_from_file(
     token_encoding_name: str,
     max_attempts: int,
     logging_level: int,
+    write_durability: str = "flush",
+    write_durability_every: int = 100,
+    resume_key: str = None,
+    requeue_failed: bool = False,
+    max_inputs_per_request: int = 1,
+    max_tokens_per_request: int = 100_000,
+    adapt_to_rate_limit_headers: bool = True,
+    target_utilization: float = 0.95,
+    token_counting_workers: int = 4,
+    max_in_flight: int = 500,
+    retry_policies: dict = None,
+    metrics_interval_seconds: float = 10,
+    metrics_filepath: str = None,
+    metrics_port: int = None,
+    endpoints: list = None,
+    routing: str = "least_loaded",
+    embedding_output: str = None,
+    embedding_id_key: str = "id",
+    embedding_shard_size: int = 100_000,
+    max_connections: int = None,
+    max_connections_per_host: int = 0,
+    keepalive_seconds: float = 30,
+    dns_cache_seconds: float = 300,
+    fast_json: bool = True,
+    gzip_request_min_bytes: int = None,
+    ingestion_workers: int = 0,
+    ingestion_slice_bytes: int = 4 * 1024**2,
+    ingestion_queue_slices: int = None,
+    ingestion_order: str = "file",
 ):
     """Processes API requests in parallel, throttling to stay under rate limits."""
-    # constants
-    seconds_to_pause_after_rate_limit_error = 15
-    seconds_to_sleep_each_loop = (
-        0.001  # 1 ms limits max throughput to 1,000 requests per second
-    )
-
     # initialize logging
     logging.basicConfig(level=logging_level)
     logging.debug(f"Logging initialized at level {logging_level}")
 
-    # infer API endpoint and construct request header
-    api_endpoint = api_endpoint_from_url(request_url)
-    request_header = {"Authorization": f"Bearer {api_key}"}
-    # use api-key header for Azure deployments
-    if "/deployments" in request_url:
-        request_header = {"api-key": f"{api_key}"}
+    # initialize the pool of endpoints, each with its own available capacity counts
+    if endpoints is None:
+        endpoints = [
+            {
+                "request_url": request_url,
+                "api_key": api_key,
+                "max_requests_per_minute": max_requests_per_minute,
+                "max_tokens_per_minute": max_tokens_per_minute,
+            }
+        ]
+    endpoint_pool = EndpointPool(
+        [
+            Endpoint(
+                request_url=endpoint["request_url"],
+                api_key=endpoint["api_key"],
+                capacity=CapacityBucket(
+                    max_requests_per_minute=float(endpoint["max_requests_per_minute"]),
+                    max_tokens_per_minute=float(endpoint["max_tokens_per_minute"]),
+                    adapt_to_headers=adapt_to_rate_limit_headers,
+                    target_utilization=target_utilization,
+                ),
+                weight=float(endpoint.get("weight", 1.0)),
+            )
+            for endpoint in endpoints
+        ],
+        routing=routing,
+    )
+
+    # infer API endpoint
+    api_endpoint = endpoint_pool.api_endpoint
 
     # initialize trackers
-    queue_of_requests_to_retry = asyncio.Queue()
-    task_id_generator = (
-        task_id_generator_function()
-    )  # generates integer IDs of 0, 1, 2, ...
     status_tracker = (
         StatusTracker()
     )  # single instance to track a collection of variables
+    if retry_policies is None:
+        retry_policies = default_retry_policies(max_attempts)
+    queue_of_requests_to_retry = RetryQueue(status_tracker)
+    in_flight_tasks = set()  # keeps running tasks referenced until they finish
     next_request = None  # variable to hold the next request to call
+    ready_requests = deque()  # requests read from file, ready to be called
+    packer = None  # packs embedding requests together, if enabled
+    if api_endpoint == "embeddings" and max_inputs_per_request > 1:
+        packer = EmbeddingPacker(
+            max_inputs_per_request=max_inputs_per_request,
+            max_tokens_per_request=max_tokens_per_request,
+        )
+    wakeup_event = asyncio.Event()  # set by tasks when they finish or queue a retry
+    transport = HTTPTransport(
+        max_connections=max_connections or max_in_flight,
+        max_connections_per_host=max_connections_per_host,
+        keepalive_seconds=keepalive_seconds,
+        dns_cache_seconds=dns_cache_seconds,
+        fast_json=fast_json,
+        gzip_min_bytes=gzip_request_min_bytes,
+    )
 
-    # initialize available capacity counts
-    available_request_capacity = max_requests_per_minute
-    available_token_capacity = max_tokens_per_minute
-    last_update_time = time.time()
+    if embedding_output is not None:
+        if api_endpoint != "embeddings":
+            raise ValueError(
+                f"embedding_output needs an embeddings endpoint, got {api_endpoint}"
+            )
+        if resume_key is not None and resume_key != embedding_id_key:
+            raise ValueError(
+                f'Embedding shards are resumed by their ids, so resume_key "{resume_key}" must be embedding_id_key "{embedding_id_key}"'
+            )
+
+    # collect requests completed by a previous run, so they are not sent again
+    completed_keys = set()
+    if resume_key is not None and os.path.exists(save_filepath):
+        if embedding_output is not None:
+            completed_keys = completed_embedding_keys(
+                save_filepath, embedding_id_key, include_failed=not requeue_failed
+            )
+        else:
+            completed_keys = completed_request_keys(
+                save_filepath, resume_key, include_failed=not requeue_failed
+            )
+        logging.info(
+            f"Resuming: {len(completed_keys)} requests already completed in {save_filepath}"
+        )
+
+    # initialize result writing
+    if embedding_output is not None:
+        result_writer = EmbeddingShardWriter(
+            directory=save_filepath,
+            output_format=embedding_output,
+            id_key=embedding_id_key,
+            shard_size=embedding_shard_size,
+            durability=write_durability,
+            durability_every=write_durability_every,
+        )
+    else:
+        result_writer = ResultWriter(
+            filename=save_filepath,
+            durability=write_durability,
+            durability_every=write_durability_every,
+        )
+
+    # initialize live metrics
+    metrics_reporter = MetricsReporter(
+        status_tracker=status_tracker,
+        endpoint_pool=endpoint_pool,
+        interval_seconds=metrics_interval_seconds,
+        filepath=metrics_filepath,
+        port=metrics_port,
+    )
+    await metrics_reporter.start()
 
-    # initialize flags
-    file_not_finished = True  # after file is empty, we'll skip reading it
     logging.debug("Initialization complete.")
 
     # initialize file reading
-    with open(requests_filepath) as file:
-        # `requests` will provide requests one at a time
-        requests = file.__iter__()
-        logging.debug("File opened. Entering main loop")
-        async with aiohttp.ClientSession() as session:  # Initialize ClientSession here
-            while True:
-                # get next request (if one is not already waiting for capacity)
-                if next_request is None:
-                    if not queue_of_requests_to_retry.empty():
-                        next_request = queue_of_requests_to_retry.get_nowait()
-                        logging.debug(
-                            f"Retrying request {next_request.task_id}: {next_request}"
-                        )
-                    elif file_not_finished:
-                        try:
-                            # get new request
-                            request_json = json.loads(next(requests))
-                            next_request = APIRequest(
-                                task_id=next(task_id_generator),
-                                request_json=request_json,
-                                token_consumption=num_tokens_consumed_from_request(
-                                    request_json, api_endpoint, token_encoding_name
-                                ),
-                                attempts_left=max_attempts,
-                                metadata=request_json.pop("metadata", None),
-                            )
-                            status_tracker.num_tasks_started += 1
-                            status_tracker.num_tasks_in_progress += 1
+    request_defaults = (
+        {"encoding_format": "base64"} if embedding_output is not None else None
+    )
+    # the file and token counting threads are only needed to read on the event loop
+    with contextlib.ExitStack() as reader_resources:
+        # `requests` will provide requests a batch at a time
+        if ingestion_workers > 0:
+            requests = ParallelRequestReader(
+                requests_filepath=requests_filepath,
+                api_endpoint=api_endpoint,
+                token_encoding_name=token_encoding_name,
+                max_attempts=max_attempts,
+                status_tracker=status_tracker,
+                num_workers=ingestion_workers,
+                slice_bytes=ingestion_slice_bytes,
+                max_pending_slices=ingestion_queue_slices or 2 * ingestion_workers,
+                order=ingestion_order,
+                completed_keys=completed_keys,
+                resume_key=resume_key,
+                request_defaults=request_defaults,
+            )
+        else:
+            file = reader_resources.enter_context(open(requests_filepath))
+            token_counter = reader_resources.enter_context(
+                ThreadPoolExecutor(
+                    max_workers=token_counting_workers,
+                    thread_name_prefix="token-counter",
+                )
+            )
+            requests = RequestReader(
+                file=file,
+                api_endpoint=api_endpoint,
+                token_encoding_name=token_encoding_name,
+                max_attempts=max_attempts,
+                token_counter=token_counter,
+                token_counting_workers=token_counting_workers,
+                completed_keys=completed_keys,
+                resume_key=resume_key,
+                status_tracker=status_tracker,
+                request_defaults=request_defaults,
+            )
+        logging.debug("Reader ready. Entering main loop")
+        try:
+            async with transport.create_session() as session:
+                while True:
+                    # get next request (if one is not already waiting for capacity)
+                    if next_request is None:
+                        if queue_of_requests_to_retry.has_due_request():
+                            next_request = queue_of_requests_to_retry.pop_due_request()
                             logging.debug(
-                                f"Reading request {next_request.task_id}: {next_request}"
+                                f"Retrying request {next_request.task_id}: {next_request}"
                             )
-                        except StopIteration:
-                            # if file runs out, set flag to stop reading it
-                            logging.debug("Read file exhausted")
-                            file_not_finished = False
-
-                # update available capacity
-                current_time = time.time()
-                seconds_since_update = current_time - last_update_time
-                available_request_capacity = min(
-                    available_request_capacity
-                    + max_requests_per_minute * seconds_since_update / 60.0,
-                    max_requests_per_minute,
-                )
-                available_token_capacity = min(
-                    available_token_capacity
-                    + max_tokens_per_minute * seconds_since_update / 60.0,
-                    max_tokens_per_minute,
-                )
-                last_update_time = current_time
-
-                # if enough capacity available, call API
-                if next_request:
-                    next_request_tokens = next_request.token_consumption
-                    if (
-                        available_request_capacity >= 1
-                        and available_token_capacity >= next_request_tokens
-                    ):
-                        # update counters
-                        available_request_capacity -= 1
-                        available_token_capacity -= next_request_tokens
-                        next_request.attempts_left -= 1
-
-                        # call API
-                        asyncio.create_task(
-                            next_request.call_api(
-                                session=session,
-                                request_url=request_url,
-                                request_header=request_header,
-                                retry_queue=queue_of_requests_to_retry,
-                                save_filepath=save_filepath,
-                                status_tracker=status_tracker,
+                        else:
+                            # read until a request (or pack of requests) is ready
+                            while not ready_requests and not requests.finished:
+                                for request in await requests.read_batch():
+                                    status_tracker.num_tasks_started += 1
+                                    status_tracker.num_tasks_in_progress += 1
+                                    ready_requests.extend(
+                                        packer.add(request) if packer else [request]
+                                    )
+                                if requests.finished and packer:
+                                    ready_requests.extend(packer.flush())
+                            if ready_requests:
+                                next_request = ready_requests.popleft()
+
+                    # update available capacity
+                    endpoint_pool.refill()
+
+                    # if an endpoint has enough capacity and the in-flight window has room, call API
+                    in_flight_window_full = (
+                        status_tracker.num_requests_in_flight >= max_in_flight
+                    )
+                    if next_request and not in_flight_window_full:
+                        next_request_tokens = next_request.token_consumption
+                        endpoint = endpoint_pool.choose(next_request_tokens)
+                        if endpoint is not None:
+                            # update counters
+                            endpoint.capacity.consume(next_request_tokens)
+                            endpoint.num_requests_in_flight += 1
+                            next_request.use_attempt()
+                            status_tracker.num_requests_in_flight += 1
+                            status_tracker.num_tokens_sent += next_request_tokens
+
+                            # call API
+                            task = asyncio.create_task(
+                                next_request.call_api(
+                                    session=session,
+                                    transport=transport,
+                                    endpoint=endpoint,
+                                    retry_queue=queue_of_requests_to_retry,
+                                    retry_policies=retry_policies,
+                                    result_writer=result_writer,
+                                    status_tracker=status_tracker,
+                                    wakeup_event=wakeup_event,
+                                )
                             )
-                        )
-                        next_request = None  # reset next_request to empty
+                            in_flight_tasks.add(task)
+                            task.add_done_callback(in_flight_tasks.discard)
+                            next_request = None  # reset next_request to empty
 
-                # if all tasks are finished, break
-                if status_tracker.num_tasks_in_progress == 0:
-                    break
+                            # yield once so the new task can start, then go straight
+                            # back for the next request while capacity lasts
+                            await asyncio.sleep(0)
+                            continue
 
-                # main loop sleeps briefly so concurrent tasks can run
-                await asyncio.sleep(seconds_to_sleep_each_loop)
+                    # stop if results can no longer be saved
+                    result_writer.raise_if_failed()
 
-                # if a rate limit error was hit recently, pause to cool down
-                seconds_since_rate_limit_error = (
-                    time.time() - status_tracker.time_of_last_rate_limit_error
-                )
-                if (
-                    seconds_since_rate_limit_error
-                    < seconds_to_pause_after_rate_limit_error
-                ):
-                    remaining_seconds_to_pause = (
-                        seconds_to_pause_after_rate_limit_error
-                        - seconds_since_rate_limit_error
-                    )
-                    await asyncio.sleep(remaining_seconds_to_pause)
-                    # ^e.g., if pause is 15 seconds and final limit was hit 5 seconds ago
-                    logging.warn(
-                        f"Pausing to cool down until {time.ctime(status_tracker.time_of_last_rate_limit_error + seconds_to_pause_after_rate_limit_error)}"
+                    # if all tasks are finished, break
+                    if status_tracker.num_tasks_in_progress == 0:
+                        break
+
+                    # sleep until some endpoint can cover the waiting request or the
+                    # next retry is due, or until a task finishes or queues a retry;
+                    # with a full in-flight window only a finishing task makes room
+                    if in_flight_window_full:
+                        seconds_to_wait = None
+                        waiting_for = "in_flight_window"
+                    elif next_request:
+                        seconds_to_wait = endpoint_pool.seconds_until_capacity_for(
+                            next_request.token_consumption
+                        )
+                        waiting_for = endpoint_pool.limiting_factor(
+                            next_request.token_consumption
+                        )
+                    else:
+                        seconds_to_wait = (
+                            queue_of_requests_to_retry.seconds_until_next_due()
+                        )
+                        waiting_for = (
+                            "responses" if seconds_to_wait is None else "retry_backoff"
+                        )
+                    wakeup_event.clear()
+                    started_waiting = time.monotonic()
+                    try:
+                        await asyncio.wait_for(wakeup_event.wait(), timeout=seconds_to_wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    status_tracker.seconds_waiting_for[waiting_for] = (
+                        status_tracker.seconds_waiting_for.get(waiting_for, 0)
+                        + time.monotonic()
+                        - started_waiting
                     )
+        finally:
+            # drain and close the result writer without blocking the event loop
+            await asyncio.to_thread(result_writer.close)
+            await metrics_reporter.stop()
+            requests.close()
 
         # after finishing, log final status
         logging.info(
@@ -265,6 +598,14 @@ async def process_api_requests_from_file(
             logging.warning(
                 f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed. Errors logged to {save_filepath}."
             )
+        if status_tracker.num_tasks_skipped > 0:
+            logging.info(
+                f"{status_tracker.num_tasks_skipped} requests skipped, already completed in {save_filepath}."
+            )
+        if status_tracker.num_retries > 0:
+            logging.info(
+                f"{status_tracker.num_retries} retries: {status_tracker.num_server_errors} server errors, {status_tracker.num_timeout_errors} timeouts, {status_tracker.num_client_errors} client errors."
+            )
         if status_tracker.num_rate_limit_errors > 0:
             logging.warning(
                 f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
@@ -282,10 +623,294 @@ class StatusTracker:
     num_tasks_in_progress: int = 0  # script ends when this reaches 0
     num_tasks_succeeded: int = 0
     num_tasks_failed: int = 0
+    num_tasks_skipped: int = 0  # already completed by a previous run
     num_rate_limit_errors: int = 0
     num_api_errors: int = 0  # excluding rate limit errors, counted above
     num_other_errors: int = 0
-    time_of_last_rate_limit_error: int = 0  # used to cool off after hitting rate limits
+    num_server_errors: int = 0  # 5xx responses, also counted above
+    num_client_errors: int = 0  # 4xx responses other than rate limits, also counted above
+    num_timeout_errors: int = 0  # also counted above
+    num_retries: int = 0
+    num_requests_in_flight: int = 0  # API calls waiting for a response
+    num_requests_waiting_to_retry: int = 0  # failed requests waiting out their backoff
+    num_tokens_sent: int = 0  # including retries
+    status_code_counts: dict = field(default_factory=dict)  # exceptions by class name
+    request_latency: "LatencyHistogram" = field(
+        default_factory=lambda: LatencyHistogram()
+    )
+    seconds_waiting_for: dict = field(default_factory=dict)  # main loop sleep, by reason
+
+    def record_response(self, status, latency_seconds: float) -> None:
+        status = str(status)
+        self.status_code_counts[status] = self.status_code_counts.get(status, 0) + 1
+        self.request_latency.add(latency_seconds)
+
+
+@dataclass
+class CapacityBucket:
+    """Tracks request and token capacity, refilling continuously up to the per-minute limits.
+
+    With `adapt_to_headers`, every response's x-ratelimit-* headers retune the limits
+    to `target_utilization` of what the API reports, cap the available capacity at
+    what the API says remains, and a rate limit error pauses the bucket only until
+    the API's retry-after, or until the exhausted limit has refilled enough for one
+    request.
+    """
+
+    max_requests_per_minute: float
+    max_tokens_per_minute: float
+    available_request_capacity: float = None  # starts full
+    available_token_capacity: float = None  # starts full
+    last_update_time: float = field(default_factory=time.time)
+    adapt_to_headers: bool = False
+    target_utilization: float = 0.95
+    paused_until: float = 0  # no requests are sent before this time
+    seconds_to_pause_after_rate_limit_error: float = 15  # when not adapting to headers
+
+    def __post_init__(self):
+        if self.available_request_capacity is None:
+            self.available_request_capacity = self.max_requests_per_minute
+        if self.available_token_capacity is None:
+            self.available_token_capacity = self.max_tokens_per_minute
+
+    def refill(self) -> None:
+        """Add the capacity that accrued since the last update, capped at one minute's worth."""
+        current_time = time.time()
+        seconds_since_update = current_time - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity
+            + self.max_requests_per_minute * seconds_since_update / 60.0,
+            self.max_requests_per_minute,
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity
+            + self.max_tokens_per_minute * seconds_since_update / 60.0,
+            self.max_tokens_per_minute,
+        )
+        self.last_update_time = current_time
+
+    def has_capacity_for(self, num_tokens: int) -> bool:
+        return (
+            self.available_request_capacity >= 1
+            and self.available_token_capacity >= num_tokens
+            and time.time() >= self.paused_until
+        )
+
+    def consume(self, num_tokens: int) -> None:
+        self.available_request_capacity -= 1
+        self.available_token_capacity -= num_tokens
+
+    def seconds_until_capacity_for(self, num_tokens: int) -> float:
+        """Seconds until both buckets refill enough to cover one request of `num_tokens` tokens."""
+        request_deficit = 1 - self.available_request_capacity
+        token_deficit = num_tokens - self.available_token_capacity
+        return max(
+            0.0,
+            self.paused_until - time.time(),
+            request_deficit * 60.0 / self.max_requests_per_minute,
+            token_deficit * 60.0 / self.max_tokens_per_minute,
+        )
+
+    def limiting_factor(self, num_tokens: int) -> str:
+        """Which of "rate_limit_pause", "requests" or "tokens" holds back a request of `num_tokens` tokens."""
+        waits = {
+            "rate_limit_pause": self.paused_until - time.time(),
+            "requests": (1 - self.available_request_capacity)
+            * 60.0
+            / self.max_requests_per_minute,
+            "tokens": (num_tokens - self.available_token_capacity)
+            * 60.0
+            / self.max_tokens_per_minute,
+        }
+        return max(waits, key=waits.get)
+
+    def update_from_headers(self, headers) -> None:
+        """Retune the limits and available capacity from a response's x-ratelimit-* headers."""
+        if not self.adapt_to_headers:
+            return
+        self.refill()
+        limit_requests = _float_header(headers, "x-ratelimit-limit-requests")
+        limit_tokens = _float_header(headers, "x-ratelimit-limit-tokens")
+        remaining_requests = _float_header(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _float_header(headers, "x-ratelimit-remaining-tokens")
+        if limit_requests:
+            self.max_requests_per_minute = limit_requests * self.target_utilization
+        if limit_tokens:
+            self.max_tokens_per_minute = limit_tokens * self.target_utilization
+        # the API's count already includes requests we sent before this one, so
+        # never assume more is left than the API says
+        if remaining_requests is not None:
+            self.available_request_capacity = min(
+                self.available_request_capacity, remaining_requests
+            )
+        if remaining_tokens is not None:
+            self.available_token_capacity = min(
+                self.available_token_capacity, remaining_tokens
+            )
+
+    def pause_after_rate_limit_error(self, headers, num_tokens: int = 1) -> float:
+        """Stop sending requests until one of `num_tokens` tokens fits; returns the pause in seconds."""
+        seconds_to_pause = self.seconds_to_pause_after_rate_limit_error
+        if self.adapt_to_headers:
+            seconds_to_pause = _seconds_until_capacity_refills(headers, num_tokens)
+            if seconds_to_pause is None:
+                seconds_to_pause = 1.0  # headers gave no hint; back off briefly
+        self.paused_until = max(self.paused_until, time.time() + seconds_to_pause)
+        return seconds_to_pause
+
+
+@dataclass
+class Endpoint:
+    """One API endpoint (URL + key) with its own rate limits and health.
+
+    After `failures_before_down` server errors, timeouts or connection errors in a
+    row, the endpoint is treated as down and gets no requests for
+    `seconds_down` seconds.
+    """
+
+    request_url: str
+    api_key: str
+    capacity: CapacityBucket
+    weight: float = 1.0
+    num_requests_in_flight: int = 0
+    consecutive_failures: int = 0
+    failures_before_down: int = 5
+    seconds_down: float = 30
+    request_header: dict = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.request_header = {"Authorization": f"Bearer {self.api_key}"}
+        # use api-key header for Azure deployments
+        if "/deployments" in self.request_url:
+            self.request_header = {"api-key": f"{self.api_key}"}
+
+    def record_outcome(self, error_kind: str) -> None:
+        """Track consecutive failures; rate limits and bad requests say nothing about health."""
+        if error_kind is None:
+            self.consecutive_failures = 0
+        elif error_kind in ("server", "timeout", "other"):
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failures_before_down:
+                logging.warning(
+                    f"{self.request_url} failed {self.consecutive_failures} times in a row, routing around it for {self.seconds_down}s"
+                )
+                self.capacity.paused_until = max(
+                    self.capacity.paused_until, time.time() + self.seconds_down
+                )
+                self.consecutive_failures = 0
+
+
+class EndpointPool:
+    """Routes each request to one of several endpoints that has capacity for it."""
+
+    routings = ("least_loaded", "weighted")
+
+    def __init__(self, endpoints: list, routing: str = "least_loaded"):
+        if not endpoints:
+            raise ValueError("At least one endpoint is needed")
+        if routing not in self.routings:
+            raise ValueError(
+                f'Unknown routing "{routing}", expected one of {self.routings}'
+            )
+        api_endpoints = {
+            api_endpoint_from_url(endpoint.request_url) for endpoint in endpoints
+        }
+        if len(api_endpoints) > 1:
+            raise ValueError(
+                f"All endpoints must serve the same API endpoint, got {sorted(api_endpoints)}"
+            )
+        self.endpoints = endpoints
+        self.routing = routing
+        self.api_endpoint = api_endpoints.pop()
+
+    def refill(self) -> None:
+        for endpoint in self.endpoints:
+            endpoint.capacity.refill()
+
+    def choose(self, num_tokens: int):
+        """Pick an endpoint with capacity for a request of `num_tokens` tokens, or None if there is none."""
+        candidates = [
+            endpoint
+            for endpoint in self.endpoints
+            if endpoint.capacity.has_capacity_for(num_tokens)
+        ]
+        if not candidates:
+            return None
+        if self.routing == "weighted":
+            return random.choices(
+                candidates, weights=[endpoint.weight for endpoint in candidates]
+            )[0]
+        return min(
+            candidates,
+            key=lambda endpoint: (
+                endpoint.num_requests_in_flight / endpoint.weight,
+                -endpoint.capacity.available_request_capacity
+                / endpoint.capacity.max_requests_per_minute,
+            ),
+        )
+
+    def _soonest(self, num_tokens: int) -> Endpoint:
+        return min(
+            self.endpoints,
+            key=lambda endpoint: endpoint.capacity.seconds_until_capacity_for(
+                num_tokens
+            ),
+        )
+
+    def seconds_until_capacity_for(self, num_tokens: int) -> float:
+        """Seconds until the first endpoint can cover a request of `num_tokens` tokens."""
+        return self._soonest(num_tokens).capacity.seconds_until_capacity_for(
+            num_tokens
+        )
+
+    def limiting_factor(self, num_tokens: int) -> str:
+        return self._soonest(num_tokens).capacity.limiting_factor(num_tokens)
+
+
+@dataclass
+class HTTPTransport:
+    """How requests go over the wire: connection pooling, JSON library and request compression."""
+
+    max_connections: int = 500
+    max_connections_per_host: int = 0
+    keepalive_seconds: float = 30
+    dns_cache_seconds: float = 300
+    fast_json: bool = True
+    gzip_min_bytes: int = None
+    gzip_level: int = 1  # compressing fast matters more than compressing small
+
+    def __post_init__(self):
+        if self.fast_json and orjson is None:
+            logging.info("orjson is not installed, using the json module")
+        self.use_orjson = self.fast_json and orjson is not None
+
+    def create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections,
+            limit_per_host=self.max_connections_per_host,
+            keepalive_timeout=self.keepalive_seconds,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_seconds,
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    async def encode_request(self, request_json: dict, header: dict):
+        """Return the body bytes of a request and the headers to send with it."""
+        if self.use_orjson:
+            body = orjson.dumps(request_json)
+        else:
+            body = json.dumps(request_json).encode("utf-8")
+        headers = {**header, "Content-Type": "application/json"}
+        if self.gzip_min_bytes is not None and len(body) >= self.gzip_min_bytes:
+            # zlib releases the GIL, so large bodies compress in parallel with the loop
+            body = await asyncio.to_thread(gzip.compress, body, self.gzip_level)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+    def decode_response(self, body: bytes):
+        if self.use_orjson:
+            return orjson.loads(body)
+        return json.loads(body)
 
 
 @dataclass
@@ -298,36 +923,102 @@ class APIRequest:
     attempts_left: int
     metadata: dict
     result: list = field(default_factory=list)
+    members: list = None  # for packed embedding requests, the single-input requests packed together
+    error_counts: dict = field(default_factory=dict)  # errors so far, by kind of error
+
+    @staticmethod
+    def pack(members: list) -> "APIRequest":
+        """Pack single-input embedding requests with the same parameters into one request."""
+        if len(members) == 1:
+            return members[0]
+        request_json = {
+            **members[0].request_json,
+            "input": [member.request_json["input"] for member in members],
+        }
+        return APIRequest(
+            task_id=members[0].task_id,
+            request_json=request_json,
+            token_consumption=sum(member.token_consumption for member in members),
+            attempts_left=min(member.attempts_left for member in members),
+            metadata=None,
+            members=members,
+        )
+
+    def use_attempt(self) -> None:
+        self.attempts_left -= 1
+        for member in self.members or []:
+            member.attempts_left -= 1
 
     async def call_api(
         self,
         session: aiohttp.ClientSession,
-        request_url: str,
-        request_header: dict,
-        retry_queue: asyncio.Queue,
-        save_filepath: str,
+        transport: "HTTPTransport",
+        endpoint: "Endpoint",
+        retry_queue: "RetryQueue",
+        retry_policies: dict,
+        result_writer: "ResultWriter",
         status_tracker: StatusTracker,
+        wakeup_event: asyncio.Event,
     ):
         """Calls the OpenAI API and saves results."""
+        try:
+            await self._call_api(
+                session=session,
+                transport=transport,
+                endpoint=endpoint,
+                retry_queue=retry_queue,
+                retry_policies=retry_policies,
+                result_writer=result_writer,
+                status_tracker=status_tracker,
+            )
+        finally:
+            # let the main loop know a task finished or a retry was queued
+            status_tracker.num_requests_in_flight -= 1
+            endpoint.num_requests_in_flight -= 1
+            wakeup_event.set()
+
+    async def _call_api(
+        self,
+        session: aiohttp.ClientSession,
+        transport: "HTTPTransport",
+        endpoint: "Endpoint",
+        retry_queue: "RetryQueue",
+        retry_policies: dict,
+        result_writer: "ResultWriter",
+        status_tracker: StatusTracker,
+    ):
         logging.info(f"Starting request #{self.task_id}")
         error = None
+        status = None
+        started_at = time.monotonic()
         try:
+            body, headers = await transport.encode_request(
+                self.request_json, endpoint.request_header
+            )
             async with session.post(
-                url=request_url, headers=request_header, json=self.request_json
+                url=endpoint.request_url, headers=headers, data=body
             ) as response:
-                response = await response.json()
+                status = response.status
+                response_headers = response.headers
+                response = transport.decode_response(await response.read())
+            endpoint.capacity.update_from_headers(response_headers)
             if "error" in response:
                 logging.warning(
                     f"Request {self.task_id} failed with error {response['error']}"
                 )
                 status_tracker.num_api_errors += 1
                 error = response
-                if "rate limit" in response["error"].get("message", "").lower():
-                    status_tracker.time_of_last_rate_limit_error = time.time()
+                if classify_error(status, error) == "rate_limit":
                     status_tracker.num_rate_limit_errors += 1
                     status_tracker.num_api_errors -= (
                         1  # rate limit errors are counted separately
                     )
+                    seconds_to_pause = endpoint.capacity.pause_after_rate_limit_error(
+                        response_headers, self.token_consumption
+                    )
+                    logging.warning(
+                        f"Pausing {endpoint.request_url} to cool down until {time.ctime(endpoint.capacity.paused_until)} ({seconds_to_pause:.2f}s)"
+                    )
 
         except (
             Exception
@@ -335,32 +1026,906 @@ class APIRequest:
             logging.warning(f"Request {self.task_id} failed with Exception {e}")
             status_tracker.num_other_errors += 1
             error = e
+        status_tracker.record_response(
+            status if status is not None else type(error).__name__,
+            time.monotonic() - started_at,
+        )
+        error_kind = None
         if error:
+            error_kind = classify_error(status, error)
+            if error_kind == "server":
+                status_tracker.num_server_errors += 1
+            elif error_kind == "client":
+                status_tracker.num_client_errors += 1
+            elif error_kind == "timeout":
+                status_tracker.num_timeout_errors += 1
+        endpoint.record_outcome(error_kind)
+        if self.members:
+            self._save_packed_results(
+                response if error is None else None,
+                error,
+                error_kind,
+                retry_queue,
+                retry_policies,
+                result_writer,
+                status_tracker,
+            )
+        elif error:
             self.result.append(error)
-            if self.attempts_left:
-                retry_queue.put_nowait(self)
+            seconds_to_wait = self._record_error(error_kind, retry_policies)
+            if seconds_to_wait is not None:
+                retry_queue.put(self, seconds_to_wait)
             else:
-                logging.error(
-                    f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}"
-                )
-                data = (
-                    [self.request_json, [str(e) for e in self.result], self.metadata]
-                    if self.metadata
-                    else [self.request_json, [str(e) for e in self.result]]
-                )
-                append_to_jsonl(data, save_filepath)
-                status_tracker.num_tasks_in_progress -= 1
-                status_tracker.num_tasks_failed += 1
+                self._save_failure(result_writer, status_tracker)
         else:
             data = (
                 [self.request_json, response, self.metadata]
                 if self.metadata
                 else [self.request_json, response]
             )
-            append_to_jsonl(data, save_filepath)
+            result_writer.write(data)
             status_tracker.num_tasks_in_progress -= 1
             status_tracker.num_tasks_succeeded += 1
-            logging.debug(f"Request {self.task_id} saved to {save_filepath}")
+            logging.debug(
+                f"Request {self.task_id} queued for saving to {result_writer.filename}"
+            )
+
+    def _save_packed_results(
+        self,
+        response: dict,
+        error,
+        error_kind: str,
+        retry_queue: "RetryQueue",
+        retry_policies: dict,
+        result_writer: "ResultWriter",
+        status_tracker: StatusTracker,
+    ):
+        """Split a packed response into one saved result per member; retry only the members that failed."""
+        failed_members = self.members
+        if error is None:
+            data_by_index = {item["index"]: item for item in response.get("data", [])}
+            failed_members = []
+            for i, member in enumerate(self.members):
+                if i not in data_by_index:
+                    failed_members.append(member)
+                    continue
+                member_response = {
+                    **{k: v for k, v in response.items() if k not in ("data", "usage")},
+                    "data": [{**data_by_index[i], "index": 0}],
+                    "usage": {
+                        "prompt_tokens": member.token_consumption,
+                        "total_tokens": member.token_consumption,
+                    },
+                }
+                data = (
+                    [member.request_json, member_response, member.metadata]
+                    if member.metadata
+                    else [member.request_json, member_response]
+                )
+                result_writer.write(data)
+                status_tracker.num_tasks_in_progress -= 1
+                status_tracker.num_tasks_succeeded += 1
+            if failed_members:
+                error = f"Response is missing {len(failed_members)} of {len(self.members)} packed inputs"
+                error_kind = "other"
+                logging.warning(f"Request {self.task_id}: {error}")
+
+        if response is None and error_kind == "client" and len(failed_members) > 1:
+            # the API rejected the whole pack and any one input may be the cause:
+            # split it in half without charging the attempt, so a bad input only
+            # holds back the half it is in and the others are not failed along with
+            # it. Server errors, timeouts and the like are not caused by the inputs,
+            # so they are retried whole with backoff below
+            for member in failed_members:
+                member.result.append(error)
+                member.attempts_left += 1
+            middle = len(failed_members) // 2
+            retry_queue.put(APIRequest.pack(failed_members[:middle]), 0)
+            retry_queue.put(APIRequest.pack(failed_members[middle:]), 0)
+            return
+
+        retry_members = []
+        seconds_to_wait = 0
+        for member in failed_members:
+            member.result.append(error)
+            member_seconds_to_wait = member._record_error(error_kind, retry_policies)
+            if member_seconds_to_wait is not None:
+                retry_members.append(member)
+                seconds_to_wait = max(seconds_to_wait, member_seconds_to_wait)
+            else:
+                member._save_failure(result_writer, status_tracker)
+        if retry_members:
+            retry_queue.put(APIRequest.pack(retry_members), seconds_to_wait)
+
+    def _record_error(self, error_kind: str, retry_policies: dict):
+        """Count an error; returns the backoff before the retry, or None if it should not be retried."""
+        self.error_counts[error_kind] = self.error_counts.get(error_kind, 0) + 1
+        policy = retry_policies[error_kind]
+        if not self.attempts_left or self.error_counts[error_kind] >= policy.max_attempts:
+            return None
+        return policy.backoff_seconds(self.error_counts[error_kind])
+
+    def _save_failure(
+        self, result_writer: "ResultWriter", status_tracker: StatusTracker
+    ):
+        logging.error(
+            f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}"
+        )
+        data = (
+            [self.request_json, [str(e) for e in self.result], self.metadata]
+            if self.metadata
+            else [self.request_json, [str(e) for e in self.result]]
+        )
+        result_writer.write(data)
+        status_tracker.num_tasks_in_progress -= 1
+        status_tracker.num_tasks_failed += 1
+
+
+@dataclass
+class RetryPolicy:
+    """How many attempts one kind of error may use, and the backoff before each retry.
+
+    The backoff before the n-th retry is drawn uniformly from
+    [0, min(max_backoff_seconds, base_backoff_seconds * 2 ** (n - 1))] ("full jitter"),
+    so retries of requests that failed together spread out instead of hitting the
+    API again at the same moment.
+    """
+
+    max_attempts: int
+    base_backoff_seconds: float = 1.0
+    max_backoff_seconds: float = 60.0
+
+    def backoff_seconds(self, num_errors: int) -> float:
+        ceiling = min(
+            self.max_backoff_seconds, self.base_backoff_seconds * 2 ** (num_errors - 1)
+        )
+        return random.uniform(0, ceiling)
+
+
+class RetryQueue:
+    """Holds failed requests until their backoff has passed, ordered by when they are due."""
+
+    def __init__(self, status_tracker: StatusTracker):
+        self.status_tracker = status_tracker
+        self._heap = []  # (due time, sequence number, request)
+        self._sequence = itertools.count()  # keeps equal due times in FIFO order
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def put(self, request: "APIRequest", seconds_to_wait: float) -> None:
+        heapq.heappush(
+            self._heap, (time.time() + seconds_to_wait, next(self._sequence), request)
+        )
+        self.status_tracker.num_retries += 1
+        self.status_tracker.num_requests_waiting_to_retry = len(self._heap)
+
+    def has_due_request(self) -> bool:
+        return bool(self._heap) and self._heap[0][0] <= time.time()
+
+    def pop_due_request(self) -> "APIRequest":
+        _, _, request = heapq.heappop(self._heap)
+        self.status_tracker.num_requests_waiting_to_retry = len(self._heap)
+        return request
+
+    def seconds_until_next_due(self):
+        """Seconds until the next retry is due, or None if there is nothing to retry."""
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.time())
+
+
+@dataclass
+class LatencyHistogram:
+    """Counts latencies in log-spaced buckets, so percentiles cost O(buckets) memory and time.
+
+    Buckets grow by `growth` from `min_seconds`, so a reported percentile is within
+    a factor of `growth` of the true value.
+    """
+
+    min_seconds: float = 0.001
+    growth: float = 1.1
+    num_buckets: int = 150  # 1 ms * 1.1 ** 150 is about 10 minutes
+    counts: list = None
+    count: int = 0
+    total_seconds: float = 0.0
+
+    def __post_init__(self):
+        if self.counts is None:
+            self.counts = [0] * (self.num_buckets + 1)
+
+    def add(self, seconds: float) -> None:
+        if seconds <= self.min_seconds:
+            bucket = 0
+        else:
+            bucket = min(
+                self.num_buckets,
+                1 + int(math.log(seconds / self.min_seconds, self.growth)),
+            )
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total_seconds += seconds
+
+    def percentile(self, q: float):
+        """Upper edge of the bucket holding the q-th percentile (0 < q <= 100), or None if empty."""
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * q / 100.0)
+        seen = 0
+        for bucket, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.min_seconds * self.growth**bucket
+        return self.min_seconds * self.growth**self.num_buckets
+
+
+class MetricsReporter:
+    """Reports live metrics of a run as one JSON line every `interval_seconds`.
+
+    Lines go to `filepath` (jsonl) or the log, and with `port` the latest line is
+    also served at http://127.0.0.1:{port}/metrics. Rates cover the last interval;
+    counts, latency percentiles and waiting times cover the whole run.
+    `event_loop_lag_seconds` is how late the reporter woke up: when it grows, the
+    event loop, not the API, is the bottleneck.
+    """
+
+    def __init__(
+        self,
+        status_tracker: StatusTracker,
+        endpoint_pool: EndpointPool,
+        interval_seconds: float = 10,
+        filepath: str = None,
+        port: int = None,
+    ):
+        self.status_tracker = status_tracker
+        self.endpoint_pool = endpoint_pool
+        self.interval_seconds = interval_seconds
+        self.filepath = filepath
+        self.port = port
+        self.latest = {}
+        self._started_at = time.monotonic()
+        self._last_report_at = self._started_at
+        self._last_counts = (0, 0, 0)
+        self._task = None
+        self._runner = None
+
+    async def start(self) -> None:
+        if self.port is not None:
+            app = web.Application()
+            app.router.add_get("/metrics", self._serve_metrics)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+            logging.info(f"Serving metrics at http://127.0.0.1:{self.port}/metrics")
+        if self.interval_seconds:
+            self._task = asyncio.create_task(self._report_periodically())
+
+    async def stop(self) -> None:
+        """Stop reporting, after one last report covering the end of the run."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._report(event_loop_lag_seconds=0.0)
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _report_periodically(self) -> None:
+        while True:
+            due = time.monotonic() + self.interval_seconds
+            await asyncio.sleep(self.interval_seconds)
+            self._report(event_loop_lag_seconds=max(0.0, time.monotonic() - due))
+
+    async def _serve_metrics(self, request: web.Request) -> web.Response:
+        return web.json_response(self.latest or self.snapshot(0.0))
+
+    def _report(self, event_loop_lag_seconds: float) -> None:
+        self.latest = self.snapshot(event_loop_lag_seconds)
+        line = json.dumps(self.latest)
+        if self.filepath:
+            with open(self.filepath, "a") as f:
+                f.write(line + "\n")
+        else:
+            logging.info(f"Metrics: {line}")
+
+    def snapshot(self, event_loop_lag_seconds: float) -> dict:
+        tracker = self.status_tracker
+        now = time.monotonic()
+        seconds_since_last_report = max(now - self._last_report_at, 1e-9)
+        counts = (
+            tracker.request_latency.count,
+            tracker.num_tasks_succeeded,
+            tracker.num_tokens_sent,
+        )
+        rates = [
+            (count - last_count) / seconds_since_last_report
+            for count, last_count in zip(counts, self._last_counts)
+        ]
+        self._last_report_at = now
+        self._last_counts = counts
+        latency = tracker.request_latency
+        return {
+            "time": time.time(),
+            "elapsed_seconds": round(now - self._started_at, 3),
+            "requests_per_second": round(rates[0], 3),
+            "succeeded_per_second": round(rates[1], 3),
+            "tokens_per_second": round(rates[2], 3),
+            "requests_in_flight": tracker.num_requests_in_flight,
+            "requests_waiting_to_retry": tracker.num_requests_waiting_to_retry,
+            "tasks_in_progress": tracker.num_tasks_in_progress,
+            "tasks_succeeded": tracker.num_tasks_succeeded,
+            "tasks_failed": tracker.num_tasks_failed,
+            "tasks_skipped": tracker.num_tasks_skipped,
+            "retries": tracker.num_retries,
+            "rate_limit_errors": tracker.num_rate_limit_errors,
+            "status_codes": dict(tracker.status_code_counts),
+            "latency_seconds": {
+                "count": latency.count,
+                "mean": latency.total_seconds / latency.count if latency.count else None,
+                "p50": latency.percentile(50),
+                "p95": latency.percentile(95),
+                "p99": latency.percentile(99),
+            },
+            "limits": [
+                {
+                    "request_url": endpoint.request_url,
+                    "requests_per_minute": endpoint.capacity.max_requests_per_minute,
+                    "tokens_per_minute": endpoint.capacity.max_tokens_per_minute,
+                    "available_requests": endpoint.capacity.available_request_capacity,
+                    "available_tokens": endpoint.capacity.available_token_capacity,
+                    "requests_in_flight": endpoint.num_requests_in_flight,
+                    "paused_seconds": round(
+                        max(0.0, endpoint.capacity.paused_until - time.time()), 3
+                    ),
+                }
+                for endpoint in self.endpoint_pool.endpoints
+            ],
+            "seconds_waiting_for": {
+                reason: round(seconds, 3)
+                for reason, seconds in tracker.seconds_waiting_for.items()
+            },
+            "event_loop_lag_seconds": round(event_loop_lag_seconds, 6),
+        }
+
+
+class ResultWriter:
+    """Writes results to a jsonl file from a single background thread.
+
+    Results are serialized and written in batches, flushed when a batch is full or
+    `flush_interval_seconds` have passed. The durability policy controls how often
+    written results are pushed to disk:
+        - "none": leave it to the OS (and Python's file buffer)
+        - "flush": flush the file buffer every `durability_every` results
+        - "fsync": flush and fsync every `durability_every` results
+    """
+
+    durability_policies = ("none", "flush", "fsync")
+
+    def __init__(
+        self,
+        filename: str,
+        durability: str = "flush",
+        durability_every: int = 100,
+        batch_size: int = 512,
+        flush_interval_seconds: float = 1.0,
+    ):
+        if durability not in self.durability_policies:
+            raise ValueError(
+                f'Unknown durability policy "{durability}", expected one of {self.durability_policies}'
+            )
+        self.filename = filename
+        self.durability = durability
+        self.durability_every = max(1, int(durability_every))
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.num_results_written = 0
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, name="result-writer", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, data) -> None:
+        """Queue a json payload to be appended to the results file. Never blocks."""
+        if self._closed:
+            raise RuntimeError(f"Result writer for {self.filename} is closed")
+        self._queue.put(data)
+
+    def raise_if_failed(self) -> None:
+        """Re-raise a write error from the writer thread, so the run stops instead of losing results."""
+        if self._error is not None:
+            raise RuntimeError(
+                f"Result writer for {self.filename} failed"
+            ) from self._error
+
+    def close(self) -> None:
+        """Write everything still queued, apply the durability policy and close the file."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_WRITER_SENTINEL)
+        self._thread.join()
+        self.raise_if_failed()
+
+    def _run(self) -> None:
+        try:
+            with open(self.filename, "a") as f:
+                self._write_until_closed(f)
+        except Exception as e:
+            logging.error(f"Result writer for {self.filename} failed with {e}")
+            self._error = e
+
+    def _write_until_closed(self, f) -> None:
+        batch = []
+        batch_started_at = None
+        results_since_sync = 0
+        finished = False
+        while not finished:
+            timeout = None
+            if batch:
+                timeout = max(
+                    0.0,
+                    batch_started_at + self.flush_interval_seconds - time.monotonic(),
+                )
+            try:
+                data = self._queue.get(timeout=timeout)
+                if data is _WRITER_SENTINEL:
+                    finished = True
+                else:
+                    line = self._encode(data)
+                    if line is not None:
+                        if not batch:
+                            batch_started_at = time.monotonic()
+                        batch.append(line)
+            except queue.Empty:
+                pass
+
+            batch_is_due = (
+                finished
+                or len(batch) >= self.batch_size
+                or (
+                    batch
+                    and time.monotonic() - batch_started_at
+                    >= self.flush_interval_seconds
+                )
+            )
+            if batch and batch_is_due:
+                f.write("".join(batch))
+                self.num_results_written += len(batch)
+                results_since_sync += len(batch)
+                batch = []
+            if self.durability != "none" and results_since_sync and (
+                finished or results_since_sync >= self.durability_every
+            ):
+                f.flush()
+                if self.durability == "fsync":
+                    os.fsync(f.fileno())
+                results_since_sync = 0
+
+    def _encode(self, data):
+        """Return the line to write for a result, or None if it needs no line."""
+        return json.dumps(data) + "\n"
+
+
+class EmbeddingShardWriter(ResultWriter):
+    """Writes embeddings into float32 shards instead of a jsonl file.
+
+    Successful results are decoded (from base64 or a list of floats) on the writer
+    thread into a preallocated `shard_size` x dimensions float32 array, which is
+    saved once full, and at close, as one shard:
+        - "npy": shard_00000.npy with the ids in shard_00000.ids.npy
+        - "parquet": shard_00000.parquet with an `id_key` column and a fixed size
+          list `embedding` column
+    Shards are written under a temporary name and renamed, so a crash never leaves
+    a partial shard behind; results not yet in a saved shard are sent again on
+    resume. Failures are appended to failures.jsonl, in the usual results format,
+    with the durability policy of ResultWriter.
+    """
+
+    output_formats = ("npy", "parquet")
+
+    def __init__(
+        self,
+        directory: str,
+        output_format: str = "npy",
+        id_key: str = "id",
+        shard_size: int = 100_000,
+        **kwargs,
+    ):
+        if output_format not in self.output_formats:
+            raise ValueError(
+                f'Unknown embedding output "{output_format}", expected one of {self.output_formats}'
+            )
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.output_format = output_format
+        self.id_key = id_key
+        self.shard_size = shard_size
+        self.failures_filename = os.path.join(directory, "failures.jsonl")
+        # continue numbering after the shards of a previous run
+        self.shard_index = len(embedding_shard_names(directory, output_format))
+        self._vectors = None  # allocated once the first embedding gives the dimensions
+        self._ids = []
+        super().__init__(filename=directory, **kwargs)
+
+    def _run(self) -> None:
+        try:
+            with open(self.failures_filename, "a") as f:
+                self._write_until_closed(f)
+            self._save_shard()
+        except Exception as e:
+            logging.error(f"Result writer for {self.filename} failed with {e}")
+            self._error = e
+
+    def _encode(self, data):
+        response = data[1]
+        if not isinstance(response, dict):
+            # a list of errors after all attempts
+            return super()._encode(data)
+        metadata = data[2] if len(data) > 2 else {}
+        embedding = response["data"][0]["embedding"]
+        if isinstance(embedding, str):
+            vector = np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+        else:
+            vector = np.asarray(embedding, dtype=np.float32)
+        if self._vectors is None:
+            self._vectors = np.empty((self.shard_size, len(vector)), dtype=np.float32)
+        self._vectors[len(self._ids)] = vector
+        self._ids.append(metadata.get(self.id_key))
+        if len(self._ids) == self.shard_size:
+            self._save_shard()
+        return None
+
+    def _save_shard(self) -> None:
+        if not self._ids:
+            return
+        save_embedding_shard(
+            self.directory,
+            self.shard_index,
+            self._ids,
+            self._vectors[: len(self._ids)],
+            output_format=self.output_format,
+            id_key=self.id_key,
+            fsync=self.durability == "fsync",
+        )
+        self.num_results_written += len(self._ids)
+        self.shard_index += 1
+        self._ids = []
+
+
+_WRITER_SENTINEL = object()  # tells the writer thread to drain and stop
+
+
+class EmbeddingPacker:
+    """Packs consecutive single-input embedding requests into multi-input requests.
+
+    Requests are packed while they share all parameters other than `input`, up to
+    `max_inputs_per_request` inputs and `max_tokens_per_request` tokens. Requests
+    that already have a list `input` are passed through unchanged.
+    """
+
+    def __init__(self, max_inputs_per_request: int, max_tokens_per_request: int):
+        self.max_inputs_per_request = max_inputs_per_request
+        self.max_tokens_per_request = max_tokens_per_request
+        self._members = []
+        self._params = None
+        self._tokens = 0
+
+    def add(self, request: APIRequest) -> list:
+        """Add a request; returns the requests that are now ready to be called."""
+        if not isinstance(request.request_json.get("input"), str):
+            return self.flush() + [request]
+        params = {k: v for k, v in request.request_json.items() if k != "input"}
+        ready = []
+        if self._members and (
+            params != self._params
+            or len(self._members) >= self.max_inputs_per_request
+            or self._tokens + request.token_consumption > self.max_tokens_per_request
+        ):
+            ready = self.flush()
+        self._members.append(request)
+        self._params = params
+        self._tokens += request.token_consumption
+        return ready
+
+    def flush(self) -> list:
+        """Return the pending pack, if any, as a request ready to be called."""
+        if not self._members:
+            return []
+        pack = APIRequest.pack(self._members)
+        self._members = []
+        self._params = None
+        self._tokens = 0
+        return [pack]
+
+
+class RequestReader:
+    """Reads requests from a jsonl file in batches and turns them into APIRequests.
+
+    Token counts come from each line's `num_tokens` field when present; the rest of
+    a batch is counted in `token_counter`'s threads (tiktoken releases the GIL), so
+    admission does not block the event loop. Requests already completed by a
+    previous run are skipped.
+    """
+
+    def __init__(
+        self,
+        file,
+        api_endpoint: str,
+        token_encoding_name: str,
+        max_attempts: int,
+        token_counter: ThreadPoolExecutor,
+        token_counting_workers: int,
+        status_tracker: StatusTracker,
+        completed_keys: set = None,
+        resume_key: str = None,
+        batch_size: int = 256,
+        request_defaults: dict = None,
+    ):
+        self.file = file
+        self.api_endpoint = api_endpoint
+        self.token_encoding_name = token_encoding_name
+        self.max_attempts = max_attempts
+        self.token_counter = token_counter
+        self.token_counting_workers = token_counting_workers
+        self.status_tracker = status_tracker
+        self.completed_keys = completed_keys or set()
+        self.resume_key = resume_key
+        self.batch_size = batch_size
+        self.request_defaults = request_defaults or {}
+        self.finished = False  # after file is empty, we'll skip reading it
+        self._task_id_generator = (
+            task_id_generator_function()
+        )  # generates integer IDs of 0, 1, 2, ...
+
+    async def read_batch(self) -> list:
+        """Read up to `batch_size` lines; returns the new requests among them."""
+        lines = list(itertools.islice(self.file, self.batch_size))
+        if len(lines) < self.batch_size:
+            # if file runs out, set flag to stop reading it
+            logging.debug("Read file exhausted")
+            self.finished = True
+
+        request_jsons = []
+        for line in lines:
+            request_json = json.loads(line)
+            if (
+                self.completed_keys
+                and (request_json.get("metadata") or {}).get(self.resume_key)
+                in self.completed_keys
+            ):
+                self.status_tracker.num_tasks_skipped += 1
+                continue
+            for key, value in self.request_defaults.items():
+                request_json.setdefault(key, value)
+            request_jsons.append(request_json)
+
+        token_counts = [
+            request_json.pop("num_tokens", None) for request_json in request_jsons
+        ]
+        await self._count_missing_tokens(request_jsons, token_counts)
+
+        requests = []
+        for request_json, token_count in zip(request_jsons, token_counts):
+            request = APIRequest(
+                task_id=next(self._task_id_generator),
+                request_json=request_json,
+                token_consumption=token_count,
+                attempts_left=self.max_attempts,
+                metadata=request_json.pop("metadata", None),
+            )
+            logging.debug(f"Reading request {request.task_id}: {request}")
+            requests.append(request)
+        return requests
+
+    def close(self) -> None:
+        """Nothing to release; the file belongs to the caller."""
+
+    async def _count_missing_tokens(self, request_jsons: list, token_counts: list):
+        """Fill in the `None` entries of `token_counts`, split across the counting threads."""
+        missing = [i for i, count in enumerate(token_counts) if count is None]
+        if not missing:
+            return
+        num_chunks = min(len(missing), self.token_counting_workers)
+        chunks = [missing[i::num_chunks] for i in range(num_chunks)]
+        loop = asyncio.get_running_loop()
+        chunk_counts = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    self.token_counter,
+                    _count_tokens,
+                    [request_jsons[i] for i in chunk],
+                    self.api_endpoint,
+                    self.token_encoding_name,
+                )
+                for chunk in chunks
+            ]
+        )
+        for chunk, counts in zip(chunks, chunk_counts):
+            for i, count in zip(chunk, counts):
+                token_counts[i] = count
+
+
+class ParallelRequestReader:
+    """Reads requests like RequestReader, but parses them in worker processes.
+
+    The file is cut into byte-range slices; each worker parses the lines that start
+    in its slice, skips requests already completed, and counts the tokens of those
+    without a `num_tokens` field. Only ready requests come back to the event loop,
+    which just wraps them in APIRequests. At most `max_pending_slices` slices are
+    parsed or waiting at a time, so memory stays bounded however far ahead the
+    workers could read. With `order="file"` slices are handed out in file order;
+    with `order="any"` as soon as they are parsed.
+    """
+
+    orders = ("file", "any")
+
+    def __init__(
+        self,
+        requests_filepath: str,
+        api_endpoint: str,
+        token_encoding_name: str,
+        max_attempts: int,
+        status_tracker: StatusTracker,
+        num_workers: int = 4,
+        slice_bytes: int = 4 * 1024**2,
+        max_pending_slices: int = 8,
+        order: str = "file",
+        completed_keys: set = None,
+        resume_key: str = None,
+        request_defaults: dict = None,
+    ):
+        if order not in self.orders:
+            raise ValueError(f'Unknown order "{order}", expected one of {self.orders}')
+        self.requests_filepath = requests_filepath
+        self.api_endpoint = api_endpoint
+        self.token_encoding_name = token_encoding_name
+        self.max_attempts = max_attempts
+        self.status_tracker = status_tracker
+        self.max_pending_slices = max(1, max_pending_slices)
+        self.order = order
+        self.request_defaults = request_defaults or {}
+        self.finished = False  # after every slice is read, we'll skip reading
+        file_size = os.path.getsize(requests_filepath)
+        self._slices = iter(
+            [
+                (start, min(start + slice_bytes, file_size))
+                for start in range(0, file_size, slice_bytes)
+            ]
+        )
+        self._pending = deque()
+        self._task_id_generator = task_id_generator_function()
+        # spawn, not fork: the parent already runs threads (result writer, token counters)
+        self._pool = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_ingestion_worker,
+            initargs=(completed_keys or set(), resume_key),
+        )
+
+    def _submit_slices(self) -> None:
+        loop = asyncio.get_running_loop()
+        while len(self._pending) < self.max_pending_slices:
+            next_slice = next(self._slices, None)
+            if next_slice is None:
+                return
+            self._pending.append(
+                loop.run_in_executor(
+                    self._pool,
+                    _parse_request_slice,
+                    self.requests_filepath,
+                    *next_slice,
+                    self.api_endpoint,
+                    self.token_encoding_name,
+                    self.request_defaults,
+                )
+            )
+
+    async def read_batch(self) -> list:
+        """Wait for the next parsed slice; returns the new requests in it."""
+        self._submit_slices()
+        if not self._pending:
+            self.finished = True
+            return []
+        if self.order == "file":
+            parsed = self._pending.popleft()
+        else:
+            done, _ = await asyncio.wait(
+                self._pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            parsed = done.pop()
+            self._pending.remove(parsed)
+        records, num_skipped = await parsed
+        self.status_tracker.num_tasks_skipped += num_skipped
+        self._submit_slices()
+        if not self._pending:
+            logging.debug("Read file exhausted")
+            self.finished = True
+
+        return [
+            APIRequest(
+                task_id=next(self._task_id_generator),
+                request_json=request_json,
+                token_consumption=token_count,
+                attempts_left=self.max_attempts,
+                metadata=metadata,
+            )
+            for request_json, token_count, metadata in records
+        ]
+
+    def close(self) -> None:
+        for parsed in self._pending:
+            parsed.cancel()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+_ingestion_worker_state = {}  # completed keys and resume key, set once per worker process
+
+
+def _init_ingestion_worker(completed_keys: set, resume_key: str) -> None:
+    _ingestion_worker_state["completed_keys"] = completed_keys
+    _ingestion_worker_state["resume_key"] = resume_key
+
+
+def _parse_request_slice(
+    requests_filepath: str,
+    start: int,
+    end: int,
+    api_endpoint: str,
+    token_encoding_name: str,
+    request_defaults: dict,
+):
+    """Parse the lines of a requests file that start in [start, end), in a worker process.
+
+    Returns ([(request_json, token_count, metadata), ...], number of skipped requests).
+    """
+    completed_keys = _ingestion_worker_state.get("completed_keys") or set()
+    resume_key = _ingestion_worker_state.get("resume_key")
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(requests_filepath, "rb") as f:
+        if start > 0:
+            # the line running into this slice belongs to the slice it starts in
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        data = b""
+        if position < end:
+            data = f.read(end - position)
+            if not data.endswith(b"\n"):
+                data += f.readline()  # finish the last line, which starts in this slice
+
+    request_jsons = []
+    num_skipped = 0
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        request_json = loads(line)
+        if (
+            completed_keys
+            and (request_json.get("metadata") or {}).get(resume_key) in completed_keys
+        ):
+            num_skipped += 1
+            continue
+        for key, value in request_defaults.items():
+            request_json.setdefault(key, value)
+        request_jsons.append(request_json)
+
+    token_counts = [request_json.pop("num_tokens", None) for request_json in request_jsons]
+    missing = [i for i, count in enumerate(token_counts) if count is None]
+    if missing:
+        counts = _count_tokens(
+            [request_jsons[i] for i in missing], api_endpoint, token_encoding_name
+        )
+        for i, count in zip(missing, counts):
+            token_counts[i] = count
+    records = [
+        (request_json, token_count, request_json.pop("metadata", None))
+        for request_json, token_count in zip(request_jsons, token_counts)
+    ]
+    return records, num_skipped
 
 
 # functions
@@ -368,20 +1933,268 @@ class APIRequest:
 
 def api_endpoint_from_url(request_url):
     """Extract the API endpoint from the request URL."""
-    match = re.search("^https://[^/]+/v\\d+/(.+)$", request_url)
+    # plain http is accepted for local stand-ins such as mock_openai_server.py
+    match = re.search("^https?://[^/]+/v\\d+/(.+)$", request_url)
     if match is None:
         # for Azure OpenAI deployment urls
         match = re.search(
-            r"^https://[^/]+/openai/deployments/[^/]+/(.+?)(\?|$)", request_url
+            r"^https?://[^/]+/openai/deployments/[^/]+/(.+?)(\?|$)", request_url
         )
     return match[1]
 
 
-def append_to_jsonl(data, filename: str) -> None:
-    """Append a json payload to the end of a jsonl file."""
-    json_string = json.dumps(data)
-    with open(filename, "a") as f:
-        f.write(json_string + "\n")
+def completed_request_keys(
+    save_filepath: str, resume_key: str, include_failed: bool = True
+) -> set:
+    """Collect the `resume_key` metadata values of the requests saved in a results file.
+
+    Streams the file line by line and keeps only the keys, so memory stays
+    proportional to the number of requests rather than the size of the results.
+    Successes are always included; failures after all attempts only with
+    `include_failed`. A truncated last line (e.g. after a crash) is cut off so new
+    results start on a fresh line.
+    """
+    succeeded = set()
+    failed = set()
+    decoder = json.JSONDecoder()
+    end_of_last_full_line = 0
+    with open(save_filepath, "rb") as f:
+        for raw_line in f:
+            if not raw_line.endswith(b"\n"):
+                break  # partial line from an interrupted write
+            end_of_last_full_line += len(raw_line)
+            line = raw_line.decode("utf-8").rstrip("\n")
+            try:
+                key, is_success = _saved_result_key(line, resume_key, decoder)
+            except (ValueError, KeyError, IndexError, TypeError):
+                logging.warning(f"Could not read a saved result: {line[:200]}")
+                continue
+            if key is None:
+                continue
+            if is_success:
+                succeeded.add(key)
+            else:
+                failed.add(key)
+
+    if end_of_last_full_line < os.path.getsize(save_filepath):
+        logging.warning(f"Truncating an incomplete last line in {save_filepath}")
+        os.truncate(save_filepath, end_of_last_full_line)
+
+    return succeeded | failed if include_failed else succeeded
+
+
+def completed_embedding_keys(
+    directory: str, id_key: str, include_failed: bool = True
+) -> set:
+    """Collect the ids saved in a directory of embedding shards (see EmbeddingShardWriter).
+
+    Failures in failures.jsonl are included with `include_failed`.
+    """
+    keys = set()
+    for name in embedding_shard_names(directory, "npy"):
+        keys.update(np.load(os.path.join(directory, name + ".ids.npy")).tolist())
+    parquet_names = embedding_shard_names(directory, "parquet")
+    if parquet_names:
+        import pyarrow.parquet as pq
+
+        for name in parquet_names:
+            table = pq.read_table(
+                os.path.join(directory, name + ".parquet"), columns=[id_key]
+            )
+            keys.update(table.column(id_key).to_pylist())
+    failures_filename = os.path.join(directory, "failures.jsonl")
+    if include_failed and os.path.exists(failures_filename):
+        keys |= completed_request_keys(failures_filename, id_key)
+    return keys
+
+
+def save_embedding_shard(
+    directory: str,
+    shard_index: int,
+    ids: list,
+    vectors: np.ndarray,
+    output_format: str = "npy",
+    id_key: str = "id",
+    fsync: bool = False,
+) -> None:
+    """Save one shard of ids and float32 vectors in the format of EmbeddingShardWriter.
+
+    Files are written under a temporary name and renamed, so a shard is either
+    complete or missing.
+    """
+
+    def save_atomically(path: str, save) -> None:
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            save(f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+    ids = np.asarray(ids)
+    if ids.dtype == object:
+        ids = ids.astype(str)  # mixed or missing ids; keeps the file loadable without pickle
+    name = os.path.join(directory, f"shard_{shard_index:05d}")
+    if output_format == "npy":
+        # ids first: a shard only counts as saved once its vectors are there
+        save_atomically(name + ".ids.npy", lambda f: np.save(f, ids))
+        save_atomically(name + ".npy", lambda f: np.save(f, vectors))
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.table(
+            {
+                id_key: ids,
+                "embedding": pa.FixedSizeListArray.from_arrays(
+                    np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1),
+                    vectors.shape[1],
+                ),
+            }
+        )
+        save_atomically(name + ".parquet", lambda f: pq.write_table(table, f))
+    logging.debug(f"Saved {len(ids)} embeddings to {name}")
+
+
+def iter_embedding_shards(directory: str, id_key: str = "id"):
+    """Yield (ids, vectors) for each shard in a directory of embedding shards, in order.
+
+    `vectors` is a float32 array of shape (len(ids), dimensions).
+    """
+    for name in embedding_shard_names(directory, "npy"):
+        path = os.path.join(directory, name)
+        yield np.load(path + ".ids.npy").tolist(), np.load(path + ".npy")
+    parquet_names = embedding_shard_names(directory, "parquet")
+    if parquet_names:
+        import pyarrow.parquet as pq
+
+        for name in parquet_names:
+            table = pq.read_table(os.path.join(directory, name + ".parquet"))
+            embeddings = table.column("embedding").combine_chunks()
+            vectors = embeddings.flatten().to_numpy().reshape(len(embeddings), -1)
+            yield table.column(id_key).to_pylist(), vectors
+
+
+def embedding_shard_names(directory: str, output_format: str) -> list:
+    """Names (without extension) of the complete shards in `directory`, in order."""
+    if not os.path.isdir(directory):
+        return []
+    suffix = ".npy" if output_format == "npy" else ".parquet"
+    return sorted(
+        name[: -len(suffix)]
+        for name in os.listdir(directory)
+        if name.startswith("shard_")
+        and name.endswith(suffix)
+        and not name.endswith(".ids.npy")
+    )
+
+
+def _saved_result_key(line: str, resume_key: str, decoder: json.JSONDecoder):
+    """Return (key, is_success) for a saved `[request, response or errors, metadata]` line.
+
+    Only the small request and metadata parts are decoded; the response, which can
+    be a large embedding, is skipped over. Falls back to a full parse when the
+    shortcut does not line up.
+    """
+    # the request comes first, so what follows it tells a response from a list of errors
+    _, end = decoder.raw_decode(line, 1)
+    is_success = line[end:].lstrip(", ").startswith("{")
+    # the metadata dict is the last element; JSON strings cannot contain an unescaped '{"'
+    start = line.rfind(', {"')
+    if start != -1:
+        try:
+            metadata, end = decoder.raw_decode(line, start + 2)
+            if line[end:] == "]" and isinstance(metadata, dict):
+                return metadata.get(resume_key), is_success
+        except ValueError:
+            pass
+    data = json.loads(line)
+    metadata = data[2] if len(data) > 2 else {}
+    return metadata.get(resume_key), not isinstance(data[1], list)
+
+
+def seconds_from_duration(duration: str) -> float:
+    """Parse a rate limit reset duration such as "1s", "6m0s", "20ms" or "1h2m3.5s" into seconds."""
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", duration)
+    if not parts:
+        return float(duration)  # plain number of seconds
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+def classify_error(status: int, error) -> str:
+    """Sort an error into "rate_limit", "timeout", "server", "client" or "other"."""
+    message = ""
+    if isinstance(error, dict) and isinstance(error.get("error"), dict):
+        message = error["error"].get("message") or ""
+    if status == 429 or "rate limit" in message.lower():
+        return "rate_limit"
+    if isinstance(error, asyncio.TimeoutError) or status == 408:
+        return "timeout"
+    if status is not None and status >= 500:
+        return "server"
+    if status is not None and 400 <= status < 500:
+        return "client"
+    return "other"  # connection errors, unreadable responses, ...
+
+
+def default_retry_policies(max_attempts: int) -> dict:
+    """Retry policies used unless others are given: client errors (bad requests) get one retry."""
+    return {
+        "rate_limit": RetryPolicy(max_attempts, base_backoff_seconds=1.0),
+        "server": RetryPolicy(max_attempts, base_backoff_seconds=1.0),
+        "timeout": RetryPolicy(max_attempts, base_backoff_seconds=2.0),
+        "client": RetryPolicy(min(max_attempts, 2), base_backoff_seconds=1.0),
+        "other": RetryPolicy(max_attempts, base_backoff_seconds=1.0),
+    }
+
+
+def _float_header(headers, name: str):
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _seconds_until_capacity_refills(headers, num_tokens: int = 1):
+    """Seconds until a request of `num_tokens` tokens fits in the API's limits again.
+
+    A retry-after(-ms) header wins when the API sends one. Otherwise, the
+    x-ratelimit-reset-* headers give the time until a limit is back to full, but it
+    refills at a steady rate, so only the share missing for one request is waited for.
+    """
+    if headers.get("retry-after-ms") is not None:
+        return float(headers["retry-after-ms"]) / 1000.0
+    if headers.get("retry-after") is not None:
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass  # an HTTP date; fall through to the rate limit headers
+    waits = []
+    for limit_name, needed in (("requests", 1), ("tokens", num_tokens)):
+        limit = _float_header(headers, f"x-ratelimit-limit-{limit_name}")
+        remaining = _float_header(headers, f"x-ratelimit-remaining-{limit_name}")
+        if remaining is not None and remaining >= needed:
+            continue  # only an exhausted limit is worth waiting for
+        seconds = None
+        reset = headers.get(f"x-ratelimit-reset-{limit_name}")
+        if reset is not None:
+            try:
+                seconds = seconds_from_duration(reset)
+            except ValueError:
+                pass
+        missing = needed - (remaining or 0)
+        if seconds is not None and limit and remaining is not None and limit > remaining:
+            # `seconds` refills limit - remaining; one request needs `missing` of it
+            seconds *= min(1.0, missing / (limit - remaining))
+        elif limit:
+            one_request = 60.0 * missing / limit  # the limits are per minute
+            seconds = one_request if seconds is None else min(seconds, one_request)
+        if seconds is not None:
+            waits.append(seconds)
+    return max(waits) if waits else None
 
 
 def num_tokens_consumed_from_request(
@@ -390,7 +2203,7 @@ def num_tokens_consumed_from_request(
     token_encoding_name: str,
 ):
     """Count the number of tokens in the request. Only supports completion and embedding requests."""
-    encoding = tiktoken.get_encoding(token_encoding_name)
+    encoding = cached_encoding(token_encoding_name)
     # if completions request, tokens = prompt + n * max_tokens
     if api_endpoint.endswith("completions"):
         max_tokens = request_json.get("max_tokens", 15)
@@ -443,6 +2256,21 @@ def num_tokens_consumed_from_request(
         )
 
 
+@functools.lru_cache(maxsize=None)
+def cached_encoding(token_encoding_name: str):
+    """Load a tiktoken encoding once; encodings are safe to share between threads."""
+    return tiktoken.get_encoding(token_encoding_name)
+
+
+def _count_tokens(
+    request_jsons: list, api_endpoint: str, token_encoding_name: str
+) -> list:
+    return [
+        num_tokens_consumed_from_request(request_json, api_endpoint, token_encoding_name)
+        for request_json in request_jsons
+    ]
+
+
 def task_id_generator_function():
     """Generate integers 0, 1, 2, and so on."""
     task_id = 0
@@ -466,10 +2294,60 @@ if __name__ == "__main__":
     parser.add_argument("--token_encoding_name", default="cl100k_base")
     parser.add_argument("--max_attempts", type=int, default=5)
     parser.add_argument("--logging_level", default=logging.INFO)
+    parser.add_argument(
+        "--write_durability", choices=ResultWriter.durability_policies, default="flush"
+    )
+    parser.add_argument("--write_durability_every", type=int, default=100)
+    parser.add_argument("--resume_key", default=None)
+    parser.add_argument("--requeue_failed", action="store_true")
+    parser.add_argument("--max_inputs_per_request", type=int, default=1)
+    parser.add_argument("--max_tokens_per_request", type=int, default=100_000)
+    parser.add_argument(
+        "--fixed_rate_limits", dest="adapt_to_rate_limit_headers", action="store_false"
+    )
+    parser.add_argument("--target_utilization", type=float, default=0.95)
+    parser.add_argument("--token_counting_workers", type=int, default=4)
+    parser.add_argument("--max_in_flight", type=int, default=500)
+    parser.add_argument("--metrics_interval_seconds", type=float, default=10)
+    parser.add_argument("--metrics_filepath", default=None)
+    parser.add_argument("--metrics_port", type=int, default=None)
+    parser.add_argument(
+        "--endpoints_filepath",
+        default=None,
+        help="json file with a list of endpoints (request_url, api_key, max_requests_per_minute, max_tokens_per_minute, weight)",
+    )
+    parser.add_argument("--routing", choices=EndpointPool.routings, default="least_loaded")
+    parser.add_argument(
+        "--embedding_output", choices=EmbeddingShardWriter.output_formats, default=None
+    )
+    parser.add_argument("--embedding_id_key", default="id")
+    parser.add_argument("--embedding_shard_size", type=int, default=100_000)
+    parser.add_argument("--max_connections", type=int, default=None)
+    parser.add_argument("--max_connections_per_host", type=int, default=0)
+    parser.add_argument("--keepalive_seconds", type=float, default=30)
+    parser.add_argument("--dns_cache_seconds", type=float, default=300)
+    parser.add_argument("--stdlib_json", dest="fast_json", action="store_false")
+    parser.add_argument("--gzip_request_min_bytes", type=int, default=None)
+    parser.add_argument("--ingestion_workers", type=int, default=0)
+    parser.add_argument("--ingestion_slice_bytes", type=int, default=4 * 1024**2)
+    parser.add_argument("--ingestion_queue_slices", type=int, default=None)
+    parser.add_argument(
+        "--ingestion_order", choices=ParallelRequestReader.orders, default="file"
+    )
     args = parser.parse_args()
 
+    endpoints = None
+    if args.endpoints_filepath is not None:
+        with open(args.endpoints_filepath) as f:
+            endpoints = json.load(f)
+
     if args.save_filepath is None:
-        args.save_filepath = args.requests_filepath.replace(".jsonl", "_results.jsonl")
+        if args.embedding_output is not None:
+            args.save_filepath = args.requests_filepath.replace(".jsonl", "_embeddings")
+        else:
+            args.save_filepath = args.requests_filepath.replace(
+                ".jsonl", "_results.jsonl"
+            )
 
     # run script
     asyncio.run(
@@ -483,6 +2361,34 @@ if __name__ == "__main__":
             token_encoding_name=args.token_encoding_name,
             max_attempts=int(args.max_attempts),
             logging_level=int(args.logging_level),
+            write_durability=args.write_durability,
+            write_durability_every=args.write_durability_every,
+            resume_key=args.resume_key,
+            requeue_failed=args.requeue_failed,
+            max_inputs_per_request=args.max_inputs_per_request,
+            max_tokens_per_request=args.max_tokens_per_request,
+            adapt_to_rate_limit_headers=args.adapt_to_rate_limit_headers,
+            target_utilization=args.target_utilization,
+            token_counting_workers=args.token_counting_workers,
+            max_in_flight=args.max_in_flight,
+            metrics_interval_seconds=args.metrics_interval_seconds,
+            metrics_filepath=args.metrics_filepath,
+            metrics_port=args.metrics_port,
+            endpoints=endpoints,
+            routing=args.routing,
+            embedding_output=args.embedding_output,
+            embedding_id_key=args.embedding_id_key,
+            embedding_shard_size=args.embedding_shard_size,
+            max_connections=args.max_connections,
+            max_connections_per_host=args.max_connections_per_host,
+            keepalive_seconds=args.keepalive_seconds,
+            dns_cache_seconds=args.dns_cache_seconds,
+            fast_json=args.fast_json,
+            gzip_request_min_bytes=args.gzip_request_min_bytes,
+            ingestion_workers=args.ingestion_workers,
+            ingestion_slice_bytes=args.ingestion_slice_bytes,
+            ingestion_queue_slices=args.ingestion_queue_slices,
+            ingestion_order=args.ingestion_order,
         )
     )
 
@@ -0,0 +1,234 @@
+"""
+ANN INDEX BENCHMARK
+
+Measures the index backends of `ann_index.py` on the product embeddings, to choose an
+operating point for the neighbor job in top-k.py.
+
+A random sample of `num_queries` stored vectors is searched with the exact flat index
+for ground truth, then with each index at each search setting (`nprobe` for IVF
+indexes, `ef_search` for HNSW). For each it reports:
+- recall@k against the exact neighbors
+- queries per second (the sample searched as one batch, with faiss' threads)
+- index size (its serialized size) and build time, including training
+- peak resident memory of the benchmark process so far
+- with `--index_dimensions`, the same for indexes over the first N dimensions of the
+  vectors (renormalized), alone and with their `shortlist_size` candidates re-ranked
+  at full dimension (`RerankingSearcher`); reduced stores are built next to the store
+- for fp16 / int8 scalar-quantized indexes, the recall delta against the same index
+  and search setting with float32 vectors (run "none" first to get it)
+
+The ground truth is exact float32 search with the same metric; for `--metric ip`,
+use a store built with `normalize=True`.
+
+Example command:
+```
+cd dataset
+python -m scripts.benchmark_ann \
+  --store_dir embedding_store \
+  --indexes ivf_flat ivf_pq hnsw \
+  --nprobe 8 32 128 \
+  --ef_search 64 128 256 \
+  --num_queries 1000 \
+  --k 100 \
+  --metric ip \
+  --scalar_quantizers none fp16 int8 \
+  --index_dimensions 256 512 \
+  --report_filepath ann_results.jsonl
+```
+"""
+
+import argparse
+import itertools
+import json
+import resource
+import time
+from dataclasses import asdict, replace
+
+import numpy as np
+
+from scripts.ann_index import (
+    INDEX_KINDS,
+    SCALAR_QUANTIZERS,
+    IndexConfig,
+    RerankingSearcher,
+    build_index,
+    describe_index,
+    index_size_bytes,
+    recall_at_k,
+    set_search_params,
+)
+from scripts.embedding_store import EmbeddingStore, normalize_rows
+
+
+def search_settings(config: IndexConfig, nprobes: list, ef_searches: list) -> list:
+    """The configs to search a built index with, one per search setting."""
+    if config.kind in ("ivf_flat", "ivf_pq"):
+        return [replace(config, nprobe=nprobe) for nprobe in nprobes]
+    if config.kind == "hnsw":
+        return [replace(config, ef_search=ef_search) for ef_search in ef_searches]
+    return [config]
+
+
+def run_benchmark(
+    store: EmbeddingStore,
+    config: IndexConfig,
+    queries: np.ndarray,
+    true_neighbors: np.ndarray,
+    k: int,
+    nprobes: list,
+    ef_searches: list,
+    full_store: EmbeddingStore = None,
+    shortlist_size: int = 400,
+) -> list:
+    """
+    Build one index and search it at each setting; returns a report per setting.
+
+    With `full_store`, `store` holds reduced-dimension vectors: queries (full
+    vectors) are searched through a RerankingSearcher, and the recall of the
+    first stage alone is reported too.
+    """
+    started_at = time.perf_counter()
+    index = build_index(store, config)
+    build_seconds = time.perf_counter() - started_at
+    size_megabytes = index_size_bytes(index) / 1024**2
+    searcher = index
+    if full_store is not None:
+        searcher = RerankingSearcher(
+            index,
+            full_store,
+            store.dimensions,
+            shortlist_size=shortlist_size,
+            metric=config.metric,
+        )
+
+    reports = []
+    for setting in search_settings(config, nprobes, ef_searches):
+        set_search_params(index, setting)
+        started_at = time.perf_counter()
+        _, neighbors = searcher.search(queries, k)
+        search_seconds = time.perf_counter() - started_at
+        report = {}
+        if full_store is not None:
+            reduced = normalize_rows(queries[:, : store.dimensions])
+            _, first_stage_neighbors = index.search(np.ascontiguousarray(reduced), k)
+            report = {
+                "index_dimensions": store.dimensions,
+                "shortlist_size": shortlist_size,
+                f"first_stage_recall_at_{k}": round(
+                    recall_at_k(first_stage_neighbors, true_neighbors), 4
+                ),
+            }
+        reports.append(
+            {
+                **report,
+                "index": describe_index(setting),
+                "num_vectors": index.ntotal,
+                "num_queries": len(queries),
+                "k": k,
+                f"recall_at_{k}": round(recall_at_k(neighbors, true_neighbors), 4),
+                "queries_per_second": round(len(queries) / search_seconds, 1),
+                "index_megabytes": round(size_megabytes, 1),
+                "build_seconds": round(build_seconds, 1),
+                # ru_maxrss is in kilobytes on Linux
+                "peak_rss_megabytes": round(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+                ),
+                "config": asdict(setting),
+            }
+        )
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store_dir", required=True)
+    parser.add_argument(
+        "--indexes",
+        nargs="+",
+        choices=INDEX_KINDS,
+        default=["ivf_flat", "ivf_pq", "hnsw"],
+    )
+    parser.add_argument("--num_queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=100)
+    parser.add_argument("--metric", choices=["l2", "ip"], default="l2")
+    parser.add_argument(
+        "--scalar_quantizers",
+        nargs="+",
+        choices=["none", *SCALAR_QUANTIZERS],
+        default=["none"],
+    )
+    parser.add_argument("--nlist", type=int, default=4096)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument("--pq_m", type=int, default=64)
+    parser.add_argument("--hnsw_m", type=int, default=32)
+    parser.add_argument("--ef_search", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--train_size", type=int, default=200_000)
+    parser.add_argument("--index_dimensions", type=int, nargs="*", default=[])
+    parser.add_argument("--shortlist_size", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report_filepath", default=None)
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store_dir)
+    rng = np.random.default_rng(args.seed)
+    query_rows = rng.choice(len(store), min(args.num_queries, len(store)), replace=False)
+    queries = store.get(query_rows)
+
+    print("Computing exact neighbors of the queries...")
+    flat = build_index(store, IndexConfig(kind="flat", metric=args.metric))
+    _, true_neighbors = flat.search(queries, args.k)
+    del flat
+
+    # the full vectors, then each reduced store; None stands for the full dimensions
+    index_stores = {None: store}
+    for dimensions in args.index_dimensions:
+        index_stores[dimensions] = EmbeddingStore.open_or_build(
+            store.manifest["shards_dir"],
+            f"{args.store_dir.rstrip('/')}_{dimensions}d",
+            id_key=store.manifest["id_key"],
+            dtype=store.manifest["dtype"],
+            dimensions=dimensions,
+        )
+
+    # (dimensions, kind, nprobe, ef_search) -> recall without scalar quantization
+    float32_recalls = {}
+    for dimensions, kind, scalar_quantizer in itertools.product(
+        index_stores, args.indexes, args.scalar_quantizers
+    ):
+        scalar_quantizer = None if scalar_quantizer == "none" else scalar_quantizer
+        if kind == "ivf_pq" and scalar_quantizer is not None:
+            continue  # already compressed by PQ
+        config = IndexConfig(
+            kind=kind,
+            metric=args.metric,
+            scalar_quantizer=scalar_quantizer,
+            nlist=args.nlist,
+            pq_m=args.pq_m,
+            hnsw_m=args.hnsw_m,
+            train_size=args.train_size,
+            seed=args.seed,
+        )
+        reports = run_benchmark(
+            index_stores[dimensions],
+            config,
+            queries,
+            true_neighbors,
+            args.k,
+            args.nprobe,
+            args.ef_search,
+            full_store=store if dimensions is not None else None,
+            shortlist_size=args.shortlist_size,
+        )
+        for report in reports:
+            recall = report[f"recall_at_{args.k}"]
+            setting = report["config"]
+            key = (dimensions, kind, setting["nprobe"], setting["ef_search"])
+            if scalar_quantizer is None:
+                float32_recalls[key] = recall
+            elif key in float32_recalls:
+                delta = recall - float32_recalls[key]
+                report["recall_delta_vs_float32"] = round(delta, 4)
+            print(json.dumps(report))
+            if args.report_filepath:
+                with open(args.report_filepath, "a") as f:
+                    f.write(json.dumps(report) + "\n")
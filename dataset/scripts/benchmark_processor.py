@@ -0,0 +1,245 @@
+"""
+PROCESSOR LOAD BENCHMARK
+
+Replays a generated requests file through `process_api_requests_from_file` against the
+local mock server (`mock_openai_server.py`), so scheduler changes can be measured and
+regression-tested offline.
+
+For each requests file size it reports:
+- sustained throughput (requests and tokens per second, end to end)
+- limit utilization (what the mock server accepted, as a fraction of its RPM/TPM limits)
+- CPU time per request of the processor process (event loop and its threads)
+- peak resident memory of the processor process
+- rate limit and server errors seen
+- the mean latency the mock server was configured to add, and how long it really took to
+  answer; a warning is printed when the mock server is far slower than configured, i.e.
+  it is the bottleneck and the numbers above measure it rather than the processor
+
+The mock server (and any ingestion worker processes) run in their own processes, so their
+CPU time is not counted.
+
+Example command:
+```
+cd dataset
+python -m scripts.benchmark_processor \
+  --num_requests 10000 100000 \
+  --requests_per_minute 60000 \
+  --tokens_per_minute 10000000 \
+  --latency_mean_seconds 0.05 \
+  --report_filepath benchmark_results.jsonl
+```
+Add `--stdlib_json --max_connections 100` to measure against the json module and
+aiohttp's default connection pool.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+from scripts.api_request_parallel_processor import process_api_requests_from_file
+
+WORDS = "red blue cotton shirt vintage leather bag steel water bottle kids toy".split()
+
+
+def generate_requests_file(
+    file_path: Path,
+    num_requests: int,
+    model: str = "text-embedding-3-small",
+    words_per_input: int = 50,
+    include_num_tokens: bool = True,
+    seed: int = 0,
+) -> None:
+    """Write `num_requests` single-input embedding requests, one per line, streaming to disk."""
+    rng = random.Random(seed)
+    with open(file_path, "w") as f:
+        for i in range(num_requests):
+            job = {
+                "model": model,
+                "input": " ".join(rng.choices(WORDS, k=words_per_input)),
+                "metadata": {"item_id": i},
+            }
+            if include_num_tokens:
+                job["num_tokens"] = words_per_input
+            f.write(json.dumps(job) + "\n")
+
+
+def start_mock_server(port: int, server_args: list) -> subprocess.Popen:
+    """Start the mock server in its own process and wait until it answers."""
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "scripts.mock_openai_server",
+            "--port",
+            str(port),
+            *server_args,
+        ],
+        cwd=Path(__file__).resolve().parents[1],
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            read_mock_stats(port)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"Mock server did not start on port {port}")
+
+
+def read_mock_stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/mock/stats") as response:
+        return json.loads(response.read())
+
+
+def run_benchmark(
+    num_requests: int,
+    port: int,
+    work_dir: Path,
+    requests_per_minute: float,
+    tokens_per_minute: float,
+    processor_kwargs: dict,
+) -> dict:
+    """Run the processor over a generated file of `num_requests` requests; returns the report."""
+    requests_filepath = work_dir / f"requests_{num_requests}.jsonl"
+    save_filepath = work_dir / f"results_{num_requests}.jsonl"
+    generate_requests_file(requests_filepath, num_requests)
+    save_filepath.unlink(missing_ok=True)
+
+    stats_before = read_mock_stats(port)
+    cpu_before = time.process_time()
+    started_at = time.perf_counter()
+    asyncio.run(
+        process_api_requests_from_file(
+            requests_filepath=str(requests_filepath),
+            save_filepath=str(save_filepath),
+            request_url=f"http://127.0.0.1:{port}/v1/embeddings",
+            api_key="mock",
+            max_requests_per_minute=requests_per_minute,
+            max_tokens_per_minute=tokens_per_minute,
+            token_encoding_name="cl100k_base",
+            max_attempts=5,
+            logging_level=logging.ERROR,
+            **processor_kwargs,
+        )
+    )
+    wall_seconds = time.perf_counter() - started_at
+    cpu_seconds = time.process_time() - cpu_before
+    stats_after = read_mock_stats(port)
+
+    def served(key: str) -> float:
+        return stats_after[key] - stats_before[key]
+
+    with open(save_filepath) as f:
+        num_results = sum(1 for _ in f)
+    minutes = wall_seconds / 60.0
+    num_timed = max(served("num_timed"), 1)
+    configured_latency = served("configured_latency_seconds") / num_timed
+    served_latency = served("served_latency_seconds") / num_timed
+    if served_latency > 2 * configured_latency + 0.01:
+        # printed, the processor sets the logging level to ERROR
+        print(
+            f"WARNING: the mock server took {served_latency:.3f}s per request on "
+            f"average, against {configured_latency:.3f}s of configured latency: it is "
+            "the bottleneck, so throughput and utilization measure it, not the processor",
+            file=sys.stderr,
+        )
+    return {
+        "num_requests": num_requests,
+        "num_results": num_results,
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(num_requests / wall_seconds, 2),
+        "api_calls_per_second": round(served("num_succeeded") / wall_seconds, 2),
+        "tokens_per_second": round(served("num_tokens_accepted") / wall_seconds, 2),
+        "request_limit_utilization": round(
+            served("num_succeeded") / minutes / stats_after["requests_per_minute_limit"], 4
+        ),
+        "token_limit_utilization": round(
+            served("num_tokens_accepted") / minutes / stats_after["tokens_per_minute_limit"], 4
+        ),
+        "cpu_seconds": round(cpu_seconds, 3),
+        "cpu_microseconds_per_request": round(cpu_seconds / num_requests * 1e6, 1),
+        # ru_maxrss is in kilobytes on Linux; it is the peak for the whole benchmark process
+        "peak_rss_megabytes": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "rate_limited": served("num_rate_limited"),
+        "server_errors": served("num_server_errors"),
+        "mock_configured_latency_seconds": round(configured_latency, 4),
+        "mock_served_latency_seconds": round(served_latency, 4),
+        "processor_kwargs": processor_kwargs,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_requests", type=int, nargs="+", default=[10_000])
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--requests_per_minute", type=float, default=60_000)
+    parser.add_argument("--tokens_per_minute", type=float, default=10_000_000)
+    parser.add_argument("--latency", default="lognormal")
+    parser.add_argument("--latency_mean_seconds", type=float, default=0.05)
+    parser.add_argument("--server_error_rate", type=float, default=0.0)
+    parser.add_argument("--embedding_dimensions", type=int, default=1536)
+    parser.add_argument("--max_in_flight", type=int, default=500)
+    parser.add_argument("--max_inputs_per_request", type=int, default=1)
+    parser.add_argument("--max_connections", type=int, default=None)
+    parser.add_argument("--stdlib_json", dest="fast_json", action="store_false")
+    parser.add_argument("--gzip_request_min_bytes", type=int, default=None)
+    parser.add_argument("--ingestion_workers", type=int, default=0)
+    parser.add_argument("--work_dir", default=None)
+    parser.add_argument("--report_filepath", default=None)
+    args = parser.parse_args()
+
+    server = start_mock_server(
+        args.port,
+        [
+            "--requests_per_minute",
+            str(args.requests_per_minute),
+            "--tokens_per_minute",
+            str(args.tokens_per_minute),
+            "--latency",
+            args.latency,
+            "--latency_mean_seconds",
+            str(args.latency_mean_seconds),
+            "--server_error_rate",
+            str(args.server_error_rate),
+            "--embedding_dimensions",
+            str(args.embedding_dimensions),
+        ],
+    )
+    try:
+        with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+            for num_requests in args.num_requests:
+                report = run_benchmark(
+                    num_requests=num_requests,
+                    port=args.port,
+                    work_dir=Path(work_dir),
+                    requests_per_minute=args.requests_per_minute,
+                    tokens_per_minute=args.tokens_per_minute,
+                    processor_kwargs={
+                        "max_in_flight": args.max_in_flight,
+                        "max_inputs_per_request": args.max_inputs_per_request,
+                        "max_connections": args.max_connections,
+                        "fast_json": args.fast_json,
+                        "gzip_request_min_bytes": args.gzip_request_min_bytes,
+                        "ingestion_workers": args.ingestion_workers,
+                        "metrics_interval_seconds": 0,
+                    },
+                )
+                print(json.dumps(report))
+                if args.report_filepath:
+                    with open(args.report_filepath, "a") as f:
+                        f.write(json.dumps(report) + "\n")
+    finally:
+        server.terminate()
+        server.wait()
@@ -1,12 +1,16 @@
 import os
+import shutil
 from pathlib import Path
+from typing import Iterable, Union
 
 import pandas as pd
 from dotenv import find_dotenv, load_dotenv
+from scripts.embedding_cache import EmbeddingCache
 from scripts.utils import (
     OpenAIConfig,
     create_embedding_jobs,
     run_api_request_processor,
+    write_embeddings_from_cache,
 )
 
 """
@@ -16,31 +20,67 @@ For getting top k similar products
 
 
 def get_product_embeddings(
-    df: pd.DataFrame, jobs_path: Path, out_path: Path, config: OpenAIConfig
+    df: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+    jobs_path: Path,
+    out_path: Path,
+    config: OpenAIConfig,
+    resume: bool = False,
 ):
+    cache = None
+    if config.embedding_cache_path is not None:
+        cache = EmbeddingCache(Path(config.embedding_cache_path))
 
-    create_embedding_jobs(
+    rows = create_embedding_jobs(
         df,
         model="text-embedding-3-small",
         file_path=jobs_path,
         product_keys=["title", "description"],
         id_key="item_id",
+        cache=cache,
+        dimensions=config.embedding_dimensions,
     )
-    scale_factor = 0.8
+    # with a cache, only texts missing from it are embedded, keyed by their cache
+    # key, into a scratch directory; the output is then written from the cache
+    save_path = out_path
+    id_key = "item_id"
+    if cache is not None:
+        save_path = out_path.with_name(out_path.name + "_new")
+        id_key = "cache_key"
+
+    # the config limits are only a starting point, the processor retunes them
+    # from the rate limit headers of the API's responses
     run_api_request_processor(
         requests_filepath=jobs_path,
-        save_filepath=out_path,
+        save_filepath=save_path,
         request_url=config.url.embedding,
-        max_requests_per_minute=int(
-            scale_factor * config.limits.requests_per_minute.text_embedding_3_small
-        ),
-        max_tokens_per_minute=int(
-            scale_factor * config.limits.tokens_per_minute.text_embedding_3_small
-        ),
+        max_requests_per_minute=config.limits.requests_per_minute.text_embedding_3_small,
+        max_tokens_per_minute=config.limits.tokens_per_minute.text_embedding_3_small,
         token_encoding_name=config.token_encoding.text_embedding_3_small,
         max_attempts=config.max_attempts,
         logging_level=config.logging_level,
+        resume_key=id_key if resume else None,
+        embedding_output=config.embedding_output.format,
+        embedding_id_key=id_key,
+        embedding_shard_size=config.embedding_output.shard_size,
+        max_inputs_per_request=config.embedding_packing.max_inputs_per_request,
+        max_tokens_per_request=config.embedding_packing.max_tokens_per_request,
+        endpoints=config.embedding_endpoints,
     )
+    if cache is None:
+        return []
+
+    with cache:
+        cache.add_shards(save_path, id_key="cache_key")
+        shutil.rmtree(save_path)
+        return write_embeddings_from_cache(
+            ids=rows["item_id"].tolist(),
+            keys=rows["cache_key"].tolist(),
+            cache=cache,
+            out_dir=out_path,
+            id_key="item_id",
+            output_format=config.embedding_output.format,
+            shard_size=config.embedding_output.shard_size,
+        )
 
 
 def main():
@@ -61,6 +101,10 @@ if __name__ == "__main__":
         "dataset/c4-raw-meta-filtered_2024-Aug-20_20-44-50/sampled_item_metadata_1M_filtered.jsonl"
     )
     jobs_path = Path("requests.jsonl")
-    out_path = Path("embeddings_out.jsonl")
-    df = pd.read_json(dataset_path, lines=True)
-    get_product_embeddings(df, jobs_path, out_path, config)
+    # embeddings are written straight into parquet shards, ready for top-k.py
+    out_path = Path("dataset/embeddings")
+    # read in chunks, so the job builder streams the catalog instead of holding it all
+    df = pd.read_json(dataset_path, lines=True, chunksize=100_000)
+    # resume picks up where a crashed run left off instead of re-embedding everything;
+    # a fresh run has nothing to resume from and starts from scratch
+    get_product_embeddings(df, jobs_path, out_path, config, resume=True)
@@ -0,0 +1,126 @@
+"""
+EMBEDDING CACHE
+
+A persistent, content-addressed store of embeddings in a local SQLite file, so a text
+is only ever sent to the API once.
+
+Embeddings are keyed by a hash of (model, dimensions, input text), where the input is
+the text as it is sent, i.e. after truncation to the context length. Identical titles
+and descriptions shared by several products, and products embedded by an earlier run,
+map to the same key.
+
+How it is used by embed_products.py:
+- `create_embedding_jobs(..., cache=cache)` writes jobs only for keys missing from the
+  cache, once per key, and returns the key of every row
+- the request processor embeds those jobs into shards with the key as their id
+- `cache.add_shards(...)` stores the new embeddings
+- `write_embeddings_from_cache(...)` writes the embeddings of all rows, in row order
+"""
+
+import hashlib
+import json
+import sqlite3
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from scripts.api_request_parallel_processor import iter_embedding_shards
+
+
+def embedding_cache_key(model: str, input: str, dimensions: int = None) -> str:
+    """Hash of what determines an embedding: the model, its dimensions and the input text."""
+    payload = json.dumps([model, dimensions, input], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    num_rows: int = 0
+    num_hits: int = 0  # embedded by an earlier run
+    num_duplicates: int = 0  # same text as an earlier row of this run
+    num_misses: int = 0  # sent to the API
+
+    @property
+    def hit_rate(self) -> float:
+        return (self.num_hits + self.num_duplicates) / max(1, self.num_rows)
+
+    def __str__(self) -> str:
+        return (
+            f"{self.num_rows} rows: {self.num_hits} cached, {self.num_duplicates} duplicates, "
+            f"{self.num_misses} to embed ({self.hit_rate:.1%} hit rate)"
+        )
+
+
+class EmbeddingCache:
+    """Embeddings by cache key, stored as float32 blobs in SQLite."""
+
+    query_chunk_size = 500  # keys per query, below SQLite's limit on bound parameters
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        # WAL keeps reads fast while a batch of new embeddings is committed
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, dimensions INTEGER NOT NULL, vector BLOB NOT NULL) "
+            "WITHOUT ROWID"
+        )
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def __enter__(self) -> "EmbeddingCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _select(self, columns: str, keys: List[str]):
+        for start in range(0, len(keys), self.query_chunk_size):
+            chunk = keys[start : start + self.query_chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            yield from self.connection.execute(
+                f"SELECT {columns} FROM embeddings WHERE key IN ({placeholders})", chunk
+            )
+
+    def contains_many(self, keys: Iterable[str]) -> set:
+        """The subset of `keys` that are in the cache."""
+        return {row[0] for row in self._select("key", list(keys))}
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        """Embeddings of the cached keys among `keys`; missing keys are left out."""
+        return {
+            key: np.frombuffer(vector, dtype="<f4")
+            for key, vector in self._select("key, vector", list(keys))
+        }
+
+    def put_many(self, items: Iterable[Tuple[str, np.ndarray]]) -> int:
+        """Store (key, embedding) pairs; returns how many were stored."""
+        rows = [
+            (key, len(vector), np.asarray(vector, dtype="<f4").tobytes())
+            for key, vector in items
+        ]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, dimensions, vector) VALUES (?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def add_shards(self, directory: Path, id_key: str = "cache_key") -> int:
+        """Store the embeddings of a directory of processor shards whose ids are cache keys."""
+        num_added = 0
+        if not Path(directory).is_dir():
+            return num_added
+        for keys, vectors in iter_embedding_shards(str(directory), id_key=id_key):
+            num_added += self.put_many(zip(keys, vectors))
+        return num_added
@@ -0,0 +1,298 @@
+"""
+EMBEDDING STORE
+
+All product embeddings as one contiguous, memory-mapped matrix, with an item id <-> row
+index, so search code can read any rows without loading or concatenating shards.
+
+A store is a directory of .npy files:
+- vectors.npy: (num_items, dimensions) float32, float16 or int8 matrix
+- scales.npy: for int8, the scale of each dimension (scalar quantization)
+- ids.npy: the item id of each row
+- sorted_ids.npy, id_order.npy: the ids in sorted order and their rows, for
+  vectorized id lookups
+- store.json: row count, dimensions, dtype and the shards it was built from
+
+Stores can L2-normalize the vectors as they are built (`normalize=True`), for
+cosine / inner product search. float16 halves the memory of float32 and int8 quarters
+it: each dimension is scaled by its largest absolute value to [-127, 127] and rounded.
+Reads (`get`, `get_range`) always return float32 (or the dtype asked for).
+
+`dimensions=256` (or 512, ...) keeps only the first dimensions of each vector and
+renormalizes them. text-embedding-3 models are trained so that such a prefix is a
+usable embedding on its own (Matryoshka representation learning), so a reduced store
+can back a small first-stage index whose shortlists are re-ranked with the full
+vectors, see `RerankingSearcher` in ann_index.py.
+
+It is built once from the embedding shards written by the request processor
+(`EmbeddingStore.build`), then opened in milliseconds: opening maps the files, and
+only the rows that are read are paged in. Processes that open the same store share
+its pages through the OS page cache; a store passed to a worker process is pickled
+as its directory and mapped again there, without copying the matrix.
+
+Example:
+```
+store = EmbeddingStore.build("dataset/embeddings", "dataset/embedding_store", id_key="item_id")
+vectors = store.get([5, 17, 1_000_042])  # float32, one row per index
+vectors = store.get_by_ids(["B000FQ9QVI", "B07XJ8C8F5"])
+```
+"""
+
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Iterable, Union
+
+import numpy as np
+from loguru import logger
+from numpy.typing import ArrayLike, NDArray
+
+from scripts.api_request_parallel_processor import (
+    embedding_shard_names,
+    iter_embedding_shards,
+)
+
+
+class EmbeddingStore:
+    """A memory-mapped embedding matrix with an item id <-> row index."""
+
+    dtypes = ("float32", "float16", "int8")
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        with open(self.directory / "store.json", "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.vectors = np.load(self.directory / "vectors.npy", mmap_mode="r")
+        self.ids = np.load(self.directory / "ids.npy", mmap_mode="r")
+        self._sorted_ids = np.load(self.directory / "sorted_ids.npy", mmap_mode="r")
+        self._id_order = np.load(self.directory / "id_order.npy", mmap_mode="r")
+        self.scales = None
+        if self.vectors.dtype == np.int8:
+            self.scales = np.load(self.directory / "scales.npy")
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    def __reduce__(self):
+        # worker processes map the files again instead of receiving a copy of them
+        return (self.__class__, (self.directory,))
+
+    @property
+    def dimensions(self) -> int:
+        return self.vectors.shape[1]
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.vectors.dtype
+
+    def get(self, rows: ArrayLike, dtype: str = "float32") -> NDArray:
+        """The vectors of `rows`, in the order given, as a new (len(rows), dimensions) array."""
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((len(rows), self.dimensions), dtype=dtype)
+        # reading in row order turns random page faults into mostly sequential reads
+        order = np.argsort(rows, kind="stable")
+        out[order] = self.vectors[rows[order]]
+        if self.scales is not None:
+            out *= self.scales
+        return out
+
+    def get_range(self, start: int, end: int, dtype: str = "float32") -> NDArray:
+        """Rows [start, end) as an array of `dtype`; no copy if it is the stored dtype."""
+        vectors = np.asarray(self.vectors[start:end], dtype=dtype)
+        if self.scales is not None:
+            vectors = vectors * self.scales.astype(dtype)
+        return vectors
+
+    def rows_for_ids(self, ids: Iterable) -> NDArray:
+        """Row index of each of `ids`; raises KeyError for ids that are not in the store."""
+        ids = np.asarray(list(ids) if not isinstance(ids, np.ndarray) else ids)
+        positions = np.searchsorted(self._sorted_ids, ids)
+        positions = np.minimum(positions, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[positions] == ids
+        if not found.all():
+            missing = ids[~found]
+            raise KeyError(
+                f"{len(missing)} ids are not in the store, e.g. {missing[:5].tolist()}"
+            )
+        return np.asarray(self._id_order[positions])
+
+    def get_by_ids(self, ids: Iterable, dtype: str = "float32") -> NDArray:
+        return self.get(self.rows_for_ids(ids), dtype=dtype)
+
+    @classmethod
+    def build(
+        cls,
+        shards_dir: Union[str, Path],
+        directory: Union[str, Path],
+        id_key: str = "id",
+        dtype: str = "float32",
+        normalize: bool = False,
+        dimensions: int = None,
+    ) -> "EmbeddingStore":
+        """
+        Build a store from a directory of embedding shards (npy or parquet, see
+        `EmbeddingShardWriter`), in shard order.
+
+        Shards are copied one at a time into a preallocated memory-mapped matrix,
+        so memory is bounded by one shard (int8 reads the shards twice, first for
+        the scales). The store is written to a temporary directory and renamed, so
+        `directory` is either complete or missing.
+        """
+        if dtype not in cls.dtypes:
+            raise ValueError(
+                f'Unknown store dtype "{dtype}", expected one of {cls.dtypes}'
+            )
+        shards_dir = Path(shards_dir)
+        directory = Path(directory)
+        num_rows, source_dimensions = _count_shard_rows(shards_dir)
+        if num_rows == 0:
+            raise ValueError(f"No embedding shards in {shards_dir}")
+        truncated_to = dimensions
+        truncate = dimensions is not None and dimensions < source_dimensions
+        if not truncate:
+            dimensions = source_dimensions
+
+        def prepare(shard_vectors: NDArray) -> NDArray:
+            if truncate:
+                # a prefix of a unit vector is not one; renormalize it
+                return normalize_rows(shard_vectors[:, :dimensions])
+            return normalize_rows(shard_vectors) if normalize else shard_vectors
+
+        started_at = time.perf_counter()
+        temporary_dir = directory.with_name(directory.name + ".tmp")
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        temporary_dir.mkdir(parents=True)
+        scales = None
+        if dtype == "int8":
+            max_abs = np.zeros(dimensions, dtype=np.float32)
+            for _, shard_vectors in iter_embedding_shards(str(shards_dir), id_key=id_key):
+                shard_vectors = prepare(shard_vectors)
+                np.maximum(max_abs, np.abs(shard_vectors).max(axis=0), out=max_abs)
+            scales = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32)
+            np.save(temporary_dir / "scales.npy", scales)
+        vectors = np.lib.format.open_memmap(
+            temporary_dir / "vectors.npy",
+            mode="w+",
+            dtype=dtype,
+            shape=(num_rows, dimensions),
+        )
+        ids = []
+        shards = iter_embedding_shards(str(shards_dir), id_key=id_key)
+        for shard_ids, shard_vectors in shards:
+            shard_vectors = prepare(shard_vectors)
+            if scales is not None:
+                shard_vectors = np.clip(np.rint(shard_vectors / scales), -127, 127)
+            vectors[len(ids) : len(ids) + len(shard_ids)] = shard_vectors
+            ids.extend(shard_ids)
+        vectors.flush()
+        del vectors
+
+        ids = np.asarray(ids)
+        if ids.dtype == object:
+            ids = ids.astype(str)  # mixed or missing ids; keeps the file loadable without pickle
+        np.save(temporary_dir / "ids.npy", ids)
+        id_order = np.argsort(ids, kind="stable")
+        sorted_ids = ids[id_order]
+        if (sorted_ids[1:] == sorted_ids[:-1]).any():
+            logger.warning(
+                f"Duplicate ids in {shards_dir}; lookups return the first of their rows"
+            )
+        np.save(temporary_dir / "sorted_ids.npy", sorted_ids)
+        np.save(temporary_dir / "id_order.npy", id_order)
+        with open(temporary_dir / "store.json", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "num_rows": num_rows,
+                    "dimensions": dimensions,
+                    "source_dimensions": source_dimensions,
+                    "dtype": dtype,
+                    "normalize": normalize,
+                    "truncated_to": truncated_to,
+                    "id_key": id_key,
+                    "shards_dir": str(shards_dir),
+                    "shards": shard_fingerprints(shards_dir),
+                },
+                f,
+                indent=2,
+            )
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temporary_dir, directory)
+        logger.info(
+            f"Built a {num_rows} x {dimensions} {dtype} embedding store in {directory} "
+            f"from {shards_dir} in {time.perf_counter() - started_at:.1f}s"
+        )
+        return cls(directory)
+
+    @classmethod
+    def open_or_build(
+        cls,
+        shards_dir: Union[str, Path],
+        directory: Union[str, Path],
+        id_key: str = "id",
+        dtype: str = "float32",
+        normalize: bool = False,
+        dimensions: int = None,
+    ) -> "EmbeddingStore":
+        """Open the store in `directory`, building it first if it is missing or its shards changed."""
+        directory = Path(directory)
+        if (directory / "store.json").exists():
+            store = cls(directory)
+            options = {
+                "dtype": dtype,
+                "normalize": normalize,
+                "truncated_to": dimensions,
+                "id_key": id_key,
+            }
+            built_with = {key: store.manifest.get(key) for key in options}
+            shards = shard_fingerprints(Path(shards_dir))
+            if built_with == options and store.manifest["shards"] == shards:
+                return store
+            logger.info(
+                f"{directory} is out of date with {shards_dir} or the options, rebuilding"
+            )
+        return cls.build(
+            shards_dir,
+            directory,
+            id_key=id_key,
+            dtype=dtype,
+            normalize=normalize,
+            dimensions=dimensions,
+        )
+
+
+def normalize_rows(vectors: NDArray) -> NDArray:
+    """Scale each row to unit L2 norm (rows of zeros are left as they are)."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def shard_fingerprints(shards_dir: Path) -> dict:
+    """Size and mtime of each embedding shard file, to tell when a store is out of date."""
+    fingerprints = {}
+    for output_format in ("npy", "parquet"):
+        suffix = ".npy" if output_format == "npy" else ".parquet"
+        for name in embedding_shard_names(str(shards_dir), output_format):
+            stat = (shards_dir / (name + suffix)).stat()
+            fingerprints[name + suffix] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprints
+
+
+def _count_shard_rows(shards_dir: Path):
+    """Total rows and dimensions of the shards in a directory, read from their headers only."""
+    num_rows = 0
+    dimensions = 0
+    for name in embedding_shard_names(str(shards_dir), "npy"):
+        shape = np.load(shards_dir / (name + ".npy"), mmap_mode="r").shape
+        num_rows += shape[0]
+        dimensions = shape[1]
+    parquet_names = embedding_shard_names(str(shards_dir), "parquet")
+    if parquet_names:
+        import pyarrow.parquet as pq
+
+        for name in parquet_names:
+            parquet_file = pq.ParquetFile(shards_dir / (name + ".parquet"))
+            num_rows += parquet_file.metadata.num_rows
+            embedding_type = parquet_file.schema_arrow.field("embedding").type
+            dimensions = embedding_type.list_size
+    return num_rows, dimensions
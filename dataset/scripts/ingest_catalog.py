@@ -0,0 +1,276 @@
+"""
+CATALOG INGESTION
+
+Converts every pending Amazon Reviews 2023 meta file (*.jsonl.gz) in a directory to
+parquet shards, one file per worker process, so converting the full metadata dump
+scales with the number of cores.
+
+Each input file becomes shards of `rows_per_shard` lines, named
+{file name without .jsonl.gz}-00000.parquet, -00001.parquet, ...; a shard is written
+under a temporary name and renamed, so it is either complete or missing.
+
+A manifest.json in the output directory records, per input file, its size and mtime
+(and optionally a content hash), the shards written, how long it took, and what
+became of its lines: rows, blank lines, bad lines (not JSON) and skipped records (a
+value that conflicts with the column's type). A file is "done" only when these add
+up to the lines read.
+
+The schema is inferred and widens as records need it: a column that is all null in
+one shard gets the type later shards find, so an early shard can have a null-typed
+column that later ones type. Read the shards with a unified schema, e.g. the
+`pa.unify_schemas(schemas, promote_options="permissive")` of their schemas.
+On a re-run:
+- files whose fingerprint matches a finished entry are skipped
+- files that were being converted when a run stopped resume after their last
+  complete shard
+- files that changed since they were converted are converted again from scratch
+
+Per-file throughput (rows/s and compressed MB/s) is logged as each file finishes.
+
+Example command:
+```
+cd dataset
+python -m scripts.ingest_catalog \
+  --input_dir ~/Datasets/Amazon_Reviews_23/meta_data \
+  --output_dir ~/Datasets/Amazon_Reviews_23/meta_parquet \
+  --num_workers 8
+```
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pyarrow.parquet as pq
+from loguru import logger
+
+from scripts.utils import (
+    iter_jsonl_lines,
+    parse_jsonl_lines,
+    records_to_table,
+    widen_schema,
+)
+
+MANIFEST_NAME = "manifest.json"
+# what became of the lines of an input file, recorded per shard and per file
+LINE_COUNTS = ("lines", "rows", "blank_lines", "bad_lines", "skipped_records")
+
+
+def file_fingerprint(path: Path, hash_contents: bool = False) -> dict:
+    """What identifies a version of an input file: size and mtime, and optionally a hash of its bytes."""
+    stat = path.stat()
+    fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if hash_contents:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(16 * 1024**2), b""):
+                digest.update(block)
+        fingerprint["blake2b"] = digest.hexdigest()
+    return fingerprint
+
+
+def load_manifest(output_dir: Path) -> dict:
+    manifest_path = output_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(output_dir: Path, manifest: dict) -> None:
+    manifest_path = output_dir / MANIFEST_NAME
+    temporary_path = manifest_path.with_name(MANIFEST_NAME + ".tmp")
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temporary_path, manifest_path)
+
+
+def shard_stem(path: Path) -> str:
+    return path.name.removesuffix(".gz").removesuffix(".jsonl")
+
+
+def existing_shards(output_dir: Path, stem: str) -> list[Path]:
+    """Complete shards of one input file, in order."""
+    return sorted(output_dir.glob(f"{stem}-[0-9][0-9][0-9][0-9][0-9].parquet"))
+
+
+def ingest_file(
+    path: Path,
+    output_dir: Path,
+    rows_per_shard: int = 500_000,
+) -> dict:
+    """
+    Convert one .jsonl.gz file to parquet shards, resuming after the shards already there.
+
+    Runs in a worker process. Returns what the manifest records about the file,
+    apart from its fingerprint. Each shard's schema metadata holds the counts of
+    its lines, so a resumed file still accounts for every line: the status is
+    "done" only if each line became a row, or is counted as blank, bad (not
+    JSON) or skipped (a record that conflicts with the schema).
+    """
+    started_at = time.perf_counter()
+    stem = shard_stem(path)
+    shards = existing_shards(output_dir, stem)
+    counts = dict.fromkeys(LINE_COUNTS, 0)
+    schemas = [pq.read_schema(shard) for shard in shards]
+    if any(b"line_counts" not in (schema.metadata or {}) for schema in schemas):
+        logger.info(f"{path.name}: shards without line counts, converting it again")
+        for shard in shards:
+            shard.unlink()
+        shards, schemas = [], []
+    # each shard starts from the schema of the shards before it, widened as its
+    # records need (see records_to_table), so later shards are never narrower
+    schema = None
+    for shard_schema in schemas:
+        for key, value in json.loads(shard_schema.metadata[b"line_counts"]).items():
+            counts[key] += value
+        schema = shard_schema if schema is None else widen_schema(schema, shard_schema)
+    num_resumed_shards = len(shards)
+
+    file_lines = iter_jsonl_lines(path)
+    # lines of the shards written by an earlier run are only split, not parsed
+    skipped = sum(1 for _ in itertools.islice(file_lines, len(shards) * rows_per_shard))
+    line_number = skipped + 1
+    while True:
+        shard_lines = list(itertools.islice(file_lines, rows_per_shard))
+        if not shard_lines:
+            break
+        records, num_bad = parse_jsonl_lines(shard_lines, path, line_number)
+        line_number += len(shard_lines)
+        table, num_skipped = records_to_table(records, schema)
+        schema = table.schema
+        shard_counts = {
+            "lines": len(shard_lines),
+            "rows": table.num_rows,
+            "blank_lines": len(shard_lines) - len(records) - num_bad,
+            "bad_lines": num_bad,
+            "skipped_records": num_skipped,
+        }
+        for key, value in shard_counts.items():
+            counts[key] += value
+
+        shard_path = output_dir / f"{stem}-{len(shards):05d}.parquet"
+        temporary_path = shard_path.with_name(shard_path.name + ".tmp")
+        table = table.replace_schema_metadata({"line_counts": json.dumps(shard_counts)})
+        pq.write_table(table, temporary_path)
+        os.replace(temporary_path, shard_path)
+        shards.append(shard_path)
+
+    unaccounted = counts["lines"] - sum(
+        counts[key] for key in LINE_COUNTS if key != "lines"
+    )
+    if unaccounted:
+        logger.error(f"{path.name}: {unaccounted} lines are neither rows nor counted")
+    seconds = time.perf_counter() - started_at
+    return {
+        "status": "incomplete" if unaccounted else "done",
+        "rows_per_shard": rows_per_shard,
+        **counts,
+        "shards": [shard.name for shard in shards],
+        "resumed_shards": num_resumed_shards,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round((line_number - 1 - skipped) / max(seconds, 1e-9), 1),
+        "megabytes_per_second": round(
+            path.stat().st_size / 1024**2 / max(seconds, 1e-9), 2
+        ),
+    }
+
+
+def ingest_catalog(
+    input_dir: Path,
+    output_dir: Path,
+    num_workers: int = None,
+    rows_per_shard: int = 500_000,
+    hash_contents: bool = False,
+) -> dict:
+    """Convert all pending *.jsonl.gz files of `input_dir` across a process pool; returns the manifest."""
+    assert input_dir.exists(), FileNotFoundError("Dataset dir does not exist!")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(output_dir)
+
+    pending = []
+    for path in sorted(input_dir.glob("*.jsonl.gz")):
+        fingerprint = file_fingerprint(path, hash_contents)
+        entry = manifest.get(path.name)
+        unchanged = (
+            entry is not None
+            and all(entry.get(key) == value for key, value in fingerprint.items())
+            and entry.get("rows_per_shard") == rows_per_shard
+        )
+        if unchanged and entry["status"] == "done":
+            continue
+        if not unchanged:
+            # new or changed since its shards were written: start over
+            for shard in existing_shards(output_dir, shard_stem(path)):
+                shard.unlink()
+        manifest[path.name] = {
+            **fingerprint,
+            "status": "in_progress",
+            "rows_per_shard": rows_per_shard,
+        }
+        pending.append(path)
+    save_manifest(output_dir, manifest)
+    logger.info(
+        f"{len(pending)} of {len(manifest)} meta files to convert in {input_dir}"
+    )
+    if not pending:
+        return manifest
+
+    # biggest files first, so one large file does not start last and finish alone
+    pending.sort(key=lambda path: path.stat().st_size, reverse=True)
+    started_at = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = {
+            pool.submit(ingest_file, path, output_dir, rows_per_shard): path
+            for path in pending
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Failed to convert {path}: {e}")
+                continue
+            manifest[path.name].update(result)
+            save_manifest(output_dir, manifest)
+            logger.info(
+                f"{path.name}: {result['rows']} rows in {len(result['shards'])} shards, "
+                f"{result['bad_lines']} bad lines, "
+                f"{result['skipped_records']} records skipped, "
+                f"{result['seconds']:.1f}s ({result['rows_per_second']:.0f} rows/s, "
+                f"{result['megabytes_per_second']:.1f} MB/s compressed)"
+            )
+
+    num_failed = sum(manifest[path.name]["status"] != "done" for path in pending)
+    logger.info(
+        f"Converted {len(pending) - num_failed} files in {time.perf_counter() - started_at:.1f}s"
+        + (f", {num_failed} failed (they resume on the next run)" if num_failed else "")
+    )
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_dir", required=True)
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--rows_per_shard", type=int, default=500_000)
+    parser.add_argument(
+        "--hash_contents",
+        action="store_true",
+        help="also compare a hash of each input file, not just its size and mtime",
+    )
+    args = parser.parse_args()
+
+    ingest_catalog(
+        input_dir=Path(args.input_dir).expanduser(),
+        output_dir=Path(args.output_dir).expanduser(),
+        num_workers=args.num_workers,
+        rows_per_shard=args.rows_per_shard,
+        hash_contents=args.hash_contents,
+    )
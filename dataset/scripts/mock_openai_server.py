@@ -0,0 +1,319 @@
+"""
+MOCK OPENAI SERVER
+
+A local stand-in for the OpenAI `/v1/embeddings` and `/v1/chat/completions` endpoints,
+for measuring `api_request_parallel_processor.py` without spending API quota.
+
+It behaves like the real API where it matters for throughput:
+- Responses take a configurable, random amount of time (constant, uniform or lognormal latency)
+- Requests and tokens per minute are enforced with token buckets; over the limit it answers
+  429 with a rate limit error, like the real API
+- Every response carries x-ratelimit-limit-*, x-ratelimit-remaining-* and x-ratelimit-reset-* headers
+- A configurable fraction of requests fail with a random 5xx error
+- Embedding requests may use a list `input`, `encoding_format="base64"` and `dimensions`
+
+Tokens are estimated as one per 4 characters, so the server does not need tiktoken.
+Counters of what was served are available at GET /mock/stats, including the latency
+requests were given and how long the server really took, which tells when the server
+itself is the bottleneck.
+
+Example command to run the server:
+```
+cd dataset
+python -m scripts.mock_openai_server \
+  --port 8080 \
+  --requests_per_minute 3000 \
+  --tokens_per_minute 1000000 \
+  --latency lognormal \
+  --latency_mean_seconds 0.3 \
+  --server_error_rate 0.01
+```
+and point the processor at it with `--request_url http://127.0.0.1:8080/v1/embeddings`.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import struct
+import time
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+
+@dataclass
+class MockServerConfig:
+    requests_per_minute: float = 3_000
+    tokens_per_minute: float = 1_000_000
+    latency: str = "lognormal"  # "constant", "uniform" or "lognormal"
+    latency_mean_seconds: float = 0.3
+    latency_sigma: float = 0.5  # spread of the lognormal latency
+    server_error_rate: float = 0.0  # fraction of requests answered with a 5xx error
+    embedding_dimensions: int = 1536
+    seed: int = None
+
+
+@dataclass
+class MockServerStats:
+    num_requests: int = 0
+    num_succeeded: int = 0
+    num_rate_limited: int = 0
+    num_server_errors: int = 0
+    num_inputs_embedded: int = 0
+    num_tokens_accepted: int = 0
+    # requests that got past the rate limit: the latency they were given, and how
+    # long the server actually took to answer them (more if the server is the
+    # bottleneck, e.g. its event loop is saturated)
+    num_timed: int = 0
+    configured_latency_seconds: float = 0.0
+    served_latency_seconds: float = 0.0
+    started_at: float = field(default_factory=time.time)
+
+
+class RateLimitBucket:
+    """Requests and tokens per minute, refilling continuously, as the API enforces them."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.remaining_requests = requests_per_minute
+        self.remaining_tokens = tokens_per_minute
+        self.last_update_time = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_update_time) / 60.0
+        self.remaining_requests = min(
+            self.requests_per_minute,
+            self.remaining_requests + self.requests_per_minute * elapsed_minutes,
+        )
+        self.remaining_tokens = min(
+            self.tokens_per_minute,
+            self.remaining_tokens + self.tokens_per_minute * elapsed_minutes,
+        )
+        self.last_update_time = now
+
+    def try_consume(self, num_tokens: int) -> bool:
+        self._refill()
+        if self.remaining_requests < 1 or self.remaining_tokens < num_tokens:
+            return False
+        self.remaining_requests -= 1
+        self.remaining_tokens -= num_tokens
+        return True
+
+    def headers(self) -> dict:
+        """Rate limit headers in the API's format; resets are the time until the bucket is full."""
+        seconds_to_reset_requests = (
+            (self.requests_per_minute - self.remaining_requests)
+            * 60.0
+            / self.requests_per_minute
+        )
+        seconds_to_reset_tokens = (
+            (self.tokens_per_minute - self.remaining_tokens)
+            * 60.0
+            / self.tokens_per_minute
+        )
+        return {
+            "x-ratelimit-limit-requests": str(int(self.requests_per_minute)),
+            "x-ratelimit-limit-tokens": str(int(self.tokens_per_minute)),
+            "x-ratelimit-remaining-requests": str(int(self.remaining_requests)),
+            "x-ratelimit-remaining-tokens": str(int(self.remaining_tokens)),
+            "x-ratelimit-reset-requests": format_duration(seconds_to_reset_requests),
+            "x-ratelimit-reset-tokens": format_duration(seconds_to_reset_tokens),
+        }
+
+
+def format_duration(seconds: float) -> str:
+    """Format seconds the way the API formats reset durations, e.g. "20ms", "1.5s" or "6m0s"."""
+    if seconds < 1:
+        return f"{int(seconds * 1000)}ms"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes:
+        return f"{int(minutes)}m{seconds:.0f}s"
+    return f"{seconds:.3g}s"
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def create_app(config: MockServerConfig) -> web.Application:
+    """Create the mock server application; its stats are at app["stats"]."""
+    rng = random.Random(config.seed)
+    bucket = RateLimitBucket(config.requests_per_minute, config.tokens_per_minute)
+    stats = MockServerStats()
+    # one vector is reused for every input, and encoded to JSON once per dimensions
+    # and encoding format: formatting 1536 floats per input would make the server,
+    # not the processor, the bottleneck of a benchmark
+    vector = [rng.uniform(-0.1, 0.1) for _ in range(config.embedding_dimensions)]
+    vectors_by_dimensions = {}
+
+    def embedding_json(dimensions: int, encoding_format: str) -> bytes:
+        """The vector, shortened to `dimensions` and renormalized like the API does, as JSON."""
+        key = (dimensions, encoding_format == "base64")
+        if key not in vectors_by_dimensions:
+            prefix = vector[:dimensions]
+            norm = sum(x * x for x in prefix) ** 0.5 or 1.0
+            prefix = [x / norm for x in prefix] if dimensions < len(vector) else prefix
+            if encoding_format == "base64":
+                packed = struct.pack(f"<{len(prefix)}f", *prefix)
+                prefix = base64.b64encode(packed).decode()
+            vectors_by_dimensions[key] = json.dumps(prefix).encode()
+        return vectors_by_dimensions[key]
+
+    def sample_latency() -> float:
+        if config.latency == "constant":
+            return config.latency_mean_seconds
+        if config.latency == "uniform":
+            return rng.uniform(0, 2 * config.latency_mean_seconds)
+        # lognormal with the requested mean
+        mu = -(config.latency_sigma**2) / 2
+        return config.latency_mean_seconds * rng.lognormvariate(mu, config.latency_sigma)
+
+    async def admit(num_tokens: int):
+        """Return an error response if the request is over the limits or fails, else None."""
+        stats.num_requests += 1
+        if not bucket.try_consume(num_tokens):
+            stats.num_rate_limited += 1
+            exhausted = "requests" if bucket.remaining_requests < 1 else "tokens"
+            return web.json_response(
+                {
+                    "error": {
+                        "message": f"Rate limit reached for {exhausted} per min (mock).",
+                        "type": exhausted,
+                        "code": "rate_limit_exceeded",
+                    }
+                },
+                status=429,
+                headers=bucket.headers(),
+            )
+        latency = sample_latency()
+        stats.configured_latency_seconds += latency
+        await asyncio.sleep(latency)
+        if rng.random() < config.server_error_rate:
+            stats.num_server_errors += 1
+            return web.json_response(
+                {"error": {"message": "The server had an error (mock).", "type": "server_error"}},
+                status=rng.choice([500, 502, 503]),
+                headers=bucket.headers(),
+            )
+        return None
+
+    async def embeddings(request: web.Request) -> web.Response:
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        num_tokens = sum(estimate_tokens(text) for text in inputs)
+        error = await admit(num_tokens)
+        if error is not None:
+            return error
+        embedding = embedding_json(
+            body.get("dimensions") or len(vector), body.get("encoding_format")
+        )
+        stats.num_succeeded += 1
+        stats.num_inputs_embedded += len(inputs)
+        stats.num_tokens_accepted += num_tokens
+        # the response of web.json_response, assembled from the pre-encoded vector
+        data = b", ".join(
+            b'{"object": "embedding", "index": %d, "embedding": %b}' % (i, embedding)
+            for i in range(len(inputs))
+        )
+        usage = {"prompt_tokens": num_tokens, "total_tokens": num_tokens}
+        payload = b'{"object": "list", "data": [%b], "model": %b, "usage": %b}' % (
+            data,
+            json.dumps(body.get("model")).encode(),
+            json.dumps(usage).encode(),
+        )
+        return web.Response(
+            body=payload, content_type="application/json", headers=bucket.headers()
+        )
+
+    async def chat_completions(request: web.Request) -> web.Response:
+        body = await request.json()
+        prompt_tokens = sum(
+            estimate_tokens(str(message.get("content", "")))
+            for message in body["messages"]
+        )
+        completion_tokens = body.get("max_tokens", 15)
+        error = await admit(prompt_tokens + completion_tokens)
+        if error is not None:
+            return error
+        stats.num_succeeded += 1
+        stats.num_tokens_accepted += prompt_tokens + completion_tokens
+        return web.json_response(
+            {
+                "id": f"chatcmpl-mock-{stats.num_requests}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "mock " * 5},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+            headers=bucket.headers(),
+        )
+
+    async def mock_stats(request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                **stats.__dict__,
+                "elapsed_seconds": time.time() - stats.started_at,
+                "requests_per_minute_limit": config.requests_per_minute,
+                "tokens_per_minute_limit": config.tokens_per_minute,
+            }
+        )
+
+    @web.middleware
+    async def time_requests(request: web.Request, handler) -> web.Response:
+        received_at = time.monotonic()
+        response = await handler(request)
+        if request.method == "POST" and response.status != 429:
+            stats.num_timed += 1
+            stats.served_latency_seconds += time.monotonic() - received_at
+        return response
+
+    app = web.Application(client_max_size=64 * 1024**2, middlewares=[time_requests])
+    app["stats"] = stats
+    app.router.add_post("/v1/embeddings", embeddings)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/mock/stats", mock_stats)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--requests_per_minute", type=float, default=3_000)
+    parser.add_argument("--tokens_per_minute", type=float, default=1_000_000)
+    parser.add_argument(
+        "--latency", choices=["constant", "uniform", "lognormal"], default="lognormal"
+    )
+    parser.add_argument("--latency_mean_seconds", type=float, default=0.3)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--server_error_rate", type=float, default=0.0)
+    parser.add_argument("--embedding_dimensions", type=int, default=1536)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config = MockServerConfig(
+        requests_per_minute=args.requests_per_minute,
+        tokens_per_minute=args.tokens_per_minute,
+        latency=args.latency,
+        latency_mean_seconds=args.latency_mean_seconds,
+        latency_sigma=args.latency_sigma,
+        server_error_rate=args.server_error_rate,
+        embedding_dimensions=args.embedding_dimensions,
+        seed=args.seed,
+    )
+    web.run_app(create_app(config), host=args.host, port=args.port)
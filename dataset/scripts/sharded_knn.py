@@ -0,0 +1,165 @@
+"""
+SHARDED K-NN
+
+Exact k nearest neighbor search over an `EmbeddingStore` that does not need the whole
+matrix in RAM, and that scales with the number of cores.
+
+The database rows are split into shards of `shard_rows` rows. For each batch of
+queries, a pool of worker processes searches the shards in parallel (`faiss.knn`,
+one thread per worker), each reading only its shard from the memory-mapped store; the
+per-shard top-k lists are then merged with one vectorized partition and sort
+(`merge_top_k`). Queries reach the workers through shared memory, once per batch.
+
+With `metric="ip"` it ranks by inner product (cosine similarity for a store built
+with `normalize=True`), largest first. A float16 or int8 store is read back as
+float32 one shard at a time, so it moves 2-4x fewer bytes from disk or page cache.
+
+Peak memory is about num_workers * (shard size + queries x shard distances) plus the
+pages of the store the OS keeps cached, which it can evict under pressure.
+`ShardedSearcher` has the `search(queries, k)` of a faiss index, so it can be passed
+to `batch_search_and_save` in top-k.py in place of one.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Tuple
+
+import faiss
+import numpy as np
+from loguru import logger
+
+from scripts.embedding_store import EmbeddingStore
+
+_worker_store = None  # the store, mapped once per worker process
+
+
+def merge_top_k(
+    distances: List[np.ndarray],
+    indices: List[np.ndarray],
+    k: int,
+    largest: bool = False,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merge per-shard (num_queries, k_i) top-k lists into one (num_queries, k) list, nearest first.
+
+    Distances are smaller-is-nearer, or larger-is-nearer with `largest` (inner
+    products). Partitions the concatenated lists instead of sorting them, so only
+    the k survivors of each row are sorted.
+    """
+    distances = np.concatenate(distances, axis=1)
+    indices = np.concatenate(indices, axis=1)
+    keys = -distances if largest else distances
+    k = min(k, distances.shape[1])
+    top = np.argpartition(keys, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(keys, top, axis=1), axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    return (
+        np.take_along_axis(distances, top, axis=1),
+        np.take_along_axis(indices, top, axis=1),
+    )
+
+
+class ShardedSearcher:
+    """Exact k-NN over the shards of an EmbeddingStore, searched by a process pool."""
+
+    metrics = ("l2", "ip")
+
+    def __init__(
+        self,
+        store: EmbeddingStore,
+        shard_rows: int = 200_000,
+        num_workers: int = None,
+        metric: str = "l2",
+    ):
+        if metric not in self.metrics:
+            raise ValueError(f'Unknown metric "{metric}", expected one of {self.metrics}')
+        self.store = store
+        self.metric = metric
+        self.ntotal = len(store)
+        self.shards = [
+            (start, min(start + shard_rows, len(store)))
+            for start in range(0, len(store), shard_rows)
+        ]
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=_init_search_worker,
+            initargs=(store,),
+        )
+        logger.info(
+            f"Searching {self.ntotal} vectors in {len(self.shards)} shards "
+            f"of up to {shard_rows} rows with {self.num_workers} workers"
+        )
+
+    def __enter__(self) -> "ShardedSearcher":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """The k nearest rows of the store to each query, like faiss' Index.search."""
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        started_at = time.perf_counter()
+        shared_queries = shared_memory.SharedMemory(create=True, size=queries.nbytes)
+        try:
+            buffer = np.ndarray(queries.shape, queries.dtype, buffer=shared_queries.buf)
+            buffer[:] = queries
+            del buffer  # the shared memory cannot be closed while an array uses it
+            futures = [
+                self.pool.submit(
+                    _search_shard,
+                    shared_queries.name,
+                    queries.shape,
+                    start,
+                    end,
+                    k,
+                    self.metric,
+                )
+                for start, end in self.shards
+            ]
+            results = [future.result() for future in futures]
+        finally:
+            shared_queries.close()
+            shared_queries.unlink()
+        distances, indices = merge_top_k(
+            [shard_distances for shard_distances, _ in results],
+            [shard_indices for _, shard_indices in results],
+            k,
+            largest=self.metric == "ip",
+        )
+        logger.debug(
+            f"Searched {len(queries)} queries in {time.perf_counter() - started_at:.2f}s"
+        )
+        return distances, indices
+
+
+def _init_search_worker(store: EmbeddingStore) -> None:
+    global _worker_store
+    _worker_store = store
+    # the pool provides the parallelism; one thread per worker avoids oversubscription
+    faiss.omp_set_num_threads(1)
+
+
+def _search_shard(
+    shared_queries_name: str, shape: tuple, start: int, end: int, k: int, metric: str
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-k of the queries in rows [start, end) of the store; runs in a worker process."""
+    shared_queries = shared_memory.SharedMemory(name=shared_queries_name)
+    try:
+        queries = np.ndarray(shape, np.float32, buffer=shared_queries.buf)
+        distances, indices = faiss.knn(
+            queries,
+            _worker_store.get_range(start, end),
+            min(k, end - start),
+            metric=faiss.METRIC_INNER_PRODUCT if metric == "ip" else faiss.METRIC_L2,
+        )
+        del queries
+    finally:
+        shared_queries.close()
+    return distances, indices + start
@@ -1,101 +1,88 @@
+import argparse
 import json
-import math
+import os
+from dataclasses import asdict
 from pathlib import Path
 
 import faiss
 import numpy as np
-from numpy.typing import ArrayLike, NDArray
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from loguru import logger
 from tqdm.auto import tqdm
 
-
-def extract_embeddings(jsonl_file: Path, id_key: str = "id", chunk_size: int = 10000):
+from scripts.ann_index import (
+    INDEX_KINDS,
+    IndexConfig,
+    RerankingSearcher,
+    describe_index,
+    open_or_build_index,
+)
+from scripts.api_request_parallel_processor import save_embedding_shard
+from scripts.embedding_store import EmbeddingStore
+from scripts.sharded_knn import ShardedSearcher
+from scripts.utils import load_embedding_results
+
+
+def extract_embeddings(
+    jsonl_file: Path,
+    id_key: str = "id",
+    chunk_size: int = 10000,
+    num_workers: int = None,
+):
     """
     Extract embeddings from responses jsonl and chunk them
-    """
-    failed_ids = []
-
-    def save_chunk(chunk_embeddings, chunk_ids, chunk_idx):
-        df = pd.DataFrame({"embedding": chunk_embeddings, "item_id": chunk_ids})
-
-        # Define the file path for the Parquet file
-        parquet_file = f"dataset/embeddings/chunk_{chunk_idx}.parquet"
-
-        # Save the DataFrame to a Parquet file
-        df.to_parquet(parquet_file, index=False)
-
-    chunk_idx = 0
-    chunk_embeddings = []
-    chunk_ids = []
-
-    with open(jsonl_file, "r", encoding="utf-8") as file:
-        for line in file:
-            item_id = None  # Initialize id before the try block
-            try:
-                data = json.loads(line)
-                item_id = data[2][id_key]
-                embedding = data[1]["data"][0]["embedding"]
-                chunk_embeddings.append(embedding)
-                chunk_ids.append(item_id)
-
-                if len(chunk_embeddings) >= chunk_size:
-                    save_chunk(chunk_embeddings, chunk_ids, chunk_idx)
-                    chunk_idx += 1
-                    chunk_embeddings.clear()
-                    chunk_ids.clear()
-
-            except Exception as e:
-                if item_id is not None:
-                    failed_ids.append(item_id)
-                logger.warning(
-                    f"JSON loads failed for ID: {item_id}, with exception: {e}"
-                )
-
-        # Save any remaining data
-        if chunk_embeddings:
-            save_chunk(chunk_embeddings, chunk_ids, chunk_idx)
 
+    Only needed for results saved as jsonl; embed_products.py now writes the
+    parquet shards directly. The file is parsed in parallel into one float32
+    matrix (see `load_embedding_results`), which is saved as parquet shards of
+    `chunk_size` rows, each with an `item_id` and an `embedding` column.
+    """
+    ids, vectors, failed_ids = load_embedding_results(
+        jsonl_file, id_key=id_key, num_workers=num_workers
+    )
+    for chunk_idx, start in enumerate(range(0, len(ids), chunk_size)):
+        save_embedding_shard(
+            "dataset/embeddings",
+            chunk_idx,
+            ids[start : start + chunk_size],
+            vectors[start : start + chunk_size],
+            output_format="parquet",
+            id_key="item_id",
+        )
     return failed_ids
 
 
-def load_chunk(index: int) -> pd.DataFrame:
-    # Load the array from the .npy file
-    return pd.read_parquet(f"dataset/embeddings/chunk_{index}.parquet")
-
-
-def get_ids_by_indexes(indexes: list[int], df: pd.DataFrame) -> list[str]:
-    return df.iloc[indexes]["item_id"].tolist()
+def chunk_path(index: int) -> Path:
+    # shards written by the request processor or extract_embeddings, or older chunks
+    shard_path = Path(f"dataset/embeddings/shard_{index:05d}.parquet")
+    if shard_path.exists():
+        return shard_path
+    return Path(f"dataset/embeddings/chunk_{index}.parquet")
 
 
-def get_embeddings_by_indexes(indexes: ArrayLike) -> NDArray:
-    results = []
-    for index in indexes:
-        chunk_index = math.floor(index / 100_000)
-        relative_index = index - chunk_index * 100_000
-        print(chunk_index, relative_index)
-        chunk = pd.read_parquet(f"dataset/embeddings/chunk_{chunk_index}.parquet")
-        embedding = chunk.iloc[relative_index]["embedding"]
-        results.append(embedding)
-    return np.stack(results)
+def load_chunk(index: int) -> pd.DataFrame:
+    return pd.read_parquet(chunk_path(index))
 
 
-def test_random_sample(num_samples: int, df_item_ids: pd.DataFrame) -> None:
+def test_random_sample(
+    num_samples: int, store: EmbeddingStore, index: faiss.Index, k: int
+) -> None:
     """
     Samples num_samples embeddings and creates a "sample_top_k.csv" with
     item_id -> top_k(item_ids) mappings
     """
-    random_indices = np.random.choice(1_000_000, num_samples, replace=False)
-    random_indices.sort()
-    random_embeddings = get_embeddings_by_indexes(random_indices)
-    random_ids = get_ids_by_indexes(random_indices.tolist(), df_item_ids)
+    random_indices = np.random.choice(len(store), num_samples, replace=False)
+    random_embeddings = store.get(random_indices)
+    random_ids = store.ids[random_indices].tolist()
 
     print("Searching...")
 
     print(random_embeddings.shape)
     distances, indices_list = index.search(random_embeddings, k)
     print(random_indices, distances, indices_list)
-    top_ks = [get_ids_by_indexes(indices, df_item_ids) for indices in indices_list]
+    top_ks = [store.ids[indices].tolist() for indices in indices_list]
     df_item_ids = pd.DataFrame()
     df_item_ids["item_id"] = random_ids
     df_item_ids["top_k"] = top_ks
@@ -104,71 +91,153 @@ def test_random_sample(num_samples: int, df_item_ids: pd.DataFrame) -> None:
 
 def batch_search_and_save(
     index: faiss.Index,
-    df: pd.DataFrame,
+    store: EmbeddingStore,
     k: int = 101,
     batch_size: int = 1000,
-    output_file: str = "nearest_neighbors.csv",
-):
+    output_dir: str = "dataset/nearest_neighbors",
+    output_format: str = "npy",
+    search: dict = None,
+) -> Path:
     """
-    Performs a nearest neighbors search in batches, stores the results in a CSV file,
-    and saves progress after each batch.
+    Performs a nearest neighbors search in batches, stores the results as binary
+    matrices, and saves progress after each batch.
+
+    The output directory holds:
+    - ids.npy: the item_id of each row, shared by the two matrices below
+    - neighbors.npy: int32 (N, k - 1), the rows of each row's nearest neighbors,
+      excluding the row itself, nearest first
+    - distances.npy: float16 (N, k - 1), their distances (or similarities, for
+      inner product search)
+    - progress.json: how many rows are done; a re-run with the same store (and
+      embedding shards), k and search settings resumes after them, anything else
+      starts over
+    - neighbors.parquet, if output_format is "parquet": item_id, neighbors and
+      distances columns, written once all batches are done
 
     Args:
     - index: The FAISS index or similar nearest neighbor index.
-    - df: The DataFrame containing the embeddings and item_ids.
+    - store: The embeddings and item_ids, in the order they were added to the index.
     - k: The number of nearest neighbors to search for each embedding.
     - batch_size: The number of embeddings to process in each batch.
-    - output_file: The path to the CSV file where results will be stored.
+    - output_dir: The directory where results will be stored.
+    - output_format: "npy", or "parquet" to also write neighbors.parquet.
+    - search: JSON-serializable description of how `index` searches (e.g. its
+      IndexConfig as a dict), so neighbors of different searches are never mixed.
 
     Returns:
-    - None
+    - The output directory.
     """
-    num_batches = (
-        len(df) + batch_size - 1
-    ) // batch_size  # Calculate number of batches
-
-    for i in tqdm(num_batches):
-        # Determine the start and end of the current batch
-        start_idx = i * batch_size
-        end_idx = min((i + 1) * batch_size, len(df))
-
-        # Extract the embeddings and item_ids for the current batch
-        batch_embeddings = np.stack(df["embedding"].values[start_idx:end_idx])
-        batch_item_ids = df["item_id"].iloc[start_idx:end_idx].tolist()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    num_rows = len(store)
+    shape = (num_rows, k - 1)
+    progress_path = output_dir / "progress.json"
+    progress = {
+        "num_rows": num_rows,
+        "k": k,
+        "store": str(store.directory),
+        "store_manifest": store.manifest,
+        "search": search,
+    }
+
+    completed_rows = 0
+    if progress_path.exists():
+        with open(progress_path, "r", encoding="utf-8") as f:
+            saved_progress = json.load(f)
+        if {key: saved_progress.get(key) for key in progress} == progress:
+            completed_rows = saved_progress["completed_rows"]
+        else:
+            logger.info(f"{output_dir} holds other neighbors, starting over")
+    if completed_rows:
+        logger.info(f"Resuming after {completed_rows} of {num_rows} rows")
+        neighbors = np.load(output_dir / "neighbors.npy", mmap_mode="r+")
+        distances = np.load(output_dir / "distances.npy", mmap_mode="r+")
+    else:
+        np.save(output_dir / "ids.npy", store.ids)
+        neighbors = np.lib.format.open_memmap(
+            output_dir / "neighbors.npy", mode="w+", dtype=np.int32, shape=shape
+        )
+        distances = np.lib.format.open_memmap(
+            output_dir / "distances.npy", mode="w+", dtype=np.float16, shape=shape
+        )
+
+    for start_idx in tqdm(
+        range(completed_rows, num_rows, batch_size),
+        total=(num_rows - completed_rows + batch_size - 1) // batch_size,
+    ):
+        end_idx = min(start_idx + batch_size, num_rows)
 
         # Perform the search for the current batch
-        _, indices = index.search(batch_embeddings, k)
-
-        # Collect the results as a list of dictionaries
-        batch_results = []
-        for j, item_id in enumerate(batch_item_ids):
-            # Get the similar item_ids, excluding the first one (the queried vector itself)
-            similar_item_ids = df["item_id"].iloc[indices[j][1:]].tolist()
-            batch_results.append(
-                {"item_id": item_id, "similar_item_ids": similar_item_ids}
-            )
-
-        # Convert the batch results to a DataFrame
-        batch_df = pd.DataFrame(batch_results)
+        batch_distances, indices = index.search(store.get_range(start_idx, end_idx), k)
+
+        # Drop the queried vector itself; where it is not among the results (e.g.
+        # an approximate index, or duplicates ahead of it) drop the farthest instead
+        is_self = indices == np.arange(start_idx, end_idx)[:, None]
+        is_self[~is_self.any(axis=1), -1] = True
+        is_self &= np.cumsum(is_self, axis=1) == 1  # only one column per row
+        keep = ~is_self
+        neighbors[start_idx:end_idx] = indices[keep].reshape(-1, k - 1)
+        distances[start_idx:end_idx] = batch_distances[keep].reshape(-1, k - 1)
+
+        # Checkpoint: the matrices first, then the row count that vouches for them
+        neighbors.flush()
+        distances.flush()
+        temporary_path = progress_path.with_name(progress_path.name + ".tmp")
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump({**progress, "completed_rows": end_idx}, f)
+        os.replace(temporary_path, progress_path)
+
+    if output_format == "parquet":
+        save_neighbors_parquet(output_dir)
+    print(f"Results saved to {output_dir}")
+    return output_dir
+
+
+def load_neighbors(output_dir: str = "dataset/nearest_neighbors"):
+    """Memory-map the ids, neighbors and distances written by batch_search_and_save."""
+    output_dir = Path(output_dir)
+    return (
+        np.load(output_dir / "ids.npy", mmap_mode="r"),
+        np.load(output_dir / "neighbors.npy", mmap_mode="r"),
+        np.load(output_dir / "distances.npy", mmap_mode="r"),
+    )
 
-        # Append to the output CSV file
-        if i == 0:
-            batch_df.to_csv(
-                output_file, index=False, mode="w"
-            )  # Write header in the first batch
-        else:
-            batch_df.to_csv(
-                output_file, index=False, mode="a", header=False
-            )  # Append without header
 
-    print(f"Results saved to {output_file}")
+def save_neighbors_parquet(output_dir: Path, batch_size: int = 100_000) -> Path:
+    """Write the neighbor matrices as neighbors.parquet, one row group per batch."""
+    ids, neighbors, distances = load_neighbors(output_dir)
+    width = neighbors.shape[1]
+    parquet_path = output_dir / "neighbors.parquet"
+    writer = None
+    try:
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            table = pa.table(
+                {
+                    "item_id": ids[start:end],
+                    "neighbors": pa.FixedSizeListArray.from_arrays(
+                        np.ascontiguousarray(neighbors[start:end]).reshape(-1), width
+                    ),
+                    "distances": pa.FixedSizeListArray.from_arrays(
+                        np.ascontiguousarray(distances[start:end]).reshape(-1), width
+                    ),
+                }
+            )
+            if writer is None:
+                writer = pq.ParquetWriter(parquet_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return parquet_path
 
 
 if __name__ == "__main__":
     """
-    Embeddings responses from OpenAI are written to "embeddings_out.jsonl"
-    This file is huge, we want to extract the embeddings and corresponding item_id s only
-    we will chunk these and save them as parquet files in the folder embeddings
+    Embeddings from OpenAI are written by embed_products.py as parquet shards of
+    100_000 embeddings and item_id s in the folder embeddings.
+    Results saved to a jsonl file (e.g. "embeddings_out.jsonl") by older runs still
+    need to be extracted and chunked first
     """
 
     # jsonl_file = Path("embeddings_out.jsonl")
@@ -177,24 +246,123 @@ if __name__ == "__main__":
 
     """
     Once the embeddings are extracted and chunked, we'll use a faiss index to perform 
-    similarity search for each vector, and save results to top_k.csv
+    similarity search for each vector, and save results to nearest_neighbors/
     """
-    # Initialize the FAISS index
-    vector_size = 1536
-    index = faiss.IndexFlatL2(vector_size)  # Use L2 distance (Euclidean)
-    chunks = []
-    print("Loading data and adding the embeddings to the index...")
-    for i in tqdm(range(11)):
-        chunk = load_chunk(i)
-        chunks.append(chunk)
-        index.add(np.stack(chunk["embedding"].values))
-    df = pd.DataFrame()
-    df = pd.concat(chunks)
-    chunks.clear()
-    del chunk
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", choices=INDEX_KINDS, default="flat")
+    parser.add_argument(
+        "--metric",
+        choices=["l2", "ip"],
+        default="l2",
+        help="ip: inner product of L2-normalized vectors, i.e. cosine similarity",
+    )
+    parser.add_argument("--scalar_quantizer", choices=["fp16", "int8"], default=None)
+    parser.add_argument("--store_dtype", choices=EmbeddingStore.dtypes, default="float32")
+    parser.add_argument("--nlist", type=int, default=4096)
+    parser.add_argument("--nprobe", type=int, default=32)
+    parser.add_argument("--pq_m", type=int, default=64)
+    parser.add_argument("--hnsw_m", type=int, default=32)
+    parser.add_argument("--ef_search", type=int, default=128)
+    parser.add_argument("--train_size", type=int, default=200_000)
+    parser.add_argument(
+        "--sharded",
+        action="store_true",
+        help="exact search of the memory-mapped store in shards, across worker processes",
+    )
+    parser.add_argument("--shard_rows", type=int, default=200_000)
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=5000)
+    parser.add_argument(
+        "--index_dimensions",
+        type=int,
+        default=None,
+        help="search the first N dimensions (e.g. 256), then re-rank at full dimension",
+    )
+    parser.add_argument("--shortlist_size", type=int, default=400)
+    parser.add_argument(
+        "--index_dir",
+        default=None,
+        help="saved index, reused while the embeddings are unchanged",
+    )
+    args = parser.parse_args()
+
+    # One memory-mapped matrix of all shards, built on the first run
+    store = EmbeddingStore.open_or_build(
+        "dataset/embeddings",
+        "dataset/embedding_store",
+        id_key="item_id",
+        dtype=args.store_dtype,
+        normalize=args.metric == "ip",
+    )
+
+    # The first-stage store: all dimensions, or a renormalized prefix of them
+    index_store = store
+    if args.index_dimensions is not None:
+        index_store = EmbeddingStore.open_or_build(
+            "dataset/embeddings",
+            f"dataset/embedding_store_{args.index_dimensions}d",
+            id_key="item_id",
+            dtype=args.store_dtype,
+            dimensions=args.index_dimensions,
+        )
+
+    search = {
+        "index_dimensions": args.index_dimensions,
+        "shortlist_size": args.shortlist_size if args.index_dimensions else None,
+    }
+    if args.sharded:
+        search["index"] = f"sharded/{args.metric}"
+        # every batch of queries is one pass over the store: prefer large batches
+        index = ShardedSearcher(
+            index_store,
+            shard_rows=args.shard_rows,
+            num_workers=args.num_workers,
+            metric=args.metric,
+        )
+    else:
+        # The FAISS index; "flat" is exact, see benchmark_ann.py for the others.
+        # It is built and saved on the first run, then memory-mapped from disk
+        # until the embeddings or the build options change
+        config = IndexConfig(
+            kind=args.index,
+            metric=args.metric,
+            scalar_quantizer=args.scalar_quantizer,
+            nlist=args.nlist,
+            nprobe=args.nprobe,
+            pq_m=args.pq_m,
+            hnsw_m=args.hnsw_m,
+            ef_search=args.ef_search,
+            train_size=args.train_size,
+        )
+        index_dir = args.index_dir
+        if index_dir is None:
+            index_name = describe_index(config).replace("/", "_")
+            if args.index_dimensions is not None:
+                index_name += f"_{args.index_dimensions}d"
+            index_dir = f"dataset/faiss_index/{index_name}"
+        index, _ = open_or_build_index(index_store, config, index_dir)
+        search["index"] = describe_index(config)
+        search["config"] = asdict(config)
+
+    searcher = index
+    if args.index_dimensions is not None:
+        searcher = RerankingSearcher(
+            index,
+            store,
+            args.index_dimensions,
+            shortlist_size=args.shortlist_size,
+            metric=args.metric,
+        )
 
     k = 101
     print("Starting similarity search...")
     batch_search_and_save(
-        index, df, k=101, batch_size=5000, output_file="nearest_neighbors.csv"
+        searcher,
+        store,
+        k=101,
+        batch_size=args.batch_size,
+        output_dir="dataset/nearest_neighbors",
+        search=search,
     )
+    if args.sharded:
+        index.close()
@@ -1,17 +1,35 @@
 import tiktoken
 import asyncio
+import base64
+import collections
+import functools
 import gzip
+import itertools
 import json
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import yaml
-from scripts.api_request_parallel_processor import process_api_requests_from_file
+from scripts.api_request_parallel_processor import (
+    process_api_requests_from_file,
+    save_embedding_shard,
+)
+from scripts.embedding_cache import CacheStats, EmbeddingCache, embedding_cache_key
 from loguru import logger
 
+try:
+    from orjson import loads as json_loads  # faster, if installed
+except ImportError:
+    json_loads = json.loads
+
 # Log to a file with rotation
 logger.add("data_processing.log", rotation="10 MB")
 
@@ -19,6 +37,9 @@ logger.add("data_processing.log", rotation="10 MB")
 def extract_gz(path: Path) -> Path:
     """Extracts a .gz file to the same location without the .gz extension.
 
+    Prefer `iter_jsonl_batches` or `jsonl_to_parquet`, which read the .gz file
+    directly without an uncompressed copy.
+
     Args:
         path (Path): Path to the .gz file to be extracted.
 
@@ -35,7 +56,8 @@ def extract_gz(path: Path) -> Path:
     extracted_path = path.with_suffix("")  # Remove .gz suffix for the output file
     try:
         with gzip.open(path, "rb") as f_in, open(extracted_path, "wb") as f_out:
-            f_out.write(f_in.read())
+            # copy in chunks, the decompressed file can be many GB
+            shutil.copyfileobj(f_in, f_out, length=16 * 1024**2)
         # logger.info(f"File '{path}' has been unzipped to '{extracted_path}'")
     except Exception as e:
         logger.error(f"Failed to extract '{path}': {e}")
@@ -50,25 +72,264 @@ def create_category_permutations(full_category: str) -> List[str]:
     return [" > ".join(parts[: i + 1]) for i in range(len(parts))]
 
 
-def load_and_process_data(file_path: Path, lines: int = None) -> List[dict]:
-    """Load and process data from a given file path."""
-    if file_path.suffix != ".jsonl":
-        logger.info(f"Expected a .jsonl file, got {file_path.suffix} instead")
-        raise ValueError(f"Expected a .jsonl file, got {file_path.suffix} instead")
-    products = []
+def iter_jsonl_lines(file_path: Path, read_size: int = 16 * 1024**2) -> Iterator[bytes]:
+    """
+    Stream the lines of a .jsonl or .jsonl.gz file as bytes, without line endings.
+
+    The file is read (and decompressed) `read_size` bytes at a time, so memory is
+    bounded by one read however big the file is.
+    """
+    _check_jsonl_path(file_path)
+    opener = gzip.open if file_path.suffix == ".gz" else open
+    with opener(file_path, "rb") as file:
+        remainder = b""
+        while True:
+            data = file.read(read_size)
+            if not data:
+                break
+            file_lines = (remainder + data).split(b"\n")
+            remainder = file_lines.pop()  # may be the start of a line in the next read
+            yield from file_lines
+        if remainder:
+            yield remainder
+
+
+def parse_jsonl_lines(
+    file_lines: Iterable[bytes], file_path: Path, first_line_number: int = 1
+) -> Tuple[List[dict], int]:
+    """Parse lines into records; returns the records and the number of bad lines, which are logged and skipped."""
+    records = []
+    num_bad_lines = 0
+    for line_number, line in enumerate(file_lines, start=first_line_number):
+        if not line.strip():
+            continue
+        try:
+            records.append(json_loads(line))
+        except ValueError as e:
+            num_bad_lines += 1
+            logger.warning(f"Skipping bad line {line_number} of {file_path}: {e}")
+    return records, num_bad_lines
+
+
+def iter_jsonl_batches(
+    file_path: Path,
+    lines: int = None,
+    batch_size: int = 50_000,
+    read_size: int = 16 * 1024**2,
+) -> Iterator[List[dict]]:
+    """
+    Stream a .jsonl or .jsonl.gz file as batches of parsed records.
+
+    Memory is bounded by one read and one batch however big the file is. Reads
+    at most `lines` lines; lines that are not valid JSON are logged and skipped.
+    """
+    file_lines = itertools.islice(iter_jsonl_lines(file_path, read_size), lines)
+    line_number = 1
+    num_bad_lines = 0
+    num_records = 0
+    while True:
+        # a batch of lines gives at most a batch of records
+        batch_lines = list(itertools.islice(file_lines, batch_size))
+        if not batch_lines:
+            break
+        records, num_bad = parse_jsonl_lines(batch_lines, file_path, line_number)
+        line_number += len(batch_lines)
+        num_bad_lines += num_bad
+        num_records += len(records)
+        if records:
+            yield records
+    logger.info(
+        f"Read {line_number - 1} lines of {file_path}: {num_records} records, {num_bad_lines} bad lines."
+    )
+
+
+def _check_jsonl_path(file_path: Path) -> None:
+    if not file_path.name.endswith((".jsonl", ".jsonl.gz")):
+        logger.info(f"Expected a .jsonl or .jsonl.gz file, got {file_path.name} instead")
+        raise ValueError(
+            f"Expected a .jsonl or .jsonl.gz file, got {file_path.name} instead"
+        )
+
+
+def jsonl_to_parquet(
+    file_path: Path,
+    output_file_path: Path = None,
+    lines: int = None,
+    batch_size: int = 50_000,
+    json_columns: Iterable[str] = ("details",),
+    schema: pa.Schema = None,
+) -> Path:
+    """
+    Convert a .jsonl or .jsonl.gz file to parquet, one batch at a time.
+
+    Nothing is decompressed to disk and at most one batch is held in memory.
+    Dict fields whose keys vary from record to record (`json_columns`, e.g. the
+    product `details`) are stored as JSON text. The schema starts as `schema`
+    (inferred if None) and widens as later batches need it, see
+    `WideningParquetWriter`; only records that conflict with it are logged,
+    skipped and counted. The parquet file appears only once it is complete.
+
+    Returns:
+        Path: Path to the parquet file (by default next to the input, with a
+        .parquet extension).
+    """
+    if output_file_path is None:
+        name = file_path.name.removesuffix(".gz").removesuffix(".jsonl")
+        output_file_path = file_path.with_name(name + ".parquet")
+    temporary_path = output_file_path.with_name(output_file_path.name + ".tmp")
+
+    writer = WideningParquetWriter(temporary_path, schema)
+    num_skipped = 0
     try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            for i, line in enumerate(file):
-                try:
-                    products.append(json.loads(line.strip()))
-                except Exception as e:
-                    logger.warning(f"Exception occurred while loading data: {e}")
-
-                if i == lines - 1:
-                    break
-            logger.info(
-                f"Processed file {file_path} successfully, collected: {len(products)} products."
+        for batch in iter_jsonl_batches(file_path, lines=lines, batch_size=batch_size):
+            table, num_skipped_in_batch = records_to_table(
+                batch, writer.schema, json_columns
             )
+            num_skipped += num_skipped_in_batch
+            writer.write_table(table)
+    finally:
+        writer.close()
+    if not writer.num_rows:
+        temporary_path.unlink(missing_ok=True)
+        logger.warning(
+            f"No records in {file_path} ({num_skipped} skipped), nothing written"
+        )
+        return output_file_path
+    os.replace(temporary_path, output_file_path)
+    logger.info(
+        f"Wrote {writer.num_rows} rows from {file_path} to {output_file_path}"
+        + (f", skipped {num_skipped} records that did not fit" if num_skipped else "")
+    )
+    return output_file_path
+
+
+def records_to_table(
+    records: List[dict],
+    schema: pa.Schema = None,
+    json_columns: Iterable[str] = ("details",),
+) -> Tuple[pa.Table, int]:
+    """
+    Convert records to an Arrow table; returns it and the number of records skipped.
+
+    Values of `json_columns` are stored as JSON text. The table's schema is
+    `schema` (if given) unified with the one inferred from the records, so
+    columns that are null-typed on one side take the type of the other, ints
+    widen to floats, and new columns are added. Only records with a value that
+    conflicts with the others (e.g. a string in a column of numbers) are logged
+    and skipped.
+    """
+    json_columns = set(json_columns)
+    for record in records:
+        for column in json_columns.intersection(record):
+            if record[column] is not None:
+                record[column] = json.dumps(record[column], ensure_ascii=False)
+    try:
+        table = pa.Table.from_pylist(records)
+        if schema is None:
+            return table, 0
+        return conform_table(table, widen_schema(schema, table.schema)), 0
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        pass
+    # some records conflict: widen the schema one record at a time, skipping those
+    fitting = []
+    num_skipped = 0
+    for record in records:
+        try:
+            record_schema = pa.Table.from_pylist([record]).schema
+            widened = record_schema
+            if schema is not None:
+                widened = widen_schema(schema, record_schema)
+            pa.Table.from_pylist([record], schema=widened)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError) as e:
+            num_skipped += 1
+            logger.warning(f"Skipping a record that does not fit the schema: {e}")
+            continue
+        schema = widened
+        fitting.append(record)
+    return pa.Table.from_pylist(fitting, schema=schema), num_skipped
+
+
+def widen_schema(schema: pa.Schema, other: pa.Schema) -> pa.Schema:
+    """
+    The narrowest schema both schemas' data fit in; raises pa.ArrowTypeError if
+    they conflict. Schema metadata is dropped.
+    """
+    return pa.unify_schemas(
+        [schema.remove_metadata(), other.remove_metadata()],
+        promote_options="permissive",
+    )
+
+
+def conform_table(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Cast `table` to a wider `schema`, with null columns for the fields it lacks."""
+    columns = [
+        table.column(field.name).cast(field.type)
+        if field.name in table.column_names
+        else pa.nulls(table.num_rows, field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class WideningParquetWriter:
+    """
+    Writes tables to one parquet file, widening its schema as they need it.
+
+    The schema inferred from the first records of a file is often too narrow for
+    later ones: a column that is always None so far is null-typed, a list that is
+    always empty is list<null>, and ints can turn out to be floats. When a table
+    needs a wider schema (see `widen_schema`), the rows written so far are copied
+    to a new file with that schema, one row group at a time. That happens a few
+    times, early in a file; all other tables are only cast to the schema.
+    """
+
+    def __init__(self, path: Path, schema: pa.Schema = None):
+        self.path = Path(path)
+        self.schema = schema.remove_metadata() if schema is not None else None
+        self.num_rows = 0
+        self._writer = None
+
+    def write_table(self, table: pa.Table) -> None:
+        if self.schema is None:
+            schema = table.schema.remove_metadata()
+        else:
+            schema = widen_schema(self.schema, table.schema)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, schema)
+        elif not schema.equals(self.schema):
+            self._rewrite(schema)
+        self.schema = schema
+        self._writer.write_table(conform_table(table, schema))
+        self.num_rows += table.num_rows
+
+    def _rewrite(self, schema: pa.Schema) -> None:
+        """Copy the rows written so far to a new file with the wider `schema`."""
+        self._writer.close()
+        narrow_path = self.path.with_name(self.path.name + ".narrow")
+        os.replace(self.path, narrow_path)
+        self._writer = pq.ParquetWriter(self.path, schema)
+        with pq.ParquetFile(narrow_path) as parquet_file:
+            for row_group in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(row_group)
+                self._writer.write_table(conform_table(table, schema))
+        narrow_path.unlink()
+        logger.debug(f"Widened the schema of {self.path} after {self.num_rows} rows")
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+
+
+def load_and_process_data(file_path: Path, lines: int = None) -> pd.DataFrame:
+    """Load and process data from a given .jsonl or .jsonl.gz file path."""
+    _check_jsonl_path(file_path)
+    products = []
+    try:
+        for batch in iter_jsonl_batches(file_path, lines=lines):
+            products.extend(batch)
+        logger.info(
+            f"Processed file {file_path} successfully, collected: {len(products)} products."
+        )
     except Exception as e:
         logger.error(f"Failed to process file {file_path}: {e}")
         return pd.DataFrame()
@@ -148,10 +409,45 @@ class TokenEncodingConfig:
     text_embedding_ada_002: str
 
 
+@dataclass
+class EmbeddingPackingConfig:
+    max_inputs_per_request: int
+    max_tokens_per_request: int
+
+
+@dataclass
+class EmbeddingOutputConfig:
+    format: str
+    shard_size: int
+
+
+@dataclass
+class EndpointConfig:
+    request_url: str
+    api_key_env: str
+    requests_per_minute: int
+    tokens_per_minute: int
+    weight: float = 1.0
+
+    def as_processor_endpoint(self) -> dict:
+        return {
+            "request_url": self.request_url,
+            "api_key": os.getenv(self.api_key_env),
+            "max_requests_per_minute": float(self.requests_per_minute),
+            "max_tokens_per_minute": float(self.tokens_per_minute),
+            "weight": float(self.weight),
+        }
+
+
 @dataclass
 class OpenAIConfig:
     url: URLConfig
     max_attempts: int
+    embedding_packing: EmbeddingPackingConfig
+    embedding_endpoints: List[EndpointConfig]
+    embedding_output: EmbeddingOutputConfig
+    embedding_cache_path: str
+    embedding_dimensions: Optional[int]
     logging_level: int
     limits: LimitsConfig
     token_encoding: TokenEncodingConfig
@@ -163,8 +459,27 @@ class OpenAIConfig:
             return OpenAIConfig(
                 url=URLConfig(**data["openai"]["url"]),
                 max_attempts=data["openai"]["max_attempts"],
+                embedding_packing=EmbeddingPackingConfig(
+                    **data["openai"]["embedding_packing"]
+                ),
+                embedding_endpoints=[
+                    EndpointConfig(**endpoint)
+                    for endpoint in data["openai"].get("embedding_endpoints") or []
+                ],
+                embedding_output=EmbeddingOutputConfig(
+                    **data["openai"]["embedding_output"]
+                ),
+                embedding_cache_path=data["openai"].get("embedding_cache_path"),
+                embedding_dimensions=data["openai"].get("embedding_dimensions"),
                 logging_level=data["openai"]["logging_level"],
-                limits=LimitsConfig(**data["openai"]["limits"]),
+                limits=LimitsConfig(
+                    requests_per_minute=ModelLimit(
+                        **data["openai"]["limits"]["requests_per_minute"]
+                    ),
+                    tokens_per_minute=ModelLimit(
+                        **data["openai"]["limits"]["tokens_per_minute"]
+                    ),
+                ),
                 token_encoding=TokenEncodingConfig(
                     **data["openai"]["token_encoding_name"]
                 ),
@@ -180,6 +495,14 @@ def run_api_request_processor(
     token_encoding_name: str,
     max_attempts: int,
     logging_level: int,
+    resume_key: str = None,
+    requeue_failed: bool = False,
+    max_inputs_per_request: int = 1,
+    max_tokens_per_request: int = 100_000,
+    endpoints: List[EndpointConfig] = None,
+    embedding_output: str = None,
+    embedding_id_key: str = "id",
+    embedding_shard_size: int = 100_000,
 ) -> None:
     asyncio.run(
         process_api_requests_from_file(
@@ -192,6 +515,18 @@ def run_api_request_processor(
             token_encoding_name=token_encoding_name,
             max_attempts=int(max_attempts),
             logging_level=int(logging_level),
+            resume_key=resume_key,
+            requeue_failed=requeue_failed,
+            max_inputs_per_request=max_inputs_per_request,
+            max_tokens_per_request=max_tokens_per_request,
+            endpoints=(
+                [endpoint.as_processor_endpoint() for endpoint in endpoints]
+                if endpoints
+                else None
+            ),
+            embedding_output=embedding_output,
+            embedding_id_key=embedding_id_key,
+            embedding_shard_size=embedding_shard_size,
         )
     )
 
@@ -203,65 +538,364 @@ def save_jsonl(entries: List[Dict], file_path: Path) -> None:
             f.write(json_string + "\n")
 
 
+EMBEDDING_CTX_LENGTH = 8191
+EMBEDDING_ENCODING = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def embedding_encoding() -> tiktoken.Encoding:
+    """The embedding tokenizer, loaded once per process."""
+    return tiktoken.get_encoding(EMBEDDING_ENCODING)
+
+
+def truncate_inputs_with_token_counts(inputs: List[str]) -> List[Tuple[str, int]]:
+    """Truncate each input to the embedding context length; returns (input, token count) pairs."""
+    encoding = embedding_encoding()
+    truncated = []
+    for input, tokens in zip(inputs, encoding.encode_batch(inputs, num_threads=1)):
+        if len(tokens) > EMBEDDING_CTX_LENGTH:
+            # not sure if i can pass tokens or text only
+            truncated.append(
+                (encoding.decode(tokens[:EMBEDDING_CTX_LENGTH]), EMBEDDING_CTX_LENGTH)
+            )
+        else:
+            truncated.append((input, len(tokens)))
+    return truncated
+
+
+def truncate_input_with_token_count(input: str) -> Tuple[str, int]:
+    """Truncate the input to the embedding context length and return it with its token count."""
+    return truncate_inputs_with_token_counts([input])[0]
+
+
 def truncate_input(input: str):
-    EMBEDDING_CTX_LENGTH = 8191
-    EMBEDDING_ENCODING = "cl100k_base"
-    encoding = tiktoken.get_encoding(EMBEDDING_ENCODING)
-    tokens = encoding.encode(input)
-    if len(tokens) > EMBEDDING_CTX_LENGTH:
-        return encoding.decode(
-            tokens[:EMBEDDING_CTX_LENGTH]
-        )  # not sure if i can pass tokens or text only
-    return input
+    return truncate_input_with_token_count(input)[0]
 
 
 def create_embedding_jobs(
-    df: pd.DataFrame,
+    df: Union[pd.DataFrame, Iterable[pd.DataFrame]],
     model: str,
     file_path: Path,
     product_keys: list[str] = ["product_text"],
     id_key: str = "id",
-) -> None:
+    cache: EmbeddingCache = None,
+    dimensions: int = None,
+    chunk_size: int = 10_000,
+    num_workers: int = None,
+    batch_size: int = 500,
+) -> Optional[pd.DataFrame]:
+    """
+    Stream one embedding request per row to a JSONL file.
+
+    `df` is a DataFrame or an iterable of DataFrame chunks (e.g. from
+    `pd.read_json(..., lines=True, chunksize=...)`), so the whole catalog never
+    has to be in memory. Rows are truncated and counted in batches of
+    `batch_size` across `num_workers` processes (default: one per CPU) and the
+    jobs of each chunk are written as soon as it is done, with their token count.
+
+    With a cache, rows whose text is already cached, or repeats the text of an
+    earlier row, get no job; jobs are keyed by "cache_key" instead of `id_key`
+    and a DataFrame of the `id_key` and "cache_key" of every row is returned,
+    in row order.
+    """
 
     assert file_path.suffix == ".jsonl", ValueError("File path must be a JSONL file!")
 
-    jobs = [
-        {
-            "model": model,
-            "input": truncate_input(
-                "\n\n".join([getattr(row, product_key) for product_key in product_keys])
-            ),
-            "metadata": {id_key: getattr(row, id_key)},
-        }
-        for row in df.itertuples()
-    ]
-    save_jsonl(entries=jobs, file_path=file_path)
+    if isinstance(df, pd.DataFrame):
+        chunks = (
+            df.iloc[start : start + chunk_size]
+            for start in range(0, len(df), chunk_size)
+        )
+    else:
+        chunks = df
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+    pool = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+
+    row_ids = []
+    row_keys = []
+    job_keys = set()
+    stats = CacheStats()
+    num_jobs = 0
+    num_job_tokens = 0
+    try:
+        with open(file_path, "w") as f:
+            for chunk in chunks:
+                inputs = [
+                    "\n\n".join(values)
+                    for values in zip(
+                        *(chunk[product_key] for product_key in product_keys)
+                    )
+                ]
+                batches = [
+                    inputs[start : start + batch_size]
+                    for start in range(0, len(inputs), batch_size)
+                ]
+                truncated = itertools.chain.from_iterable(
+                    pool.map(truncate_inputs_with_token_counts, batches)
+                    if pool is not None
+                    else map(truncate_inputs_with_token_counts, batches)
+                )
+
+                jobs = []
+                for id, (input, num_tokens) in zip(chunk[id_key].tolist(), truncated):
+                    # num_tokens saves the request processor from encoding the input again
+                    job = {"model": model, "input": input, "num_tokens": num_tokens}
+                    if dimensions is not None:
+                        job["dimensions"] = dimensions
+                    if cache is None:
+                        job["metadata"] = {id_key: id}
+                        jobs.append(job)
+                        continue
+
+                    key = embedding_cache_key(model, input, dimensions)
+                    row_ids.append(id)
+                    row_keys.append(key)
+                    stats.num_rows += 1
+                    if key in job_keys:
+                        stats.num_duplicates += 1
+                        continue
+                    job_keys.add(key)
+                    job["metadata"] = {"cache_key": key}
+                    jobs.append(job)
+
+                if cache is not None and jobs:
+                    cached_keys = cache.contains_many(
+                        job["metadata"]["cache_key"] for job in jobs
+                    )
+                    stats.num_hits += len(cached_keys)
+                    jobs = [
+                        job
+                        for job in jobs
+                        if job["metadata"]["cache_key"] not in cached_keys
+                    ]
+                    stats.num_misses += len(jobs)
+
+                f.writelines(json.dumps(job) + "\n" for job in jobs)
+                num_jobs += len(jobs)
+                num_job_tokens += sum(job["num_tokens"] for job in jobs)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    logger.info(
+        f"Wrote {num_jobs} embedding jobs ({num_job_tokens} tokens) to {file_path}"
+    )
+    if cache is None:
+        return None
+    logger.info(f"Embedding cache: {stats}")
+    return pd.DataFrame({id_key: row_ids, "cache_key": row_keys})
+
+
+def write_embeddings_from_cache(
+    ids: List,
+    keys: List[str],
+    cache: EmbeddingCache,
+    out_dir: Path,
+    id_key: str = "id",
+    output_format: str = "parquet",
+    shard_size: int = 100_000,
+) -> List:
+    """
+    Write the cached embedding of every id, in order, as shards in out_dir.
+
+    Uses the shard format of the request processor. Returns the ids that have no
+    cached embedding, e.g. because their request failed; they are also listed in
+    out_dir/failures.jsonl.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for path in out_dir.iterdir():
+        if path.name.startswith("shard_") or path.name == "failures.jsonl":
+            path.unlink()
+
+    failed_ids = []
+    failures = []
+    shard_index = 0
+    for start in range(0, len(keys), shard_size):
+        chunk_ids = ids[start : start + shard_size]
+        chunk_keys = keys[start : start + shard_size]
+        vectors = cache.get_many(set(chunk_keys))
+        shard_ids = []
+        shard_vectors = []
+        for id, key in zip(chunk_ids, chunk_keys):
+            if key in vectors:
+                shard_ids.append(id)
+                shard_vectors.append(vectors[key])
+            else:
+                failed_ids.append(id)
+                failures.append(
+                    [{"cache_key": key}, ["Not in the embedding cache"], {id_key: id}]
+                )
+        if shard_ids:
+            save_embedding_shard(
+                str(out_dir),
+                shard_index,
+                shard_ids,
+                np.stack(shard_vectors),
+                output_format=output_format,
+                id_key=id_key,
+            )
+            shard_index += 1
+    save_jsonl(entries=failures, file_path=out_dir / "failures.jsonl")
+    if failed_ids:
+        logger.warning(f"{len(failed_ids)} rows have no embedding, see {out_dir / 'failures.jsonl'}")
+    return failed_ids
 
 
 def load_results(
-    results_path: Path, id_key: str = "id"
+    results_path: Path, id_key: str = "id", num_workers: int = None
 ) -> Tuple[pd.DataFrame, List[str]]:
     """
     Load results from a JSONL file and return a DataFrame and a List of faild IDs.
+
+    The `embeddings` column holds rows of one float32 matrix, see `load_embedding_results`.
+    """
+    ids, vectors, fail_ids = load_embedding_results(
+        results_path, id_key=id_key, num_workers=num_workers
+    )
+    df = pd.DataFrame({id_key: ids, "embeddings": list(vectors)})
+    return df, fail_ids
+
+
+def load_embedding_results(
+    results_path: Path,
+    id_key: str = "id",
+    num_workers: int = None,
+    range_bytes: int = 64 * 1024**2,
+) -> Tuple[np.ndarray, np.ndarray, List]:
+    """
+    Load the embeddings of a results JSONL file into a float32 matrix and an id array.
+
+    The file is split into byte ranges of about `range_bytes` at line boundaries,
+    which `num_workers` processes (default: one per CPU) parse in parallel. Each
+    range comes back as a float32 block that is copied into one matrix allocated
+    up front for every line of the file, so peak memory stays close to the size
+    of the matrix instead of several times it in Python lists of floats.
+
+    Returns:
+        ids, a (num_results, dimensions) float32 matrix with the embedding of
+        ids[i] in row i, and the ids of the failed results.
     """
     assert results_path.exists(), FileNotFoundError("There is no results file!")
     assert results_path.suffix == ".jsonl", ValueError(
         "File path must be a JSONL file!"
     )
 
-    embeddings = []
+    ranges = _line_aligned_ranges(results_path, range_bytes)
+    num_lines = _count_lines(results_path)
+    dimensions = _results_dimensions(results_path)
+    vectors = np.empty((num_lines, dimensions), dtype=np.float32)
+    ids = []
     fail_ids = []
-    with open(results_path, "r", encoding="utf-8") as file:
-        for line in file:
-            id = None  # Initialize id before the try block
+
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+    pool = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    try:
+        if pool is not None:
+            # a few ranges ahead of the copying, so parsed blocks do not pile up
+            blocks = _iter_in_order(
+                pool,
+                _parse_results_range,
+                [(results_path, start, end, id_key, dimensions) for start, end in ranges],
+                window=2 * num_workers,
+            )
+        else:
+            blocks = (
+                _parse_results_range(results_path, start, end, id_key, dimensions)
+                for start, end in ranges
+            )
+        for block_ids, block_vectors, block_fail_ids in blocks:
+            vectors[len(ids) : len(ids) + len(block_ids)] = block_vectors
+            ids.extend(block_ids)
+            fail_ids.extend(block_fail_ids)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    logger.info(
+        f"Loaded {len(ids)} embeddings of {dimensions} dimensions from {results_path}, "
+        f"{len(fail_ids)} failed"
+    )
+    return np.asarray(ids), vectors[: len(ids)], fail_ids
+
+
+def _iter_in_order(pool, function, arguments: Iterable[tuple], window: int):
+    """Results of `function` over `arguments`, in order, with at most `window` submitted ahead."""
+    arguments = iter(arguments)
+    pending = collections.deque()
+    for args in itertools.islice(arguments, window):
+        pending.append(pool.submit(function, *args))
+    while pending:
+        result = pending.popleft().result()
+        for args in itertools.islice(arguments, 1):
+            pending.append(pool.submit(function, *args))
+        yield result
+
+
+def _line_aligned_ranges(file_path: Path, range_bytes: int) -> List[Tuple[int, int]]:
+    """Split a file into (start, end) byte ranges of about `range_bytes` that end after a newline."""
+    size = file_path.stat().st_size
+    boundaries = [0]
+    with open(file_path, "rb") as f:
+        while boundaries[-1] + range_bytes < size:
+            f.seek(boundaries[-1] + range_bytes)
+            f.readline()  # to the end of the line the range would split
+            if f.tell() >= size:
+                break
+            boundaries.append(f.tell())
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _count_lines(file_path: Path, read_size: int = 16 * 1024**2) -> int:
+    num_lines = 0
+    last_byte = b"\n"
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(read_size), b""):
+            num_lines += block.count(b"\n")
+            last_byte = block[-1:]
+    return num_lines + (last_byte != b"\n")
+
+
+def _results_dimensions(results_path: Path) -> int:
+    """Dimensions of the first successful embedding in a results file, 0 if there is none."""
+    with open(results_path, "rb") as f:
+        for line in f:
             try:
-                data = json.loads(line)
-                id = data[2][id_key]
-                embedding = data[1]["data"][0]["embedding"]
-                embeddings.append({id_key: id, "embeddings": embedding})
-            except Exception as e:
-                if id is not None:
-                    fail_ids.append(id)
-                logger.warning(f"JSON loads failed for ID: {id}, with exception: {e}")
-    df = pd.DataFrame(embeddings)
-    return df, fail_ids
+                return len(_result_embedding(json_loads(line)))
+            except Exception:
+                continue
+    return 0
+
+
+def _result_embedding(data: list) -> np.ndarray:
+    embedding = data[1]["data"][0]["embedding"]
+    if isinstance(embedding, str):
+        # requested with encoding_format="base64"
+        return np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def _parse_results_range(
+    results_path: Path, start: int, end: int, id_key: str, dimensions: int
+) -> Tuple[List, np.ndarray, List]:
+    """Parse the results in bytes [start, end) of a results file; runs in a worker process."""
+    with open(results_path, "rb") as f:
+        f.seek(start)
+        file_lines = f.read(end - start).splitlines()
+    vectors = np.empty((len(file_lines), dimensions), dtype=np.float32)
+    ids = []
+    fail_ids = []
+    for line in file_lines:
+        if not line.strip():
+            continue
+        id = None  # Initialize id before the try block
+        try:
+            data = json_loads(line)
+            id = data[2][id_key]
+            vectors[len(ids)] = _result_embedding(data)
+            ids.append(id)
+        except Exception as e:
+            if id is not None:
+                fail_ids.append(id)
+            logger.warning(f"JSON loads failed for ID: {id}, with exception: {e}")
+    return ids, vectors[: len(ids)], fail_ids
@@ -0,0 +1,25 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# the scripts are imported as `scripts.xxx`, from the dataset directory
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from scripts.api_request_parallel_processor import save_embedding_shard  # noqa: E402
+from scripts.embedding_store import EmbeddingStore  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path) -> EmbeddingStore:
+    """A normalized 2000 x 32 store built from two npy shards of random vectors."""
+    rng = np.random.default_rng(0)
+    shards_dir = tmp_path / "embeddings"
+    shards_dir.mkdir()
+    for shard_index in range(2):
+        start = shard_index * 1000
+        ids = [f"item{row}" for row in range(start, start + 1000)]
+        vectors = rng.normal(size=(1000, 32)).astype(np.float32)
+        save_embedding_shard(str(shards_dir), shard_index, ids, vectors)
+    return EmbeddingStore.build(shards_dir, tmp_path / "store", normalize=True)
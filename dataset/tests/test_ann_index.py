@@ -0,0 +1,57 @@
+from dataclasses import replace
+
+import numpy as np
+import pytest
+
+from scripts.ann_index import (
+    INDEX_KINDS,
+    IndexConfig,
+    build_index,
+    load_index,
+    open_or_build_index,
+    save_index,
+)
+
+
+def small_config(kind: str, **kwargs) -> IndexConfig:
+    return IndexConfig(kind=kind, nlist=16, pq_m=8, hnsw_m=8, train_size=2000, **kwargs)
+
+
+@pytest.mark.parametrize("kind", INDEX_KINDS)
+@pytest.mark.parametrize("scalar_quantizer", [None, "fp16", "int8"])
+def test_build_index(store, kind, scalar_quantizer):
+    if kind == "ivf_pq" and scalar_quantizer is not None:
+        pytest.skip("ivf_pq takes no scalar_quantizer")
+    index = build_index(store, small_config(kind, scalar_quantizer=scalar_quantizer))
+    assert index.ntotal == len(store)
+    _, neighbors = index.search(store.get_range(0, 10), 5)
+    assert neighbors.shape == (10, 5)
+    assert (neighbors >= 0).all()
+
+
+@pytest.mark.parametrize("kind", INDEX_KINDS)
+@pytest.mark.parametrize("metric", ["l2", "ip"])
+def test_saved_index_loads_memory_mapped(store, tmp_path, kind, metric):
+    config = small_config(kind, metric=metric)
+    index = build_index(store, config)
+    queries = store.get_range(0, 10)
+    distances, neighbors = index.search(queries, 5)
+    save_index(index, tmp_path / "index", config, store)
+
+    loaded, ids = load_index(tmp_path / "index", mmap=True)
+    loaded_distances, loaded_neighbors = loaded.search(queries, 5)
+    np.testing.assert_array_equal(loaded_neighbors, neighbors)
+    np.testing.assert_allclose(loaded_distances, distances, rtol=1e-5)
+    np.testing.assert_array_equal(ids, store.ids)
+
+
+def test_open_or_build_index_reuses_saved_index(store, tmp_path):
+    config = small_config("ivf_flat")
+    open_or_build_index(store, config, tmp_path / "index")
+    modified_at = (tmp_path / "index" / "index.faiss").stat().st_mtime_ns
+    # search-time settings do not need a rebuild, build options do
+    open_or_build_index(store, replace(config, nprobe=4), tmp_path / "index")
+    assert (tmp_path / "index" / "index.faiss").stat().st_mtime_ns == modified_at
+    index, _ = open_or_build_index(store, replace(config, nlist=8), tmp_path / "index")
+    assert (tmp_path / "index" / "index.faiss").stat().st_mtime_ns != modified_at
+    assert index.nlist == 8
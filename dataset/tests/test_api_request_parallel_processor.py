@@ -0,0 +1,82 @@
+import pytest
+
+from scripts.api_request_parallel_processor import (
+    APIRequest,
+    RetryQueue,
+    StatusTracker,
+    _seconds_until_capacity_refills,
+    default_retry_policies,
+)
+
+
+def test_rate_limit_pause_waits_for_one_request_not_a_full_reset():
+    headers = {
+        "x-ratelimit-limit-requests": "500",
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "1m0s",
+        "x-ratelimit-limit-tokens": "1000000",
+        "x-ratelimit-remaining-tokens": "900000",
+        "x-ratelimit-reset-tokens": "6s",
+    }
+    seconds = _seconds_until_capacity_refills(headers, num_tokens=1000)
+    assert seconds == pytest.approx(0.12)
+
+
+def test_rate_limit_pause_for_exhausted_tokens():
+    headers = {
+        "x-ratelimit-limit-tokens": "1000000",
+        "x-ratelimit-remaining-tokens": "0",
+        "x-ratelimit-reset-tokens": "1m0s",
+    }
+    # 50_000 of the 1_000_000 tokens refill in 3 of the 60 seconds
+    seconds = _seconds_until_capacity_refills(headers, num_tokens=50_000)
+    assert seconds == pytest.approx(3)
+
+
+def test_rate_limit_pause_prefers_retry_after():
+    headers = {"retry-after-ms": "250", "x-ratelimit-reset-requests": "1m0s"}
+    assert _seconds_until_capacity_refills(headers) == pytest.approx(0.25)
+    assert _seconds_until_capacity_refills({"retry-after": "2"}) == 2
+
+
+def failed_pack(error_kind: str, num_members: int = 8):
+    members = [
+        APIRequest(
+            task_id=i,
+            request_json={"model": "text-embedding-3-small", "input": f"item {i}"},
+            token_consumption=2,
+            attempts_left=5,
+            metadata=None,
+        )
+        for i in range(num_members)
+    ]
+    request = APIRequest.pack(members)
+    request.use_attempt()
+    retry_queue = RetryQueue(StatusTracker())
+    request._save_packed_results(
+        None,
+        {"error": {"message": "failed"}},
+        error_kind,
+        retry_queue,
+        default_retry_policies(5),
+        result_writer=None,
+        status_tracker=retry_queue.status_tracker,
+    )
+    return members, retry_queue
+
+
+def test_rejected_pack_is_split_without_charging_the_attempt():
+    members, retry_queue = failed_pack("client")
+    assert len(retry_queue) == 2
+    assert retry_queue.has_due_request()
+    assert all(member.attempts_left == 5 for member in members)
+
+
+@pytest.mark.parametrize("error_kind", ["server", "timeout", "other"])
+def test_failed_pack_is_retried_whole_with_backoff(error_kind):
+    members, retry_queue = failed_pack(error_kind)
+    assert len(retry_queue) == 1
+    assert len(retry_queue.pop_due_request().members) == len(members)
+    # the attempt is charged, and the error counts towards the policy's backoff
+    assert all(member.attempts_left == 4 for member in members)
+    assert all(member.error_counts == {error_kind: 1} for member in members)
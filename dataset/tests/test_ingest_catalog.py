@@ -0,0 +1,65 @@
+import gzip
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from scripts.ingest_catalog import existing_shards, ingest_catalog, ingest_file
+
+
+def write_catalog(path):
+    lines = [
+        json.dumps({"parent_asin": f"A{i}", "price": None, "videos": []})
+        for i in range(10)
+    ]
+    lines += ["", "{not json"]
+    lines += [
+        json.dumps({"parent_asin": f"B{i}", "price": 9.99, "videos": [{"title": "x"}]})
+        for i in range(9)
+    ]
+    lines.append(json.dumps({"parent_asin": "C0", "price": "cheap", "videos": []}))
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def read_shards(shards):
+    tables = [pq.read_table(shard) for shard in shards]
+    schema = pa.unify_schemas(
+        [table.schema.remove_metadata() for table in tables],
+        promote_options="permissive",
+    )
+    return pa.concat_tables([table.cast(schema) for table in tables]).to_pylist()
+
+
+def test_ingest_keeps_rows_with_values_in_columns_null_in_the_first_shard(tmp_path):
+    input_dir, output_dir = tmp_path / "meta", tmp_path / "parquet"
+    input_dir.mkdir()
+    write_catalog(input_dir / "meta_Test.jsonl.gz")
+
+    entry = ingest_catalog(input_dir, output_dir, num_workers=1, rows_per_shard=5)[
+        "meta_Test.jsonl.gz"
+    ]
+
+    assert entry["status"] == "done"
+    assert entry["lines"] == 22
+    assert (entry["rows"], entry["blank_lines"], entry["bad_lines"]) == (19, 1, 1)
+    assert entry["skipped_records"] == 1
+    rows = read_shards(existing_shards(output_dir, "meta_Test"))
+    assert len(rows) == 19
+    assert [row["price"] for row in rows[10:]] == [9.99] * 9
+    assert rows[-1]["videos"] == [{"title": "x"}]
+
+
+def test_resumed_file_accounts_for_every_line(tmp_path):
+    path = tmp_path / "meta_Test.jsonl.gz"
+    write_catalog(path)
+    first = ingest_file(path, tmp_path, rows_per_shard=5)
+    existing_shards(tmp_path, "meta_Test")[-1].unlink()
+
+    resumed = ingest_file(path, tmp_path, rows_per_shard=5)
+
+    assert resumed["resumed_shards"] == 4
+    assert resumed["status"] == "done"
+    for key in ("lines", "rows", "blank_lines", "bad_lines", "skipped_records"):
+        assert resumed[key] == first[key]
+    assert len(read_shards(existing_shards(tmp_path, "meta_Test"))) == 19
@@ -0,0 +1,36 @@
+import asyncio
+import base64
+
+import numpy as np
+from aiohttp.test_utils import TestClient, TestServer
+
+from scripts.mock_openai_server import MockServerConfig, create_app
+
+
+async def embed(body: dict) -> dict:
+    app = create_app(MockServerConfig(latency="constant", latency_mean_seconds=0))
+    async with TestClient(TestServer(app)) as client:
+        response = await client.post("/v1/embeddings", json=body)
+        assert response.status == 200
+        return await response.json()
+
+
+def test_embeddings_response_is_pre_encoded_json():
+    response = asyncio.run(
+        embed({"model": "text-embedding-3-small", "input": ["a", "b", "c"]})
+    )
+    assert [item["index"] for item in response["data"]] == [0, 1, 2]
+    assert len(response["data"][0]["embedding"]) == 1536
+    assert response["model"] == "text-embedding-3-small"
+    assert response["usage"] == {"prompt_tokens": 3, "total_tokens": 3}
+
+
+def test_embeddings_response_with_dimensions_and_base64():
+    response = asyncio.run(
+        embed({"input": "a", "dimensions": 256, "encoding_format": "base64"})
+    )
+    vector = np.frombuffer(
+        base64.b64decode(response["data"][0]["embedding"]), dtype="<f4"
+    )
+    assert vector.shape == (256,)
+    assert abs(np.linalg.norm(vector) - 1) < 1e-5
@@ -0,0 +1,34 @@
+import importlib.util
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+# top-k.py is not an importable module name
+spec = importlib.util.spec_from_file_location(
+    "top_k", Path(__file__).resolve().parents[1] / "scripts" / "top-k.py"
+)
+top_k = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(top_k)
+
+
+def test_checkpoint_of_another_search_is_not_resumed(store, tmp_path):
+    index = faiss.IndexFlat(store.dimensions)
+    index.add(store.get_range(0, len(store)))
+    output_dir = tmp_path / "nearest_neighbors"
+    search = {"index": "flat/l2/float32"}
+    top_k.batch_search_and_save(index, store, k=6, output_dir=output_dir, search=search)
+    _, neighbors, _ = top_k.load_neighbors(output_dir)
+    expected = np.array(neighbors)
+
+    # a finished checkpoint of the same search is resumed, i.e. nothing is redone
+    neighbors = np.load(output_dir / "neighbors.npy", mmap_mode="r+")
+    neighbors[:] = -1
+    neighbors.flush()
+    del neighbors
+    top_k.batch_search_and_save(index, store, k=6, output_dir=output_dir, search=search)
+    assert (top_k.load_neighbors(output_dir)[1] == -1).all()
+
+    search = {"index": "hnsw/l2/float32"}
+    top_k.batch_search_and_save(index, store, k=6, output_dir=output_dir, search=search)
+    np.testing.assert_array_equal(top_k.load_neighbors(output_dir)[1], expected)
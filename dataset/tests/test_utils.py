@@ -0,0 +1,43 @@
+import gzip
+import json
+
+import pyarrow.parquet as pq
+
+from scripts.utils import jsonl_to_parquet, records_to_table
+
+
+def write_jsonl_gz(path, records):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def test_columns_that_are_null_in_the_first_batch_keep_later_values(tmp_path):
+    records = [
+        {"parent_asin": f"A{i}", "price": None, "videos": [], "details": {}}
+        for i in range(10)
+    ] + [
+        {
+            "parent_asin": f"B{i}",
+            "price": 9.99 if i % 2 else 5,
+            "videos": [{"title": "unboxing", "url": "https://example.com"}],
+            "details": {"Color": "red"},
+        }
+        for i in range(10)
+    ]
+    write_jsonl_gz(tmp_path / "meta_Test.jsonl.gz", records)
+
+    parquet_path = jsonl_to_parquet(tmp_path / "meta_Test.jsonl.gz", batch_size=5)
+
+    rows = pq.read_table(parquet_path).to_pylist()
+    assert [row["parent_asin"] for row in rows] == [r["parent_asin"] for r in records]
+    assert [row["price"] for row in rows[10:]] == [5, 9.99] * 5
+    assert rows[10]["videos"][0]["title"] == "unboxing"
+    assert json.loads(rows[10]["details"]) == {"Color": "red"}
+
+
+def test_only_conflicting_records_are_skipped():
+    records = [{"price": 1.5}, {"price": "cheap"}, {"price": None}, {"price": 2}]
+    table, num_skipped = records_to_table(records)
+    assert num_skipped == 1
+    assert table.column("price").to_pylist() == [1.5, None, 2]